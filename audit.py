@@ -0,0 +1,137 @@
+# Copyright 2021 Jaewan Yun <jaeyun@ucdavis.edu>
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import argparse
+import datetime
+import json
+import statistics
+
+from database import Database
+from logger import Logger
+
+
+L = Logger()
+L.set_log_type('OKGREEN')
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def _median(values):
+    if len(values) == 0:
+        return 0
+    return statistics.median(values)
+
+
+def find_gaps(counts, context=5, lookaround=60, window=7, min_baseline=5, low_ratio=0.1, merge_days=2):
+    """Find suspicious dates in a series of `(date, count)` rows.
+
+    A run of empty dates is a gap when the `context` nearest non-empty dates
+    on both sides are dense. A non-empty date is partial when it has less than
+    `low_ratio` of the median of the `window` dates around it, as happens
+    when a window was cut off at a page limit. Flagged dates closer than
+    `merge_days` are merged so each range becomes one refetch job.
+
+    Returns a list of `(first_date, last_date, reason)` ranges.
+    """
+    if counts is None or len(counts) < 3:
+        return []
+    by_date = {d: n for d, n in counts}
+    first = counts[0][0]
+    days = [first + datetime.timedelta(days=i) for i in range((counts[-1][0] - first).days + 1)]
+    values = [by_date.get(d, 0) for d in days]
+
+    flagged = []
+    i = 1
+    while i < len(days) - 1:
+        if values[i] == 0:
+            # Extent of the empty run
+            j = i
+            while j < len(days) - 1 and values[j] == 0:
+                j += 1
+            left = [v for v in values[max(0, i - lookaround):i] if v > 0][-context:]
+            right = [v for v in values[j:j + lookaround] if v > 0][:context]
+            if _median(left) >= min_baseline and _median(right) >= min_baseline:
+                flagged.extend([(days[k], 'empty') for k in range(i, j)])
+            i = j
+            continue
+        around = values[max(0, i - window):i] + values[i + 1:i + 1 + window]
+        baseline = _median(around)
+        if baseline >= min_baseline and values[i] < low_ratio * baseline:
+            flagged.append((days[i], 'partial'))
+        i += 1
+
+    ranges = []
+    for day, reason in flagged:
+        if len(ranges) > 0 and (day - ranges[-1][1]).days <= merge_days:
+            reasons = ranges[-1][2] if reason in ranges[-1][2] else '{},{}'.format(ranges[-1][2], reason)
+            ranges[-1] = (ranges[-1][0], day, reasons)
+        else:
+            ranges.append((day, day, reason))
+    return ranges
+
+
+def audit(sources, symbols=None, output='gaps.jsonl', **kwargs):
+    """Scan the daily series of every stored symbol and write one refetch job
+    per suspicious range to `output`. Keyword arguments go to `find_gaps`.
+    """
+    database = Database(id='A')
+    n_jobs = 0
+    n_days = 0
+    with open(output, 'w') as f:
+        for source in sources:
+            stored = database.tables(source) or []
+            if symbols is not None:
+                stored = [s for s in stored if s in symbols]
+            for symbol in sorted(stored):
+                ranges = find_gaps(database.daily_counts(symbol, source), **kwargs)
+                for first, last, reason in ranges:
+                    since = datetime.datetime.combine(first, datetime.time())
+                    until = datetime.datetime.combine(last, datetime.time()) + datetime.timedelta(days=1)
+                    f.write(json.dumps({
+                        'source': source,
+                        'symbol': symbol,
+                        'since': since.strftime(DATE_FORMAT),
+                        'until': until.strftime(DATE_FORMAT),
+                        'reason': reason,
+                    }) + '\n')
+                    n_jobs += 1
+                    n_days += (last - first).days + 1
+                if len(ranges) > 0:
+                    L.log(' [Audit]:\t', '{} {} has {} suspicious ranges'.format(source, symbol, len(ranges)))
+    database.close()
+    L.log(' [Audit]:\t', '{} refetch jobs covering {} days written to {}'.format(n_jobs, n_days, output))
+    return n_jobs
+
+
+def read_jobs(filename, source):
+    """Read the jobs of one source from an audit file as `download_query`
+    arguments.
+    """
+    jobs = []
+    with open(filename) as f:
+        for line in f:
+            job = json.loads(line)
+            if job['source'] != source:
+                continue
+            jobs.append({
+                'symbol': job['symbol'],
+                'recency': None,
+                'newest_datetime': datetime.datetime.strptime(job['since'], DATE_FORMAT),
+                'prechecked': True,
+                'until': datetime.datetime.strptime(job['until'], DATE_FORMAT),
+            })
+    return jobs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sources', nargs='+', default=['reddit', 'twitter'], help='sources to audit')
+    parser.add_argument('--symbols', nargs='+', help='symbols to audit, all stored symbols by default')
+    parser.add_argument('--output', default='gaps.jsonl', help='file to write refetch jobs to')
+    parser.add_argument('--min-baseline', type=float, default=5, help='rows per day for a date to count as dense')
+    args = parser.parse_args()
+
+    audit(args.sources, symbols=args.symbols, output=args.output, min_baseline=args.min_baseline)
@@ -0,0 +1,177 @@
+# Copyright 2021 Jaewan Yun <jaeyun@ucdavis.edu>
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import json
+import threading
+import time
+
+from logger import Logger
+
+
+L = Logger()
+L.set_log_type('OKCYAN')
+
+
+class Autoscaler:
+    """Adjust the number of workers at runtime between `n_min` and `n_max`.
+
+    Every `interval` seconds the rows/s, throttled and failed response rates,
+    mean write latency and queue depth since the last check are compared.
+    Throttling, errors or slow writes retire a quarter of the workers.
+    Otherwise a worker is added while each addition keeps raising rows/s by
+    `min_gain`, and the last one is retired again when it does not.
+
+    `start_worker(worker_id)` starts a worker, which must call `should_stop`
+    between jobs and `stopped` when it exits. `throughputs` are the
+    `Throughput` objects the workers report to, and `depth` returns the
+    number of queued jobs, or None if unknown.
+    """
+
+    def __init__(self, start_worker, throughputs, depth=None, n_min=1, n_max=32, interval=30,
+                 max_error_rate=0.1, max_write_latency=5.0, min_gain=0.05, log_file=None):
+        self.start_worker = start_worker
+        self.throughputs = throughputs
+        self.depth = depth or (lambda: None)
+        self.n_min = n_min
+        self.n_max = n_max
+        self.interval = interval
+        self.max_error_rate = max_error_rate
+        self.max_write_latency = max_write_latency
+        self.min_gain = min_gain
+        self.log_file = log_file
+        self.label = ' [{}]:\t'.format('Autoscale')
+
+        self.lock = threading.Lock()
+        self.n_workers = 0
+        self.n_retiring = 0
+        self.next_id = 0
+        self.decisions = []
+        self.last = None
+        self.last_action = None
+        self.last_rate = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _totals(self):
+        totals = {'rows': 0, 'responses': 0, 'throttled': 0, 'errors': 0, 'writes': 0, 'write_time': 0.0}
+        for throughput in self.throughputs:
+            snapshot = throughput.snapshot()
+            for key in totals:
+                totals[key] += snapshot[key]
+        totals['time'] = time.time()
+        return totals
+
+    def add(self, n=1):
+        for _ in range(n):
+            with self.lock:
+                if self.n_workers - self.n_retiring >= self.n_max:
+                    return
+                if self.n_retiring > 0:
+                    # Cancel a pending retirement instead of starting a worker
+                    self.n_retiring -= 1
+                    continue
+                self.n_workers += 1
+                worker_id = self.next_id
+                self.next_id += 1
+            self.start_worker(worker_id)
+
+    def retire(self, n=1):
+        with self.lock:
+            n = min(n, self.n_workers - self.n_retiring - self.n_min)
+            if n > 0:
+                self.n_retiring += n
+
+    def should_stop(self):
+        """Called by a worker between jobs. True if it should exit.
+        """
+        with self.lock:
+            if self.n_retiring > 0:
+                self.n_retiring -= 1
+                self.n_workers -= 1
+                return True
+        return False
+
+    def stopped(self):
+        """Called by a worker that exits on its own, such as when the queue is
+        empty.
+        """
+        with self.lock:
+            self.n_workers -= 1
+
+    def active(self):
+        with self.lock:
+            return self.n_workers - self.n_retiring
+
+    def decide(self, metrics):
+        """Return the change in workers and the reason for it.
+        """
+        n = self.active()
+        error_rate = (metrics['throttled'] + metrics['errors']) / max(metrics['responses'], 1)
+        if metrics['responses'] > 0 and error_rate > self.max_error_rate:
+            return -max(1, n // 4), 'error rate {:.1%} above {:.1%}'.format(error_rate, self.max_error_rate)
+        if metrics['write_latency'] > self.max_write_latency:
+            return -max(1, n // 4), 'write latency {:.2f}s above {:.2f}s'.format(metrics['write_latency'], self.max_write_latency)
+        if metrics['depth'] is not None and metrics['depth'] <= n:
+            return 0, 'queue depth {} leaves no work for more workers'.format(metrics['depth'])
+        if self.last_action == 'add' and self.last_rate is not None and metrics['rate'] < self.last_rate * (1 + self.min_gain):
+            return -1, 'rows/s {:.1f} did not rise {:.0%} above {:.1f}'.format(metrics['rate'], self.min_gain, self.last_rate)
+        if self.last_action == 'retire' and metrics['rate'] >= (self.last_rate or 0):
+            return 0, 'holding at rows/s {:.1f}'.format(metrics['rate'])
+        return 1, 'probing with rows/s at {:.1f}'.format(metrics['rate'])
+
+    def check(self):
+        totals = self._totals()
+        if self.last is None:
+            self.last = totals
+            return
+        elapsed = max(totals['time'] - self.last['time'], 1e-9)
+        writes = totals['writes'] - self.last['writes']
+        metrics = {
+            'rate': (totals['rows'] - self.last['rows']) / elapsed,
+            'responses': totals['responses'] - self.last['responses'],
+            'throttled': totals['throttled'] - self.last['throttled'],
+            'errors': totals['errors'] - self.last['errors'],
+            'write_latency': (totals['write_time'] - self.last['write_time']) / writes if writes > 0 else 0.0,
+            'depth': self.depth(),
+        }
+        self.last = totals
+
+        change, reason = self.decide(metrics)
+        before = self.active()
+        if change > 0:
+            self.add(change)
+        elif change < 0:
+            self.retire(-change)
+        after = self.active()
+        action = 'add' if after > before else 'retire' if after < before else 'hold'
+        self.last_action = action
+        self.last_rate = metrics['rate']
+
+        decision = {
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'workers': after,
+            'action': action,
+            'reason': reason,
+            **metrics,
+        }
+        self.decisions.append(decision)
+        L.log(self.label, '{} {} -> {} workers: {}'.format(action, before, after, reason))
+        if self.log_file is not None:
+            with open(self.log_file, 'a') as f:
+                f.write(json.dumps(decision) + '\n')
+
+    def _loop(self):
+        while not self._stopped.wait(self.interval):
+            self.check()
+
+    def start(self, n_start):
+        self.add(max(self.n_min, min(n_start, self.n_max)))
+        self.last = self._totals()
+        self._thread = threading.Thread(target=self._loop, name='autoscale', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
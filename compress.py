@@ -0,0 +1,154 @@
+# Copyright 2021 Jaewan Yun <jaeyun@ucdavis.edu>
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import argparse
+import collections
+import re
+import struct
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from logger import Logger
+
+
+L = Logger()
+L.set_log_type('OKGREEN')
+
+# Text columns stored compressed in tables created with `compress_text`
+COLUMNS = {
+    'reddit': ['body'],
+    'twitter': ['full_text', 'source', 'user_name', 'hashtags', 'symbols', 'user_mentions', 'urls'],
+}
+
+RAW = 0
+ZLIB = 1
+ZSTD = 2
+HEADER = struct.Struct('>BH')
+# Values shorter than this gain nothing from compression
+MIN_LENGTH = 24
+ZLIB_DICT_SIZE = 32 * 1024
+ZSTD_DICT_SIZE = 110 * 1024
+
+WORD = re.compile(r'\S+')
+
+
+class Codecs:
+    """Encoders and decoders of one source. Every value starts with its codec
+    and dictionary version, so rows written before a dictionary was retrained
+    still decode. Version 0 is plain zlib without a dictionary.
+    """
+
+    def __init__(self, source, dictionaries=None):
+        self.source = source
+        self.dictionaries = {0: (ZLIB, b'')}
+        self.dictionaries.update(dictionaries or {})
+        self.version = max(self.dictionaries)
+        self._zstd = {}
+
+    def _zstd_dict(self, version):
+        if version not in self._zstd:
+            self._zstd[version] = zstandard.ZstdCompressionDict(self.dictionaries[version][1])
+        return self._zstd[version]
+
+    def encode(self, text):
+        if text is None:
+            return None
+        data = text.encode('utf-8') if isinstance(text, str) else text
+        if len(data) < MIN_LENGTH:
+            return HEADER.pack(RAW, 0) + data
+        version = self.version
+        codec, zdict = self.dictionaries[version]
+        if codec == ZSTD:
+            compressed = zstandard.ZstdCompressor(dict_data=self._zstd_dict(version)).compress(data)
+        else:
+            compressor = zlib.compressobj(level=9, zdict=zdict) if zdict else zlib.compressobj(level=9)
+            compressed = compressor.compress(data) + compressor.flush()
+        if len(compressed) >= len(data):
+            return HEADER.pack(RAW, 0) + data
+        return HEADER.pack(codec, version) + compressed
+
+    def decode(self, value):
+        if value is None or isinstance(value, str):
+            return value
+        value = bytes(value)
+        codec, version = HEADER.unpack_from(value)
+        data = value[HEADER.size:]
+        if codec == ZLIB:
+            zdict = self.dictionaries[version][1]
+            decompressor = zlib.decompressobj(zdict=zdict) if zdict else zlib.decompressobj()
+            data = decompressor.decompress(data) + decompressor.flush()
+        elif codec == ZSTD:
+            data = zstandard.ZstdDecompressor(dict_data=self._zstd_dict(version)).decompress(data)
+        return data.decode('utf-8')
+
+
+def train(samples, size=None):
+    """Build a dictionary from sample values. Returns `(codec, data)`, using
+    zstd when it is installed and a zlib preset dictionary otherwise.
+    """
+    samples = [s.encode('utf-8') if isinstance(s, str) else s for s in samples if s]
+    if zstandard is not None and len(samples) >= 100:
+        return ZSTD, zstandard.train_dictionary(size or ZSTD_DICT_SIZE, samples).as_bytes()
+
+    # zlib only looks back 32 KB, so the dictionary holds the strings that
+    # save the most bytes, with the most valuable last
+    size = size or ZLIB_DICT_SIZE
+    counts = collections.Counter()
+    for s in samples:
+        if len(s) <= 256:
+            counts[s] += 1
+        for word in set(WORD.findall(s.decode('utf-8', 'ignore'))):
+            counts[word.encode('utf-8')] += 1
+    ranked = sorted([s for s, n in counts.items() if n > 1], key=lambda s: counts[s] * len(s))
+    parts = []
+    total = 0
+    for s in reversed(ranked):
+        if total + len(s) + 1 > size:
+            break
+        parts.append(s)
+        total += len(s) + 1
+    return ZLIB, b' '.join(reversed(parts))
+
+
+def train_sources(sources, n_symbols=20, n_rows=5000):
+    """Train and store a new dictionary for each source from the rows of its
+    largest tables.
+    """
+    from database import Database
+    database = Database(id='C')
+    for source in sources:
+        stored = database.tables(source) or []
+        sizes = sorted(stored, key=lambda s: -((database.size(s, source) or [[0]])[0][0]))
+        samples = []
+        for symbol in sizes[:n_symbols]:
+            # Tables created with `normalize_users` have no user_name
+            columns = [c for c in COLUMNS[source] if c in database.table_columns(symbol, source)]
+            for i, row in enumerate(database.scan(symbol, source, columns=columns, typed=False)):
+                if i >= n_rows:
+                    break
+                samples.extend([v for v in row if v])
+        if len(samples) == 0:
+            L.log(' [Compress]:\t', 'No rows to train a {} dictionary from'.format(source))
+            continue
+        codec, data = train(samples)
+        version = database.add_dictionary(source, codec, data)
+        L.log(' [Compress]:\t', '{} dictionary version {} trained on {} values, {} bytes, {}'.format(
+            source, version, len(samples), len(data), 'zstd' if codec == ZSTD else 'zlib'))
+    database.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sources', nargs='+', default=['reddit', 'twitter'], help='sources to train dictionaries for')
+    parser.add_argument('--symbols', type=int, default=20, help='number of the largest tables to sample')
+    parser.add_argument('--rows', type=int, default=5000, help='rows to sample per table')
+    args = parser.parse_args()
+
+    train_sources(args.sources, n_symbols=args.symbols, n_rows=args.rows)
@@ -4,20 +4,201 @@
 # THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 
+import collections
 import datetime
+import functools
+import hashlib
+import inspect
 import json
 import time
+import threading
 import mysql.connector
+from queue import Queue, Empty
 
+import compress
 from logger import Logger
+from shards import ShardMap, shard_name, CONNECTION_KEYS
+from spool import Spool
 
 
 L = Logger()
 L.set_log_type('WARNING')
 
 
+class SeenIds:
+    """IDs recently stored per table, so rows fetched again by overlapping
+    windows are dropped before they reach the database.
+
+    The set is exact, so a new row is never mistaken for a stored one, and
+    each table keeps at most `max_ids`, forgetting the oldest first.
+    """
+
+    def __init__(self, max_ids=200000):
+        self.max_ids = max_ids
+        self.lock = threading.Lock()
+        self.ids = {}
+        self.order = {}
+
+    def warmed(self, table_name):
+        with self.lock:
+            return table_name in self.ids
+
+    def add(self, table_name, ids):
+        with self.lock:
+            seen = self.ids.setdefault(table_name, set())
+            order = self.order.setdefault(table_name, collections.deque())
+            for id in ids:
+                if id in seen:
+                    continue
+                seen.add(id)
+                order.append(id)
+            while len(order) > self.max_ids:
+                seen.discard(order.popleft())
+
+    def unseen(self, table_name, values):
+        """Rows of `values` whose first column is not a stored ID.
+        """
+        with self.lock:
+            seen = self.ids.get(table_name)
+            if seen is None:
+                return values
+            return [v for v in values if v[0] not in seen]
+
+    def forget(self, table_name):
+        with self.lock:
+            self.ids.pop(table_name, None)
+            self.order.pop(table_name, None)
+
+
+# Shared by every connection of a process
+SEEN = SeenIds()
+
+
+class UserStates:
+    """Snapshot last written for recently seen Twitter users, so profiles
+    that have not changed are not written again. Least recently seen users
+    are forgotten beyond `max_users`.
+    """
+
+    def __init__(self, max_users=100000):
+        self.max_users = max_users
+        self.lock = threading.Lock()
+        self.states = collections.OrderedDict()
+
+    def changed(self, user_id, snapshot):
+        with self.lock:
+            if self.states.get(user_id) == snapshot:
+                self.states.move_to_end(user_id)
+                return False
+            return True
+
+    def add(self, user_id, snapshot):
+        with self.lock:
+            self.states[user_id] = snapshot
+            self.states.move_to_end(user_id)
+            while len(self.states) > self.max_users:
+                self.states.popitem(last=False)
+
+
+USERS = UserStates()
+
+# Profile tables of `normalize_users`, which share the prefix of tweet tables
+USER_TABLES = ['Twitter_Users', 'Twitter_User_Snapshots']
+
+# Aggregates kept per source, symbol and bucket
+ROLLUP_TABLES = {
+    'hour': 'Rollup_Hourly',
+    'day': 'Rollup_Daily',
+}
+ROLLUP_BUCKETS = {
+    'hour': 'DATE_FORMAT(datetime, "%Y-%m-%d %H:00:00")',
+    'day': 'CAST(DATE(datetime) AS DATETIME)',
+}
+# Columns of each source that feed the rollup sums and author counts
+ROLLUP_COLUMNS = {
+    'reddit': {'score': 'score', 'favorite': None, 'retweet': None, 'author': 'author'},
+    'twitter': {'score': None, 'favorite': 'favorite_count', 'retweet': 'retweet_count', 'author': 'user_id'},
+}
+# Engagement counts that change after a post is stored
+METRIC_COLUMNS = {
+    'reddit': ['score'],
+    'twitter': ['favorite_count', 'retweet_count', 'reply_count', 'quote_count'],
+}
+
+
+# Functions called with `(symbol, type, rows)` for rows stored by add_data
+LISTENERS = []
+
+# Errors meaning the server is unreachable rather than the command is wrong
+CONNECTION_ERRORS = {-1, 2003, 2006, 2013, 2055}
+
+
+class DatabaseUnavailable(Exception):
+    """Raised by reads whose result would otherwise be mistaken for an
+    empty table while the server is unreachable.
+    """
+
+# Spools shared by every connection of a process, by config file
+SPOOLS = {}
+SPOOLS_LOCK = threading.Lock()
+
+
+def open_spool(config_file='config.json', shared=True):
+    """Spool for the `spool_dir` of a config file, or None if it has none.
+    Rows are replayed through a connection of its own.
+    """
+    with open(config_file) as f:
+        directory = json.load(f).get('spool_dir')
+    if directory is None:
+        return None
+
+    databases = []
+
+    def replay(symbol, type, names, values):
+        if len(databases) == 0:
+            databases.append(Database(id='S', config_file=config_file, spool=False))
+        return databases[0].replay(symbol, type, names, values)
+
+    if not shared:
+        return Spool(directory, replay)
+    with SPOOLS_LOCK:
+        if config_file not in SPOOLS:
+            SPOOLS[config_file] = Spool(directory, replay)
+        return SPOOLS[config_file]
+
+
+def add_listener(listener):
+    LISTENERS.append(listener)
+
+
+def remove_listener(listener):
+    if listener in LISTENERS:
+        LISTENERS.remove(listener)
+
+
+def _routed(method):
+    """Run a method taking a `symbol` and `type` on the shard that holds
+    the symbol, when the database is sharded.
+    """
+    signature = inspect.signature(method)
+
+    @functools.wraps(method)
+    def route(self, *args, **kwargs):
+        if self.shard_map is None:
+            return method(self, *args, **kwargs)
+        arguments = signature.bind(self, *args, **kwargs).arguments
+        return getattr(self.shard(arguments['symbol'], arguments['type']), method.__name__)(*args, **kwargs)
+    return route
+
+
+def _bucket(dt, period):
+    if period == 'hour':
+        return dt.replace(minute=0, second=0, microsecond=0)
+    return dt.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
 class Database:
-    def __init__(self, id='N/A', config_file='config.json', verbose=True):
+    def __init__(self, id='N/A', config_file='config.json', verbose=True, spool=True, shard=None):
         self.id = id
         self.verbose = verbose
         self.config_file = config_file
@@ -30,6 +211,16 @@ class Database:
         self.db_label = ' (D{}):\t'.format(self.id)
         self.reconnect_tries = 100
         self.reconnect_delay = 10
+        # Whether the last command failed because the server is unreachable
+        self.unavailable = False
+        self.created_tables = set()
+        self.seen = SEEN
+        self.users = USERS
+        self.codecs = {}
+        self.compressed = {}
+        self.columns = {}
+        self.shard_map = None
+        self.shards = {}
 
         # Read configuration from file
         try:
@@ -40,15 +231,42 @@ class Database:
             self.config['user'] = config['user']
             self.config['password'] = config['password']
             self.config['database'] = config['database']
+            self.rollups = config.get('rollups', True)
+            self.compress_text = config.get('compress_text', False)
+            self.normalize_users = config.get('normalize_users', False)
+            # Seconds an insert may take before writes go to the spool
+            self.spool_latency = config.get('spool_latency', 10)
+            # Symbols are spread over the `shards` databases, whose entries
+            # default to the connection settings above
+            shards = {shard_name(entry): entry for entry in config.get('shards') or []}
+            if shard is not None:
+                self.config.update({key: shards[shard][key] for key in CONNECTION_KEYS if key in shards[shard]})
+                self.db_label = ' (D{}@{}):\t'.format(self.id, shard)
+            elif len(shards) > 0:
+                self.shard_map = ShardMap(list(shards))
         except Exception as e:
             if self.verbose:
                 L.log(self.db_label, 'Failed to read {}'.format(self.config_file), e)
             raise Exception('Failed to read {}'.format(self.config_file))
 
-        # Establish connection
-        self.conn = mysql.connector.connect(**self.config)
-        if self.verbose:
-            L.log(self.db_label, 'Connected to database')
+        self.spool = open_spool(self.config_file) if spool else None
+
+        # Establish connection. A sharded database only routes to the
+        # shards, which are connected to when first used
+        self.last_reconnect = time.time()
+        self.conn = None
+        if self.shard_map is None:
+            try:
+                self.conn = mysql.connector.connect(**self.config)
+                if self.verbose:
+                    L.log(self.db_label, 'Connected to database')
+            except mysql.connector.Error as e:
+                if self.spool is None:
+                    raise
+                # Writes are spooled until the database comes back
+                if self.verbose:
+                    L.log(self.db_label, 'Database unavailable, spooling writes', e)
+                self.spool.trip()
 
         self.twitter_format = [
             # Tweet data
@@ -83,6 +301,8 @@ class Database:
             {'key': ['update_datetime', ], 'name': 'update_datetime', 'type': 'DATETIME NOT NULL'},
             # {'key': ['user_data_json', ], 'name': 'user_data', 'type': 'TEXT DEFAULT ""'},
             {'key': ['user_id', ], 'name': 'user_id', 'type': 'TEXT NOT NULL'},
+            # Profile at the time of the tweet, in tables created with `normalize_users`
+            {'key': ['user_snapshot', ], 'name': 'user_snapshot', 'type': 'BIGINT UNSIGNED DEFAULT NULL'},
 
             # Entity
             # {'key': ['entities', ], 'name': 'entities', 'type': 'TEXT DEFAULT ""'},
@@ -120,6 +340,8 @@ class Database:
             {'key': ['user_data', 'statuses_count', ], 'name': 'user_statuses_count', 'type': 'INT NOT NULL'},
             {'key': ['user_data', 'verified', ], 'name': 'user_verified', 'type': 'BOOL NOT NULL'},
         ]
+        # Profile columns kept in the user tables instead, with `normalize_users`
+        self.user_format = [row for row in self.twitter_format if row['key'][0] == 'user_data']
         self.reddit_format = [
             {'key': ['id', ], 'name': 'id', 'type': 'VARCHAR(32) NOT NULL'},
             {'key': ['link_id', ], 'name': 'link_id', 'type': 'TEXT DEFAULT ""'},
@@ -144,17 +366,39 @@ class Database:
         ]
 
     def _exec(self, cmd):
+        n_tries = 0
+        self.unavailable = False
         while True:
             try:
+                if self.conn is None:
+                    raise mysql.connector.Error(msg='Not connected', errno=-1)
                 cur = self.conn.cursor()
                 cur.execute(cmd)
                 return cur
             except mysql.connector.Error as e:
-                if e.errno == -1:
+                if e.errno in CONNECTION_ERRORS:
                     # No database connection
                     if self.verbose:
                         L.log(self.db_label, 'No database connection')
-                    self.reconnect()
+                    if self.spool is not None:
+                        # Fail fast instead of blocking the worker, trying
+                        # to reconnect at most every `reconnect_delay`
+                        self.spool.trip()
+                        if time.time() - self.last_reconnect < self.reconnect_delay or not self._try_reconnect():
+                            self.unavailable = True
+                            return None
+                        continue
+                    n_tries += 1
+                    if n_tries > self.reconnect_tries:
+                        L.log(self.db_label, 'Gave up reconnecting after {} tries'.format(self.reconnect_tries))
+                        self.unavailable = True
+                        return None
+                    try:
+                        self.reconnect()
+                    except Exception as e:
+                        if self.verbose:
+                            L.log(self.db_label, 'Reconnect failed', e)
+                        time.sleep(self.reconnect_delay)
                     continue
                 elif e.errno == 1146:
                     # No table
@@ -188,6 +432,7 @@ class Database:
             self.conn.commit()
             return res
         except mysql.connector.Error as e:
+            self.unavailable = e.errno in CONNECTION_ERRORS
             L.log(self.db_label, 'Error no {}. Error fetching command {}'.format(e.errno, cmd), e)
         except Exception as e:
             if self.verbose:
@@ -206,17 +451,67 @@ class Database:
             L.log(self.db_label, 'Reconnecting to database')
         # self.conn.reconnect(attempts=self.reconnect_tries, delay=self.reconnect_delay)
         time.sleep(1)
-        self.conn.close()
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except mysql.connector.Error:
+                pass
+            self.conn = None
         time.sleep(2)
+        self.last_reconnect = time.time()
         self.conn = mysql.connector.connect(**self.config)
         time.sleep(1)
 
+    def _try_reconnect(self):
+        """Reconnect once without waiting. Returns False on failure.
+        """
+        self.last_reconnect = time.time()
+        try:
+            if self.conn is not None:
+                self.conn.close()
+        except mysql.connector.Error:
+            pass
+        try:
+            self.conn = mysql.connector.connect(**self.config)
+            return True
+        except mysql.connector.Error:
+            self.conn = None
+            return False
+
+    def is_connected(self):
+        if self.shard_map is not None:
+            return all([shard.is_connected() for shard in self.shards.values()])
+        try:
+            return self.conn is not None and self.conn.is_connected()
+        except mysql.connector.Error:
+            return False
+
     def close(self):
+        for shard in self.shards.values():
+            shard.close()
+        self.shards = {}
+        if self.shard_map is not None:
+            return
         if self.verbose:
             L.log(self.db_label, 'Closing database connection')
-        self.conn.close()
+        if self.conn is not None:
+            self.conn.close()
         self.conn = None
 
+    def shard_database(self, name):
+        """Connection to the shard `name`, opened on first use, so each
+        pooled connection holds at most one connection per shard.
+        """
+        if name not in self.shards:
+            self.shards[name] = Database(id=self.id, config_file=self.config_file, verbose=self.verbose,
+                                         spool=self.spool is not None, shard=name)
+        return self.shards[name]
+
+    def shard(self, symbol, type):
+        """Connection to the shard that holds a symbol.
+        """
+        return self.shard_database(self.shard_map.locate(symbol, type))
+
     def table_name(self, symbol, type):
         if type == 'twitter':
             return 'Twitter_{}'.format(symbol)
@@ -237,30 +532,286 @@ class Database:
                 L.log(self.db_label, 'Error getting table format. Unknown type'.format(type))
             raise Exception('Error getting table format. Unknown type {}'.format(type))
 
-    def create_table(self, symbol, type):
+    @_routed
+    def create_table(self, symbol, type, definition=None):
+        """Create the table of a symbol, or with `definition`, a CREATE
+        TABLE statement read by `table_definition`, as another database has
+        it.
+        """
         table_name = self.table_name(symbol, type)
+        if table_name in self.created_tables:
+            return True
+        if definition is not None:
+            res = self._call(definition.replace('CREATE TABLE', 'CREATE TABLE IF NOT EXISTS', 1))
+            if res:
+                self.compressed.pop(table_name, None)
+                self.columns.pop(table_name, None)
+            return res
         table_format = self.table_format(type)
 
+        compressed = compress.COLUMNS[type] if self.compress_text else []
+        if type == 'twitter' and self.normalize_users:
+            profile = [row['name'] for row in self.user_format]
+            table_format = [row for row in table_format if row['name'] not in profile]
+        else:
+            table_format = [row for row in table_format if row['name'] != 'user_snapshot']
+
         cmd = 'CREATE TABLE IF NOT EXISTS\n{}(\n'.format(table_name)
         for row in table_format:
-            cmd += '\t{} {},\n'.format(row['name'], row['type'])
-        cmd += '\tPRIMARY KEY ({})\n);'.format(table_format[0]['name'])
+            column_type = row['type']
+            if row['name'] in compressed:
+                # BLOB columns cannot have a default
+                column_type = 'BLOB NOT NULL' if 'NOT NULL' in column_type else 'BLOB'
+            cmd += '\t{} {},\n'.format(row['name'], column_type)
+        cmd += '\tPRIMARY KEY ({}),\n'.format(table_format[0]['name'])
+        cmd += '\tINDEX datetime_index (datetime)\n);'
         # L.log(cmd)
+        res = self._call(cmd)
+        if res:
+            self.created_tables.add(table_name)
+            self.compressed.pop(table_name, None)
+            self.columns.pop(table_name, None)
+        return res
+
+    @_routed
+    def table_definition(self, symbol, type):
+        """CREATE TABLE statement of a symbol's table, or None.
+        """
+        res = self._fetch('SHOW CREATE TABLE {};'.format(self.table_name(symbol, type)))
+        if res is None or len(res) == 0:
+            return None
+        return res[0][1]
+
+    @_routed
+    def table_columns(self, symbol, type):
+        """Names of the columns a table has, in the order of its format.
+        Tables created with and without `normalize_users` differ. Returns
+        every column of the format if the table cannot be read.
+        """
+        table_name = self.table_name(symbol, type)
+        names = [row['name'] for row in self.table_format(type)]
+        if table_name not in self.columns:
+            cmd = 'SELECT column_name FROM information_schema.columns WHERE table_schema = DATABASE() AND table_name = "{}";'.format(table_name)
+            res = self._fetch(cmd)
+            if res is None or len(res) == 0:
+                return names
+            present = set([r[0] for r in res])
+            self.columns[table_name] = [name for name in names if name in present]
+        return self.columns[table_name]
+
+    @_routed
+    def compressed_columns(self, symbol, type):
+        """Names of the columns of a table that hold compressed text. Tables
+        created before `compress_text` was enabled have none.
+        """
+        table_name = self.table_name(symbol, type)
+        if table_name not in self.compressed:
+            cmd = 'SELECT column_name FROM information_schema.columns WHERE table_schema = DATABASE() AND table_name = "{}" AND data_type = "blob";'.format(table_name)
+            res = self._fetch(cmd)
+            if res is None:
+                return set()
+            self.compressed[table_name] = set([r[0] for r in res])
+        return self.compressed[table_name]
+
+    def codec(self, type):
+        """Codecs of a source with every dictionary trained for it.
+        """
+        if type not in self.codecs:
+            dictionaries = {}
+            if self._create_dictionary_table():
+                res = self._fetch('SELECT version, codec, data FROM Compression_Dictionaries WHERE source = "{}";'.format(type))
+                for version, codec, data in res or []:
+                    dictionaries[version] = (codec, bytes(data))
+            self.codecs[type] = compress.Codecs(type, dictionaries)
+        return self.codecs[type]
+
+    def _create_dictionary_table(self):
+        if 'Compression_Dictionaries' in self.created_tables:
+            return True
+        cmd = 'CREATE TABLE IF NOT EXISTS\nCompression_Dictionaries(\n'
+        cmd += '\tsource VARCHAR(16) NOT NULL,\n'
+        cmd += '\tversion INT NOT NULL,\n'
+        cmd += '\tcodec INT NOT NULL,\n'
+        cmd += '\tdata MEDIUMBLOB NOT NULL,\n'
+        cmd += '\tcreated DATETIME NOT NULL,\n'
+        cmd += '\tPRIMARY KEY (source, version)\n);'
+        res = self._call(cmd)
+        if res:
+            self.created_tables.add('Compression_Dictionaries')
+        return res
+
+    def add_dictionary(self, type, codec, data):
+        """Store a newly trained dictionary as the next version for a source.
+        Returns the version, or None on failure. Sharded databases store it
+        on every shard.
+        """
+        if self.shard_map is not None:
+            versions = [self.shard_database(name).add_dictionary(type, codec, data) for name in self.shard_map.names]
+            return None if None in versions else max(versions)
+        if not self._create_dictionary_table():
+            return None
+        res = self._fetch('SELECT COALESCE(MAX(version), 0) FROM Compression_Dictionaries WHERE source = "{}";'.format(type))
+        if res is None:
+            return None
+        version = res[0][0] + 1
+        cmd = 'INSERT INTO Compression_Dictionaries (source, version, codec, data, created) VALUES (%s, %s, %s, %s, %s);'
+        if not self._executemany(cmd, [[type, version, codec, data, datetime.datetime.now() + datetime.timedelta(hours=8)]]):
+            return None
+        self.codecs.pop(type, None)
+        return version
+
+    @_routed
+    def decode_row(self, symbol, type, columns, row):
+        """Decode the compressed values of a row read from `columns`.
+        """
+        compressed = self.compressed_columns(symbol, type)
+        if len(compressed) == 0:
+            return row
+        codec = self.codec(type)
+        return [codec.decode(v) if c in compressed else v for c, v in zip(columns, row)]
+
+    def _encode_rows(self, symbol, type, names, values):
+        compressed = self.compressed_columns(symbol, type)
+        if len(compressed) == 0:
+            return values
+        codec = self.codec(type)
+        indexes = [i for i, name in enumerate(names) if name in compressed]
+        encoded = []
+        for value in values:
+            value = list(value)
+            for i in indexes:
+                value[i] = codec.encode(value[i])
+            encoded.append(value)
+        return encoded
+
+    @_routed
+    def add_datetime_index(self, symbol, type):
+        """Index the datetime column of a table created before it was indexed.
+        """
+        table_name = self.table_name(symbol, type)
+        cmd = 'SHOW INDEX FROM {} WHERE Key_name = "datetime_index";'.format(table_name)
+        res = self._fetch(cmd)
+        if res is None or len(res) > 0:
+            return False
+        cmd = 'ALTER TABLE {} ADD INDEX datetime_index (datetime);'.format(table_name)
         return self._call(cmd)
 
+    def tables(self, type):
+        """List the symbols that have a table of the given type.
+        """
+        if self.shard_map is not None:
+            symbols = []
+            for name in self.shard_map.names:
+                stored = self.shard_database(name).tables(type)
+                if stored is None:
+                    return None
+                symbols.extend([s for s in stored if s not in symbols])
+            return symbols
+        prefix = self.table_name('', type)
+        cmd = 'SELECT table_name FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name LIKE "{}%";'.format(prefix.replace('_', '\\_'))
+        res = self._fetch(cmd)
+        if res is None:
+            return None
+        return [r[0][len(prefix):] for r in res if r[0] not in USER_TABLES]
+
+    def bulk_newest(self, symbols, type, recent_since, step=100):
+        """Get the newest datetime and the number of rows newer than
+        `recent_since` for many symbols with one query per `step` tables.
+        Raises `DatabaseUnavailable` if the server cannot be reached.
+        """
+        if self.shard_map is not None:
+            stats = {}
+            for name, symbols in self.shard_map.group(symbols, type).items():
+                shard_stats = self.shard_database(name).bulk_newest(symbols, type, recent_since, step=step)
+                if shard_stats is None:
+                    return None
+                stats.update(shard_stats)
+            return stats
+        existing = self.tables(type)
+        if existing is None:
+            if self.unavailable:
+                raise DatabaseUnavailable('No database connection')
+            return None
+        existing = set(existing)
+        symbols = [s for s in symbols if s in existing]
+        recent = recent_since.strftime('%Y-%m-%d %H:%M:%S')
+
+        stats = {}
+        for start in range(0, len(symbols), step):
+            selects = []
+            for symbol in symbols[start:start+step]:
+                table_name = self.table_name(symbol, type)
+                selects.append('SELECT "{0}", MAX(datetime), (SELECT COUNT(*) FROM {1} WHERE datetime > "{2}") FROM {1}'.format(symbol, table_name, recent))
+            res = self._fetch('\nUNION ALL\n'.join(selects) + ';')
+            if res is None:
+                if self.unavailable:
+                    raise DatabaseUnavailable('No database connection')
+                return None
+            for symbol, newest, n_recent in res:
+                stats[symbol] = {'newest': newest, 'recent': int(n_recent or 0)}
+        return stats
+
+    @_routed
     def drop_table(self, symbol, type):
         table_name = self.table_name(symbol, type)
         cmd = 'DROP TABLE IF EXISTS {};'.format(table_name)
+        self.created_tables.discard(table_name)
+        self.compressed.pop(table_name, None)
+        self.columns.pop(table_name, None)
         # L.log(cmd)
         return self._call(cmd)
 
+    @_routed
+    def warm_seen(self, symbol, type, since, until=None):
+        """Load the IDs stored from `since` until `until`, where a resumed
+        symbol's first window overlaps what is already in the table. At most
+        as many IDs as the set keeps are read.
+        """
+        table_name = self.table_name(symbol, type)
+        if self.seen.warmed(table_name):
+            return True
+        cmd = 'SELECT id FROM {} WHERE datetime >= "{}"'.format(table_name, since.strftime('%Y-%m-%d %H:%M:%S'))
+        if until is not None:
+            cmd += ' AND datetime < "{}"'.format(until.strftime('%Y-%m-%d %H:%M:%S'))
+        cmd += ' LIMIT {};'.format(self.seen.max_ids)
+        res = self._fetch(cmd)
+        self.seen.add(table_name, [] if res is None else [r[0] for r in res])
+        return res is not None
+
+    @_routed
+    def forget_seen(self, symbol, type):
+        self.seen.forget(self.table_name(symbol, type))
+
+    def compact(self, data, type):
+        """Copy only the fields stored for a type, so full API objects can
+        be freed while their rows wait to be written.
+        """
+        table_format = self.table_format(type)
+        rows = []
+        for datum in data:
+            row = {}
+            for column in table_format:
+                value = datum
+                for key in column['key']:
+                    if key not in value:
+                        value = None
+                        break
+                    value = value[key]
+                if value is None:
+                    continue
+                target = row
+                for key in column['key'][:-1]:
+                    target = target.setdefault(key, {})
+                target[column['key'][-1]] = value
+            rows.append(row)
+        return rows
+
+    @_routed
     def add_data(self, symbol, data, type):
         table_name = self.table_name(symbol, type)
         table_format = self.table_format(type)
+        names = [row['name'] for row in table_format]
 
-        attributes = ', '.join([row['name'] for row in table_format])
-        placeholders = ', '.join(['%s' for _ in table_format])
-        cmd = 'INSERT INTO {} ({}) VALUES ({});'.format(table_name, attributes, placeholders)
         values = []
         for datum in data:
             value_row = []
@@ -276,30 +827,86 @@ class Database:
         # L.log(cmd)
         # L.log(values)
 
+        values = self.seen.unseen(table_name, values)
         if len(values) == 0:
             return True
+        if self.spool is not None and self.spool.active:
+            # Queue behind the rows already spooled so they stay in order
+            return self.spool.append(symbol, type, names, values)
+        return self._add_values(symbol, type, names, values)
+
+    def _add_values(self, symbol, type, names, values):
+        """Insert rows given as lists of the values of `names`, every column
+        of the format.
+        """
+        table_name = self.table_name(symbol, type)
+        if self.conn is None and self.spool is not None and time.time() - self.last_reconnect >= self.reconnect_delay:
+            self._try_reconnect()
+        if type == 'twitter' and self.normalize_users:
+            if not self.add_users(names, values):
+                if self.spool is not None and self.spool.active:
+                    return self.spool.append(symbol, type, names, values)
+                return False
+
+        # Write only the columns the table has
+        columns = self.table_columns(symbol, type)
+        indexes = [names.index(c) for c in columns]
+        attributes = ', '.join(columns)
+        placeholders = ', '.join(['%s' for _ in columns])
+        cmd = 'INSERT INTO {} ({}) VALUES ({});'.format(table_name, attributes, placeholders)
+        encoded = self._encode_rows(symbol, type, columns, [[v[i] for i in indexes] for v in values])
 
         step = 100
         start = 0
         end = min(start+step, len(values))
         # duplicates = []
+        inserted = []
         while True:
-            vals = values[start:end+1]
+            vals = values[start:end]
+            encoded_vals = encoded[start:end]
             try:
                 # cur = self.conn.cursor()
                 # cur.execute(cmd, val)
                 # cur.close()
                 # self.conn.commit()
+                if self.conn is None:
+                    raise mysql.connector.Error(msg='Not connected', errno=-1)
+                started = time.time()
                 cur = self.conn.cursor()
-                cur.executemany(cmd, vals)
+                cur.executemany(cmd, encoded_vals)
                 cur.close()
                 self.conn.commit()
+                inserted.extend(vals)
+                self.seen.add(table_name, [v[0] for v in vals])
+                if self.spool is not None and end < len(values) and time.time() - started > self.spool_latency:
+                    # Too slow to keep up. Spool the rest, and what follows
+                    # until the drainer has caught up
+                    self.spool.trip()
+                    self.spool.append(symbol, type, names, values[end:])
+                    break
             except mysql.connector.Error as e:
                 if e.errno == 1062:
-                    # Duplicate entry
-                    pass
-                    # duplicates.append(data[i]['datetime'])
-                elif e.errno == 2006:
+                    # Duplicate entry not in the seen set. Insert the batch
+                    # row by row so its new rows are not dropped
+                    vals = self._add_rows(cmd, vals, encoded_vals)
+                    if vals is None:
+                        return False
+                    inserted.extend(vals)
+                    self.seen.add(table_name, [v[0] for v in vals])
+                elif e.errno in CONNECTION_ERRORS:
+                    if self.spool is not None:
+                        # Database lost. Spool the rest so workers keep
+                        # scraping while it is down
+                        self.spool.trip()
+                        self.spool.append(symbol, type, names, values[start:])
+                        # Reconnected on a later write
+                        try:
+                            if self.conn is not None:
+                                self.conn.close()
+                        except mysql.connector.Error:
+                            pass
+                        self.conn = None
+                        break
                     # Database connection lost
                     self.reconnect()
                     continue
@@ -319,6 +926,16 @@ class Database:
 
         # if len(duplicates) > 0 and self.verbose:
         #     L.log(self.db_label, '{} duplicate entries for {} {} - {}'.format(len(duplicates), table_name, duplicates[0], duplicates[-1]))
+        if len(inserted) > 0 and (self.rollups or len(LISTENERS) > 0):
+            rows = [dict(zip(names, v)) for v in inserted]
+            if self.rollups:
+                self.update_rollups(symbol, type, rows)
+            for listener in list(LISTENERS):
+                try:
+                    listener(symbol, type, rows)
+                except Exception as e:
+                    if self.verbose:
+                        L.log(self.db_label, 'Listener failed for table {}'.format(table_name), e)
         return True
 
         # while True:
@@ -350,6 +967,424 @@ class Database:
         #             break
         # return False
 
+    def _create_user_tables(self):
+        if 'Twitter_User_Snapshots' in self.created_tables:
+            return True
+        for table_name, extra in [('Twitter_Users', 'updated'), ('Twitter_User_Snapshots', 'first_seen')]:
+            cmd = 'CREATE TABLE IF NOT EXISTS\n{}(\n'.format(table_name)
+            cmd += '\tuser_id VARCHAR(32) NOT NULL,\n'
+            cmd += '\tsnapshot BIGINT UNSIGNED NOT NULL,\n'
+            for row in self.user_format:
+                cmd += '\t{} {},\n'.format(row['name'], row['type'])
+            cmd += '\t{} DATETIME NOT NULL,\n'.format(extra)
+            if table_name == 'Twitter_Users':
+                cmd += '\tPRIMARY KEY (user_id)\n);'
+            else:
+                cmd += '\tPRIMARY KEY (user_id, snapshot)\n);'
+            if not self._call(cmd):
+                return False
+        self.created_tables.add('Twitter_User_Snapshots')
+        return True
+
+    def add_users(self, names, values):
+        """Store the profiles of the users of tweet rows `values`, whose
+        columns are `names`, and set each row's `user_snapshot`.
+
+        A snapshot is a hash of the profile, so every process derives the
+        same one. Only snapshots not already written recently by this process
+        are written: new ones to `Twitter_User_Snapshots`, and the latest per
+        user to `Twitter_Users`.
+        """
+        if not self._create_user_tables():
+            return False
+        profile = [row['name'] for row in self.user_format]
+        profile_indexes = [names.index(name) for name in profile]
+        user_index = names.index('user_id')
+        snapshot_index = names.index('user_snapshot')
+        datetime_index = names.index('datetime')
+
+        changed = {}
+        last_seen = {}
+        for value in values:
+            state = [value[i] for i in profile_indexes]
+            digest = hashlib.blake2b(json.dumps(state, default=str).encode(), digest_size=8).digest()
+            snapshot = int.from_bytes(digest, 'big')
+            value[snapshot_index] = snapshot
+            user_id = value[user_index]
+            if not self.users.changed(user_id, snapshot):
+                continue
+            key = (user_id, snapshot)
+            dt = value[datetime_index]
+            if key not in changed or dt < changed[key][-1]:
+                changed[key] = [user_id, snapshot, *state, dt]
+            last_seen[key] = max(dt, last_seen.get(key, dt))
+        if len(changed) == 0:
+            return True
+
+        latest = {}
+        for key, row in changed.items():
+            row = [*row[:-1], last_seen[key]]
+            if row[0] not in latest or row[-1] > latest[row[0]][-1]:
+                latest[row[0]] = row
+        if not self.import_users(list(changed.values()), list(latest.values())):
+            return False
+
+        for user_id, snapshot in changed:
+            self.users.add(user_id, snapshot)
+        return True
+
+    def import_users(self, snapshots, users):
+        """Store `Twitter_User_Snapshots` rows `snapshots` and `Twitter_Users`
+        rows `users`, both as `(user_id, snapshot, *profile, datetime)`.
+        """
+        if len(snapshots) == 0 and len(users) == 0:
+            return True
+        if not self._create_user_tables():
+            return False
+        profile = [row['name'] for row in self.user_format]
+        columns = ', '.join(['user_id', 'snapshot', *profile])
+        placeholders = ', '.join(['%s' for _ in range(len(profile) + 3)])
+        cmd = 'INSERT INTO Twitter_User_Snapshots ({}, first_seen) VALUES ({}) '.format(columns, placeholders)
+        cmd += 'ON DUPLICATE KEY UPDATE first_seen = LEAST(first_seen, VALUES(first_seen));'
+        if len(snapshots) > 0 and not self._executemany(cmd, snapshots):
+            return False
+
+        # Only a newer tweet moves a user to another snapshot, so backfills
+        # do not overwrite the current profile. updated is assigned last
+        newer = 'VALUES(updated) >= updated'
+        updates = ['{0} = IF({1}, VALUES({0}), {0})'.format(name, newer) for name in ['snapshot', *profile]]
+        cmd = 'INSERT INTO Twitter_Users ({}, updated) VALUES ({}) '.format(columns, placeholders)
+        cmd += 'ON DUPLICATE KEY UPDATE {}, updated = GREATEST(updated, VALUES(updated));'.format(', '.join(updates))
+        return len(users) == 0 or self._executemany(cmd, users)
+
+    def export_users(self, keys, step=500):
+        """Rows of the snapshots `(user_id, snapshot)` in `keys` and of the
+        latest profiles of their users, for `import_users`.
+        """
+        profile = [row['name'] for row in self.user_format]
+        keys = sorted(keys)
+        snapshots = []
+        users = []
+        for start in range(0, len(keys), step):
+            batch = keys[start:start + step]
+            pairs = ', '.join(['("{}", {})'.format(user_id, int(snapshot)) for user_id, snapshot in batch])
+            cmd = 'SELECT user_id, snapshot, {}, first_seen FROM Twitter_User_Snapshots WHERE (user_id, snapshot) IN ({});'.format(', '.join(profile), pairs)
+            res = self._fetch(cmd)
+            if res is None:
+                return None, None
+            snapshots.extend(res)
+            ids = ', '.join(['"{}"'.format(user_id) for user_id in sorted(set([k[0] for k in batch]))])
+            cmd = 'SELECT user_id, snapshot, {}, updated FROM Twitter_Users WHERE user_id IN ({});'.format(', '.join(profile), ids)
+            res = self._fetch(cmd)
+            if res is None:
+                return None, None
+            users.extend(res)
+        return snapshots, users
+
+    def user(self, user_id, snapshot=None):
+        """Profile of a user as a dict, at `snapshot` or the latest known.
+        """
+        if self.shard_map is not None:
+            # Users are stored on the shard of each symbol they tweeted about
+            for name in self.shard_map.names:
+                profile = self.shard_database(name).user(user_id, snapshot)
+                if profile is not None:
+                    return profile
+            return None
+        profile = [row['name'] for row in self.user_format]
+        if snapshot is None:
+            cmd = 'SELECT snapshot, {} FROM Twitter_Users WHERE user_id = "{}";'.format(', '.join(profile), user_id)
+        else:
+            cmd = 'SELECT snapshot, {} FROM Twitter_User_Snapshots WHERE user_id = "{}" AND snapshot = {};'.format(', '.join(profile), user_id, int(snapshot))
+        res = self._fetch(cmd)
+        if res is None or len(res) == 0:
+            return None
+        return dict(zip(['user_snapshot', *profile], res[0]))
+
+    @_routed
+    def replay(self, symbol, type, names, values):
+        """Store spooled rows whose columns are `names`. Returns True once
+        stored, False while the database is unreachable and None if it
+        rejected them. Rows already stored are skipped, so a replay can be
+        repeated.
+        """
+        if not self.is_connected() and not self._try_reconnect():
+            return False
+        current = [row['name'] for row in self.table_format(type)]
+        values = [[dict(zip(names, v)).get(name) for name in current] for v in values]
+        values = self.seen.unseen(self.table_name(symbol, type), values)
+        if len(values) == 0:
+            return True
+        self.create_table(symbol, type)
+        if self._add_values(symbol, type, current, values):
+            return True
+        return None if self.is_connected() else False
+
+    @_routed
+    def insert_rows(self, symbol, type, columns, rows):
+        """Insert decoded rows read from another database, skipping ids
+        already stored. Unlike `add_data`, no rollups, users or listeners are
+        updated.
+        """
+        if len(rows) == 0:
+            return True
+        cmd = 'INSERT IGNORE INTO {} ({}) VALUES ({});'.format(
+            self.table_name(symbol, type), ', '.join(columns), ', '.join(['%s'] * len(columns)))
+        return self._executemany(cmd, self._encode_rows(symbol, type, columns, rows))
+
+    def _add_rows(self, cmd, values, encoded):
+        """Insert rows one at a time, skipping duplicates. Returns the rows
+        of `values` that were inserted, or None on any other error.
+        """
+        inserted = []
+        for value, encoded_value in zip(values, encoded):
+            try:
+                cur = self.conn.cursor()
+                cur.execute(cmd, encoded_value)
+                cur.close()
+                inserted.append(value)
+            except mysql.connector.Error as e:
+                if e.errno == 1062:
+                    continue
+                if self.verbose:
+                    L.log(self.db_label, 'Error no {}. Error adding row'.format(e.errno), e)
+                return None
+        self.conn.commit()
+        return inserted
+
+    def create_rollup_tables(self):
+        if 'Rollup_Authors' in self.created_tables:
+            return True
+        for table_name in ROLLUP_TABLES.values():
+            cmd = 'CREATE TABLE IF NOT EXISTS\n{}(\n'.format(table_name)
+            cmd += '\tsource VARCHAR(16) NOT NULL,\n'
+            cmd += '\tsymbol VARCHAR(32) NOT NULL,\n'
+            cmd += '\tbucket DATETIME NOT NULL,\n'
+            cmd += '\tmentions INT NOT NULL DEFAULT 0,\n'
+            cmd += '\tscore_sum BIGINT NOT NULL DEFAULT 0,\n'
+            cmd += '\tfavorite_sum BIGINT NOT NULL DEFAULT 0,\n'
+            cmd += '\tretweet_sum BIGINT NOT NULL DEFAULT 0,\n'
+            cmd += '\tunique_authors INT NOT NULL DEFAULT 0,\n'
+            cmd += '\tPRIMARY KEY (source, symbol, bucket)\n);'
+            if not self._call(cmd):
+                return False
+        cmd = 'CREATE TABLE IF NOT EXISTS\nRollup_Authors(\n'
+        cmd += '\tperiod VARCHAR(8) NOT NULL,\n'
+        cmd += '\tsource VARCHAR(16) NOT NULL,\n'
+        cmd += '\tsymbol VARCHAR(32) NOT NULL,\n'
+        cmd += '\tbucket DATETIME NOT NULL,\n'
+        cmd += '\tauthor VARCHAR(64) NOT NULL,\n'
+        cmd += '\tPRIMARY KEY (period, source, symbol, bucket, author)\n);'
+        res = self._call(cmd)
+        if res:
+            self.created_tables.add('Rollup_Authors')
+        return res
+
+    @_routed
+    def update_rollups(self, symbol, type, rows):
+        """Add newly stored rows to the hourly and daily rollups.
+        """
+        if not self.create_rollup_tables():
+            return False
+        columns = ROLLUP_COLUMNS[type]
+        for period, table_name in ROLLUP_TABLES.items():
+            buckets = {}
+            authors = set()
+            for row in rows:
+                bucket = _bucket(row['datetime'], period)
+                b = buckets.setdefault(bucket, [0, 0, 0, 0])
+                b[0] += 1
+                for i, name in enumerate(['score', 'favorite', 'retweet']):
+                    if columns[name] is not None:
+                        b[i + 1] += row[columns[name]] or 0
+                authors.add((bucket, str(row[columns['author']])[:64]))
+
+            cmd = 'INSERT INTO {} (source, symbol, bucket, mentions, score_sum, favorite_sum, retweet_sum) VALUES (%s, %s, %s, %s, %s, %s, %s) '.format(table_name)
+            cmd += 'ON DUPLICATE KEY UPDATE mentions = mentions + VALUES(mentions), score_sum = score_sum + VALUES(score_sum), '
+            cmd += 'favorite_sum = favorite_sum + VALUES(favorite_sum), retweet_sum = retweet_sum + VALUES(retweet_sum);'
+            if not self._executemany(cmd, [[type, symbol, bucket, *b] for bucket, b in buckets.items()]):
+                return False
+            cmd = 'INSERT IGNORE INTO Rollup_Authors (period, source, symbol, bucket, author) VALUES (%s, %s, %s, %s, %s);'
+            if not self._executemany(cmd, [[period, type, symbol, bucket, author] for bucket, author in authors]):
+                return False
+            if not self._count_authors(table_name, period, type, symbol, min(buckets), max(buckets)):
+                return False
+        return True
+
+    def _executemany(self, cmd, values):
+        try:
+            if self.conn is None:
+                raise mysql.connector.Error(msg='Not connected', errno=-1)
+            cur = self.conn.cursor()
+            cur.executemany(cmd, values)
+            cur.close()
+            self.conn.commit()
+            return True
+        except mysql.connector.Error as e:
+            if e.errno in CONNECTION_ERRORS and self.spool is not None:
+                self.spool.trip()
+            if self.verbose:
+                L.log(self.db_label, 'Error no {}. Error executing command {}'.format(e.errno, cmd), e)
+        except Exception as e:
+            if self.verbose:
+                L.log(self.db_label, 'Error executing command {}'.format(cmd), e)
+        return False
+
+    def _count_authors(self, table_name, period, type, symbol, first, last):
+        cmd = 'UPDATE {} r JOIN (SELECT bucket, COUNT(*) AS n FROM Rollup_Authors '.format(table_name)
+        cmd += 'WHERE period = "{}" AND source = "{}" AND symbol = "{}" AND bucket BETWEEN "{}" AND "{}" GROUP BY bucket) a '.format(
+            period, type, symbol, first.strftime('%Y-%m-%d %H:%M:%S'), last.strftime('%Y-%m-%d %H:%M:%S'))
+        cmd += 'ON r.bucket = a.bucket SET r.unique_authors = a.n WHERE r.source = "{}" AND r.symbol = "{}";'.format(type, symbol)
+        return self._call(cmd)
+
+    @_routed
+    def rebuild_rollups(self, symbol, type):
+        """Recompute the rollups of one symbol from its raw table.
+        """
+        if not self.create_rollup_tables():
+            return False
+        table_name = self.table_name(symbol, type)
+        columns = ROLLUP_COLUMNS[type]
+        sums = ', '.join(['COALESCE(SUM({}), 0)'.format(columns[name]) if columns[name] is not None else '0' for name in ['score', 'favorite', 'retweet']])
+        for period, rollup_table in ROLLUP_TABLES.items():
+            bucket = ROLLUP_BUCKETS[period]
+            where = 'source = "{}" AND symbol = "{}"'.format(type, symbol)
+            if not self._call('DELETE FROM {} WHERE {};'.format(rollup_table, where)):
+                return False
+            if not self._call('DELETE FROM Rollup_Authors WHERE period = "{}" AND {};'.format(period, where)):
+                return False
+            cmd = 'INSERT INTO {} (source, symbol, bucket, mentions, score_sum, favorite_sum, retweet_sum) '.format(rollup_table)
+            cmd += 'SELECT "{}", "{}", {} AS b, COUNT(*), {} FROM {} GROUP BY b;'.format(type, symbol, bucket, sums, table_name)
+            if not self._call(cmd):
+                return False
+            cmd = 'INSERT IGNORE INTO Rollup_Authors (period, source, symbol, bucket, author) '
+            cmd += 'SELECT DISTINCT "{}", "{}", "{}", {}, LEFT({}, 64) FROM {};'.format(period, type, symbol, bucket, columns['author'], table_name)
+            if not self._call(cmd):
+                return False
+            cmd = 'UPDATE {} r JOIN (SELECT bucket, COUNT(*) AS n FROM Rollup_Authors WHERE period = "{}" AND {} GROUP BY bucket) a '.format(rollup_table, period, where)
+            cmd += 'ON r.bucket = a.bucket SET r.unique_authors = a.n WHERE r.source = "{}" AND r.symbol = "{}";'.format(type, symbol)
+            if not self._call(cmd):
+                return False
+        return True
+
+    @_routed
+    def rollups(self, symbol, type, period='day', since=None, until=None):
+        """Rows of `(bucket, mentions, score_sum, favorite_sum, retweet_sum,
+        unique_authors)` for one symbol, in bucket order.
+        """
+        cmd = 'SELECT bucket, mentions, score_sum, favorite_sum, retweet_sum, unique_authors FROM {} '.format(ROLLUP_TABLES[period])
+        cmd += 'WHERE source = "{}" AND symbol = "{}"'.format(type, symbol)
+        if since is not None:
+            cmd += ' AND bucket >= "{}"'.format(since.strftime('%Y-%m-%d %H:%M:%S'))
+        if until is not None:
+            cmd += ' AND bucket < "{}"'.format(until.strftime('%Y-%m-%d %H:%M:%S'))
+        return self._fetch(cmd + ' ORDER BY bucket;')
+
+    @_routed
+    def add_duplicates(self, symbol, type, duplicates):
+        """Record `(id, cluster_id, datetime)` references for near-duplicate
+        posts that were not stored in full.
+        """
+        if 'Duplicates' not in self.created_tables:
+            cmd = 'CREATE TABLE IF NOT EXISTS\nDuplicates(\n'
+            cmd += '\tsource VARCHAR(16) NOT NULL,\n'
+            cmd += '\tsymbol VARCHAR(32) NOT NULL,\n'
+            cmd += '\tid VARCHAR(32) NOT NULL,\n'
+            cmd += '\tcluster_id VARCHAR(32) NOT NULL,\n'
+            cmd += '\tdatetime DATETIME NOT NULL,\n'
+            cmd += '\tPRIMARY KEY (source, symbol, id),\n'
+            cmd += '\tINDEX cluster_index (source, symbol, cluster_id)\n);'
+            if not self._call(cmd):
+                return False
+            self.created_tables.add('Duplicates')
+        cmd = 'INSERT IGNORE INTO Duplicates (source, symbol, id, cluster_id, datetime) VALUES (%s, %s, %s, %s, %s);'
+        return self._executemany(cmd, [[type, symbol, str(id), str(cluster), dt] for id, cluster, dt in duplicates])
+
+    @_routed
+    def duplicates(self, symbol, type):
+        """References `(id, cluster_id, datetime)` recorded for a symbol.
+        """
+        res = self._fetch('SELECT table_name FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = "Duplicates";')
+        if res is None or len(res) == 0:
+            return res
+        cmd = 'SELECT id, cluster_id, datetime FROM Duplicates WHERE source = "{}" AND symbol = "{}";'.format(type, symbol)
+        return self._fetch(cmd)
+
+    @_routed
+    def drop_symbol(self, symbol, type):
+        """Drop the table of a symbol with its rollups and duplicate
+        references.
+        """
+        where = 'source = "{}" AND symbol = "{}"'.format(type, symbol)
+        cmd = 'SELECT table_name FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name IN ({});'.format(
+            ', '.join(['"{}"'.format(t) for t in [*ROLLUP_TABLES.values(), 'Rollup_Authors', 'Duplicates']]))
+        res = self._fetch(cmd)
+        if res is None:
+            return False
+        for table_name in [r[0] for r in res]:
+            if not self._call('DELETE FROM {} WHERE {};'.format(table_name, where)):
+                return False
+        return self.drop_table(symbol, type)
+
+    @_routed
+    def recent_metrics(self, symbol, type, since):
+        """Rows of `(id, datetime, *metrics)` stored from `since` on, with
+        the engagement counts in `METRIC_COLUMNS` order.
+        """
+        table_name = self.table_name(symbol, type)
+        cmd = 'SELECT id, datetime, {} FROM {} WHERE datetime >= "{}";'.format(
+            ', '.join(METRIC_COLUMNS[type]), table_name, since.strftime('%Y-%m-%d %H:%M:%S'))
+        return self._fetch(cmd)
+
+    @_routed
+    def update_metrics(self, symbol, type, changes, batch_size=500):
+        """Store refreshed engagement counts. `changes` holds `(id, datetime,
+        {column: (old, new)})` with only the columns that changed, and each
+        batch is one UPDATE that sets only those columns. The rollup sums
+        are corrected by the difference.
+        """
+        table_name = self.table_name(symbol, type)
+        now = datetime.datetime.now() + datetime.timedelta(hours=8)
+        for start in range(0, len(changes), batch_size):
+            batch = changes[start:start + batch_size]
+            assignments = []
+            params = []
+            for column in METRIC_COLUMNS[type]:
+                rows = [(id, metrics[column][1]) for id, _, metrics in batch if column in metrics]
+                if len(rows) == 0:
+                    continue
+                assignments.append('{0} = CASE id {1} ELSE {0} END'.format(column, ' '.join(['WHEN %s THEN %s'] * len(rows))))
+                for id, value in rows:
+                    params.extend([id, value])
+            ids = [id for id, _, _ in batch]
+            cmd = 'UPDATE {} SET {}, update_datetime = %s WHERE id IN ({});'.format(
+                table_name, ', '.join(assignments), ', '.join(['%s'] * len(ids)))
+            if not self._executemany(cmd, [params + [now] + ids]):
+                return False
+        if self.rollups:
+            return self._update_rollup_sums(symbol, type, changes)
+        return True
+
+    def _update_rollup_sums(self, symbol, type, changes):
+        if not self.create_rollup_tables():
+            return False
+        columns = ROLLUP_COLUMNS[type]
+        for period, table_name in ROLLUP_TABLES.items():
+            buckets = {}
+            for _, dt, metrics in changes:
+                b = buckets.setdefault(_bucket(dt, period), [0, 0, 0])
+                for i, name in enumerate(['score', 'favorite', 'retweet']):
+                    if columns[name] in metrics:
+                        old, new = metrics[columns[name]]
+                        b[i] += (new or 0) - (old or 0)
+            cmd = 'UPDATE {} SET score_sum = score_sum + %s, favorite_sum = favorite_sum + %s, retweet_sum = retweet_sum + %s '.format(table_name)
+            cmd += 'WHERE source = %s AND symbol = %s AND bucket = %s;'
+            values = [[*b, type, symbol, bucket] for bucket, b in buckets.items() if any(b)]
+            if len(values) > 0 and not self._executemany(cmd, values):
+                return False
+        return True
+
+    @_routed
     def del_data(self, symbol, type, hours):
         table_name = self.table_name(symbol, type)
         tz_offset = datetime.timedelta(hours=8)
@@ -364,6 +1399,7 @@ class Database:
         if self.verbose:
             L.log(self.db_label, '{} deleted {} rows'.format(symbol, n_rows))
 
+    @_routed
     def size(self, symbol, type):
         table_name = self.table_name(symbol, type)
         cmd = 'SELECT COUNT(*) FROM {};'.format(table_name)
@@ -372,16 +1408,143 @@ class Database:
             return None
         return res
 
+    @_routed
+    def daily_counts(self, symbol, type):
+        """Number of rows per date, in date order.
+        """
+        table_name = self.table_name(symbol, type)
+        cmd = 'SELECT date, COUNT(*) FROM {} GROUP BY date ORDER BY date;'.format(table_name)
+        return self._fetch(cmd)
+
+    def row_type(self, type, columns=None):
+        """Named tuple class for rows of a type, or of `columns` of it.
+        """
+        names = [row['name'] for row in self.table_format(type)]
+        if columns is None:
+            columns = names
+        unknown = [c for c in columns if c not in names]
+        if len(unknown) > 0:
+            if self.verbose:
+                L.log(self.db_label, 'Unknown columns {} for type {}'.format(unknown, type))
+            raise Exception('Unknown columns {} for type {}'.format(unknown, type))
+        return collections.namedtuple('{}Row'.format(type.capitalize()), columns)
+
+    @_routed
+    def scan_chunks(self, symbol, type, since=None, until=None, columns=None, chunk_size=1000, typed=True):
+        """Stream the rows of a symbol from `since` up to `until` in datetime
+        order, as lists of at most `chunk_size` rows.
+
+        Rows are read through an unbuffered cursor on a connection of its own,
+        so memory stays constant however long the range is, and other queries
+        can run on this connection meanwhile. With `columns`, only those are
+        read, and otherwise every column the table has. With `typed`, rows
+        are named tuples.
+        """
+        table_name = self.table_name(symbol, type)
+        row_type = self.row_type(type, columns or self.table_columns(symbol, type))
+        compressed = self.compressed_columns(symbol, type)
+        cmd = 'SELECT {} FROM {}'.format(', '.join(row_type._fields), table_name)
+        conditions = []
+        if since is not None:
+            conditions.append('datetime >= "{}"'.format(since.strftime('%Y-%m-%d %H:%M:%S')))
+        if until is not None:
+            conditions.append('datetime < "{}"'.format(until.strftime('%Y-%m-%d %H:%M:%S')))
+        if len(conditions) > 0:
+            cmd += ' WHERE {}'.format(' AND '.join(conditions))
+        cmd += ' ORDER BY datetime;'
+
+        config = dict(self.config)
+        config['buffered'] = False
+        config['consume_results'] = False
+        conn = mysql.connector.connect(**config)
+        try:
+            cur = conn.cursor()
+            cur.execute(cmd)
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                if len(rows) == 0:
+                    break
+                if len(compressed) > 0:
+                    rows = [self.decode_row(symbol, type, row_type._fields, row) for row in rows]
+                if typed:
+                    rows = [row_type._make(row) for row in rows]
+                yield rows
+        finally:
+            # Closing the connection discards any unread rows without
+            # transferring them, as happens when the caller stops early
+            try:
+                conn.close()
+            except mysql.connector.Error:
+                pass
+
+    def scan(self, symbol, type, since=None, until=None, columns=None, chunk_size=1000, typed=True):
+        """Stream the rows of a symbol one at a time. See `scan_chunks`.
+        """
+        for rows in self.scan_chunks(symbol, type, since=since, until=until, columns=columns, chunk_size=chunk_size, typed=typed):
+            yield from rows
+
+    @_routed
     def get_first(self, symbol, type, order_by='datetime', order='DESC'):
+        """First row of a table in the given order, or None if it is empty
+        or missing. Raises `DatabaseUnavailable` if the server cannot be
+        reached.
+        """
         table_name = self.table_name(symbol, type)
-        cmd = 'SELECT * FROM {} ORDER BY {} {} LIMIT 1;'.format(table_name, order_by, order)
+        columns = self.table_columns(symbol, type)
+        cmd = 'SELECT {} FROM {} ORDER BY {} {} LIMIT 1;'.format(', '.join(columns), table_name, order_by, order)
         res = self._fetch(cmd)
+        if res is None and self.unavailable:
+            raise DatabaseUnavailable('No database connection')
         if res is None or len(res) == 0:
             return None
-        return self._to_dict(res[0], type)
+        return dict(zip(columns, self.decode_row(symbol, type, columns, res[0])))
 
     def newest(self, symbol, type):
         return self.get_first(symbol, type, order_by='datetime', order='DESC')
 
     def oldest(self, symbol, type):
         return self.get_first(symbol, type, order_by='datetime', order='ASC')
+
+
+class DatabasePool:
+    """Connections shared by the workers of every source, opened on demand
+    up to `size`. With `shards`, each one connects to a shard when first
+    routed to it, so every shard has a pool of at most `size` connections.
+    """
+
+    def __init__(self, size, config_file='config.json', verbose=True):
+        self.size = size
+        self.config_file = config_file
+        self.verbose = verbose
+        self.free = Queue()
+        self.lock = threading.Lock()
+        self.n_open = 0
+
+    def get(self):
+        try:
+            return self.free.get_nowait()
+        except Empty:
+            pass
+        with self.lock:
+            create = self.n_open < self.size
+            if create:
+                self.n_open += 1
+                id = 'P{}'.format(self.n_open - 1)
+        if create:
+            try:
+                return Database(id=id, config_file=self.config_file, verbose=self.verbose)
+            except Exception:
+                with self.lock:
+                    self.n_open -= 1
+                raise
+        return self.free.get()
+
+    def put(self, database):
+        self.free.put(database)
+
+    def close(self):
+        while True:
+            try:
+                self.free.get_nowait().close()
+            except Empty:
+                break
@@ -0,0 +1,155 @@
+# Copyright 2021 Jaewan Yun <jaeyun@ucdavis.edu>
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import collections
+import hashlib
+import re
+import threading
+
+from index import TEXT_COLUMNS
+from logger import Logger
+
+
+L = Logger()
+L.set_log_type('OKBLUE')
+
+MODES = ['drop', 'flag']
+
+URL = re.compile(r'https?://\S+|www\.\S+')
+MENTION = re.compile(r'@\w+')
+NUMBER = re.compile(r'\d+([.,]\d+)*')
+WORD = re.compile(r"[\w$#']+")
+
+
+def normalize(text):
+    """Lowercase words with links, mentions and numbers masked, so templated
+    posts differing only in those look the same.
+    """
+    text = URL.sub(' ', (text or '').lower())
+    text = MENTION.sub(' @ ', text)
+    text = NUMBER.sub('0', text)
+    return WORD.findall(text)
+
+
+def simhash(words, shingle=3):
+    """64 bit SimHash over word shingles.
+    """
+    if len(words) < shingle:
+        shingles = [' '.join(words)]
+    else:
+        shingles = [' '.join(words[i:i + shingle]) for i in range(len(words) - shingle + 1)]
+    weights = [0] * 64
+    for s in shingles:
+        h = int.from_bytes(hashlib.blake2b(s.encode(), digest_size=8).digest(), 'little')
+        for bit in range(64):
+            weights[bit] += 1 if h >> bit & 1 else -1
+    signature = 0
+    for bit in range(64):
+        if weights[bit] > 0:
+            signature |= 1 << bit
+    return signature
+
+
+class _SymbolIndex:
+    """Signatures of the most recent posts of one symbol, banded so that any
+    two within `max_distance` bits share at least one band.
+    """
+
+    def __init__(self, n_bands, max_entries):
+        self.n_bands = n_bands
+        self.band_bits = 64 // n_bands
+        self.mask = (1 << self.band_bits) - 1
+        self.max_entries = max_entries
+        self.bands = [{} for _ in range(n_bands)]
+        self.entries = collections.deque()
+
+    def _keys(self, signature):
+        return [(signature >> (i * self.band_bits)) & self.mask for i in range(self.n_bands)]
+
+    def find(self, signature, max_distance):
+        for band, key in zip(self.bands, self._keys(signature)):
+            for other, id in band.get(key, []):
+                if bin(signature ^ other).count('1') <= max_distance:
+                    return id
+        return None
+
+    def add(self, signature, id):
+        keys = self._keys(signature)
+        for band, key in zip(self.bands, keys):
+            band.setdefault(key, []).append((signature, id))
+        self.entries.append((signature, id, keys))
+        while len(self.entries) > self.max_entries:
+            old_signature, old_id, old_keys = self.entries.popleft()
+            for band, key in zip(self.bands, old_keys):
+                bucket = band[key]
+                bucket.remove((old_signature, old_id))
+                if len(bucket) == 0:
+                    del band[key]
+
+
+class NearDuplicates:
+    """Pre-insert filter for posts that repeat a recent post of the same
+    symbol with small changes, such as bot templates with different links.
+
+    In `drop` mode near-duplicates are discarded. In `flag` mode they are
+    recorded in the `Duplicates` table as a reference to the first post of
+    their cluster instead of being stored in full. Posts shorter than
+    `min_words` are always kept, since short posts match by chance.
+    """
+
+    def __init__(self, mode='drop', max_distance=3, n_bands=4, max_entries=10000, min_words=6):
+        if mode not in MODES:
+            raise Exception('Unknown near-duplicate mode {}'.format(mode))
+        if max_distance >= n_bands:
+            raise Exception('max_distance must be less than n_bands for banding to find every match')
+        self.mode = mode
+        self.max_distance = max_distance
+        self.n_bands = n_bands
+        self.max_entries = max_entries
+        self.min_words = min_words
+        self.lock = threading.Lock()
+        self.symbols = {}
+
+    def filter(self, symbol, type, rows, database):
+        """Rows of `rows` that are not near-duplicates of a recent post.
+        """
+        column = TEXT_COLUMNS[type]
+        kept = []
+        duplicates = []
+        with self.lock:
+            index = self.symbols.get((type, symbol))
+            if index is None:
+                index = self.symbols[(type, symbol)] = _SymbolIndex(self.n_bands, self.max_entries)
+            for row in rows:
+                words = normalize(row.get(column))
+                if len(words) < self.min_words:
+                    kept.append(row)
+                    continue
+                signature = simhash(words)
+                cluster = index.find(signature, self.max_distance)
+                if cluster is None or cluster == row['id']:
+                    if cluster is None:
+                        index.add(signature, row['id'])
+                    kept.append(row)
+                else:
+                    duplicates.append((row, cluster))
+
+        if len(duplicates) > 0 and self.mode == 'flag':
+            database.add_duplicates(symbol, type, [(row['id'], cluster, row['datetime']) for row, cluster in duplicates])
+        return kept
+
+    def forget(self, symbol, type):
+        with self.lock:
+            self.symbols.pop((type, symbol), None)
+
+
+def from_config(config):
+    """Near-duplicate filter for the `near_duplicates` config key, or None.
+    """
+    mode = config.get('near_duplicates')
+    if mode is None:
+        return None
+    return NearDuplicates(mode=mode)
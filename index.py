@@ -0,0 +1,389 @@
+# Copyright 2021 Jaewan Yun <jaeyun@ucdavis.edu>
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import argparse
+import calendar
+import contextlib
+import datetime
+import fcntl
+import glob
+import json
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+
+from database import Database, add_listener
+from logger import Logger
+
+
+L = Logger()
+L.set_log_type('OKGREEN')
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Column holding the text of each source
+TEXT_COLUMNS = {
+    'reddit': 'body',
+    'twitter': 'full_text',
+}
+
+TOKEN = re.compile(r"[\w$#@][\w'.-]*[\w]|[\w$#@]")
+FOOTER = struct.Struct('<Q')
+# Posting lists shorter than this are stored uncompressed
+COMPRESS_MIN = 64
+
+
+def _timestamp(dt):
+    # Wall time as stored in the datetime column, whatever its timezone
+    return calendar.timegm(dt.timetuple())
+
+
+@contextlib.contextmanager
+def _locked(directory, name='lock', exclusive=False):
+    """Hold a lock file of the index directory, shared by searches and
+    exclusive while a merge removes segments.
+    """
+    with open(os.path.join(directory, name), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def tokenize(text):
+    return TOKEN.findall((text or '').lower())
+
+
+def _put_varint(out, n):
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _get_varint(data, i):
+    n = 0
+    shift = 0
+    while True:
+        b = data[i]
+        i += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, i
+        shift += 7
+
+
+def encode_postings(postings):
+    """Encode `[(doc, [positions])]` in doc order as delta varints.
+    """
+    out = bytearray()
+    _put_varint(out, len(postings))
+    last_doc = 0
+    for doc, positions in postings:
+        _put_varint(out, doc - last_doc)
+        last_doc = doc
+        _put_varint(out, len(positions))
+        last_pos = 0
+        for pos in positions:
+            _put_varint(out, pos - last_pos)
+            last_pos = pos
+    return bytes(out)
+
+
+def decode_postings(data):
+    n, i = _get_varint(data, 0)
+    postings = []
+    doc = 0
+    for _ in range(n):
+        delta, i = _get_varint(data, i)
+        doc += delta
+        n_pos, i = _get_varint(data, i)
+        positions = []
+        pos = 0
+        for _ in range(n_pos):
+            delta, i = _get_varint(data, i)
+            pos += delta
+            positions.append(pos)
+        postings.append((doc, positions))
+    return postings
+
+
+class Segment:
+    """One immutable index file: posting lists, then a compressed dictionary
+    of terms and documents, then the dictionary's offset.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            f.seek(-FOOTER.size, os.SEEK_END)
+            end = f.tell()
+            offset, = FOOTER.unpack(f.read(FOOTER.size))
+            f.seek(offset)
+            meta = json.loads(zlib.decompress(f.read(end - offset)))
+        self.terms = meta['terms']
+        self.docs = meta['docs']
+
+    @staticmethod
+    def write(filename, postings, docs):
+        """Write `postings` ({term: [(doc, [positions])]}) and `docs`
+        ([source, symbol, id, timestamp]) atomically.
+        """
+        terms = {}
+        tmp = '{}.tmp'.format(filename)
+        with open(tmp, 'wb') as f:
+            for term in sorted(postings):
+                data = encode_postings(postings[term])
+                compressed = len(data) >= COMPRESS_MIN
+                if compressed:
+                    data = zlib.compress(data)
+                terms[term] = [f.tell(), len(data), compressed, len(postings[term])]
+                f.write(data)
+            offset = f.tell()
+            f.write(zlib.compress(json.dumps({'terms': terms, 'docs': docs}).encode()))
+            f.write(FOOTER.pack(offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, filename)
+
+    def postings(self, term):
+        entry = self.terms.get(term)
+        if entry is None:
+            return []
+        offset, length, compressed, _ = entry
+        with open(self.filename, 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+        if compressed:
+            data = zlib.decompress(data)
+        return decode_postings(data)
+
+
+class Index:
+    """Inverted index of post text kept in a directory of segment files.
+
+    Rows are buffered in memory and written as a new segment every
+    `flush_docs` documents and on `close`. Segments are never modified, so
+    several processes can index into the same directory, and `merge` folds
+    them together. A merge only removes the segments it read, so writers
+    need no lock, while searches wait for it to finish.
+    """
+
+    def __init__(self, directory, flush_docs=50000):
+        self.directory = directory
+        self.flush_docs = flush_docs
+        self.lock = threading.Lock()
+        self.label = ' [{}]:\t'.format('Index')
+        self.n_written = 0
+        self.segments = {}
+        os.makedirs(directory, exist_ok=True)
+        self._reset()
+
+    def _reset(self):
+        self.postings = {}
+        self.docs = []
+
+    def add(self, symbol, type, rows):
+        """Index stored rows. Signature of a `Database` listener.
+        """
+        column = TEXT_COLUMNS.get(type)
+        if column is None:
+            return
+        with self.lock:
+            for row in rows:
+                doc = len(self.docs)
+                self.docs.append([type, symbol, str(row['id']), _timestamp(row['datetime'])])
+                positions = {}
+                for pos, term in enumerate(tokenize(row.get(column))):
+                    positions.setdefault(term, []).append(pos)
+                for term, p in positions.items():
+                    self.postings.setdefault(term, []).append((doc, p))
+            if len(self.docs) >= self.flush_docs:
+                self._flush()
+
+    def _flush(self):
+        if len(self.docs) == 0:
+            return
+        filename = os.path.join(self.directory, '{}-{}-{}.seg'.format(int(time.time()), os.getpid(), self.n_written))
+        Segment.write(filename, self.postings, self.docs)
+        self.n_written += 1
+        L.log(self.label, 'Wrote {} documents to {}'.format(len(self.docs), filename))
+        self._reset()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def close(self):
+        self.flush()
+
+    def _segments(self):
+        """Open the segments currently on disk, reusing ones already read.
+        """
+        filenames = sorted(glob.glob(os.path.join(self.directory, '*.seg')))
+        self.segments = {f: self.segments.get(f) or Segment(f) for f in filenames}
+        return [self.segments[f] for f in filenames]
+
+    def search(self, text, phrase=False, since=None, until=None, sources=None, symbols=None, limit=None):
+        """Posts containing every term of `text`, or the exact sequence of
+        terms with `phrase`, optionally within `[since, until)` and limited to
+        some sources or symbols. Returns dicts in datetime order.
+        """
+        terms = tokenize(text)
+        if len(terms) == 0:
+            return []
+        since = None if since is None else _timestamp(since)
+        until = None if until is None else _timestamp(until)
+
+        results = []
+        with _locked(self.directory):
+            for segment in self._segments():
+                # Rarest term first so the candidate set starts small
+                order = sorted(set(terms), key=lambda t: segment.terms[t][3] if t in segment.terms else 0)
+                if order[0] not in segment.terms:
+                    continue
+                candidates = None
+                positions = {}
+                for term in order:
+                    postings = dict(segment.postings(term))
+                    positions[term] = postings
+                    candidates = set(postings) if candidates is None else candidates & set(postings)
+                    if len(candidates) == 0:
+                        break
+                for doc in candidates:
+                    source, symbol, id, timestamp = segment.docs[doc]
+                    if since is not None and timestamp < since:
+                        continue
+                    if until is not None and timestamp >= until:
+                        continue
+                    if sources is not None and source not in sources:
+                        continue
+                    if symbols is not None and symbol not in symbols:
+                        continue
+                    if phrase and not self._is_phrase(terms, positions, doc):
+                        continue
+                    results.append((timestamp, source, symbol, id))
+
+        results.sort()
+        if limit is not None:
+            results = results[:limit]
+        return [{
+            'source': source,
+            'symbol': symbol,
+            'id': id,
+            'datetime': datetime.datetime.utcfromtimestamp(timestamp),
+        } for timestamp, source, symbol, id in results]
+
+    def _is_phrase(self, terms, positions, doc):
+        starts = set(positions[terms[0]][doc])
+        for i, term in enumerate(terms[1:], 1):
+            starts &= {p - i for p in positions[term][doc]}
+            if len(starts) == 0:
+                return False
+        return True
+
+    def merge(self, max_docs=1000000):
+        """Fold the segments on disk together, a run of consecutive segments
+        at a time, so memory stays bounded and no merged segment holds more
+        than `max_docs` documents. Searches and other merges wait until the
+        merged segments are removed.
+        """
+        with self.lock, _locked(self.directory, exclusive=True):
+            batches = [[]]
+            n_docs = 0
+            for segment in self._segments():
+                if len(batches[-1]) > 0 and n_docs + len(segment.docs) > max_docs:
+                    batches.append([])
+                    n_docs = 0
+                batches[-1].append(segment)
+                n_docs += len(segment.docs)
+
+            n_merged = 0
+            filenames = []
+            for batch in batches:
+                if len(batch) < 2:
+                    continue
+                postings = {}
+                docs = []
+                for segment in batch:
+                    base = len(docs)
+                    docs.extend(segment.docs)
+                    for term in segment.terms:
+                        postings.setdefault(term, []).extend([(base + doc, p) for doc, p in segment.postings(term)])
+                filename = os.path.join(self.directory, '{}-{}-{}-merged.seg'.format(int(time.time()), os.getpid(), self.n_written))
+                Segment.write(filename, postings, docs)
+                self.n_written += 1
+                for segment in batch:
+                    os.remove(segment.filename)
+                n_merged += len(batch)
+                filenames.append(filename)
+            self.segments = {}
+        if n_merged > 0:
+            L.log(self.label, 'Merged {} segments into {}'.format(n_merged, ', '.join(filenames)))
+
+
+def attach(config_file='config.json'):
+    """Index every row written by this process if `index_dir` is configured.
+    Returns the index to close when done, or None.
+    """
+    with open(config_file) as f:
+        config = json.load(f)
+    directory = config.get('index_dir')
+    if directory is None:
+        return None
+    index = Index(directory)
+    add_listener(index.add)
+    return index
+
+
+def build(directory, sources, symbols=None):
+    """Index every stored row, for data written before indexing was enabled.
+    Only one build runs on a directory at a time.
+    """
+    index = Index(directory)
+    with _locked(directory, name='build.lock', exclusive=True):
+        database = Database(id='I')
+        for source in sources:
+            stored = database.tables(source) or []
+            if symbols is not None:
+                stored = [s for s in stored if s in symbols]
+            for symbol in sorted(stored):
+                for rows in database.scan_chunks(symbol, source, columns=['id', 'datetime', TEXT_COLUMNS[source]]):
+                    index.add(symbol, source, [row._asdict() for row in rows])
+                L.log(index.label, '{} {} indexed'.format(source, symbol))
+        database.close()
+        index.close()
+        index.merge()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('query', nargs='?', help='terms to search for')
+    parser.add_argument('--index', default='index', help='index directory')
+    parser.add_argument('--phrase', action='store_true', help='match the terms as an exact phrase')
+    parser.add_argument('--since', help='earliest datetime, as YYYY-MM-DD HH:MM:SS')
+    parser.add_argument('--until', help='latest datetime, as YYYY-MM-DD HH:MM:SS')
+    parser.add_argument('--limit', type=int, default=100, help='number of results to print')
+    parser.add_argument('--build', nargs='+', metavar='SOURCE', help='index every stored row of these sources')
+    parser.add_argument('--merge', action='store_true', help='fold the segments together')
+    args = parser.parse_args()
+
+    if args.build:
+        build(args.index, args.build)
+    elif args.merge:
+        Index(args.index).merge()
+    elif args.query:
+        since = None if args.since is None else datetime.datetime.strptime(args.since, DATE_FORMAT)
+        until = None if args.until is None else datetime.datetime.strptime(args.until, DATE_FORMAT)
+        start_time = time.time()
+        results = Index(args.index).search(args.query, phrase=args.phrase, since=since, until=until, limit=args.limit)
+        for r in results:
+            print('{}\t{}\t{}\t{}'.format(r['datetime'].strftime(DATE_FORMAT), r['source'], r['symbol'], r['id']))
+        L.log(' [Index]:\t', '{} results in {:.2f}s'.format(len(results), time.time() - start_time))
@@ -0,0 +1,165 @@
+# Copyright 2021 Jaewan Yun <jaeyun@ucdavis.edu>
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import datetime
+import json
+import os
+import threading
+
+from logger import Logger
+
+
+L = Logger()
+L.set_log_type('OKGREEN')
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class Journal:
+    """Append-only record of completed windows and of page progress inside
+    deep windows, written only after the rows they cover are stored.
+
+    Records are flushed on every write and fsynced in batches of
+    `fsync_records` or every `fsync_interval` seconds. On open, the file is
+    replayed to the last record of each `(source, symbol)` and compacted.
+
+    A child process journals to its own file and reads the parent's journal
+    as `base`, so resume sees both while only its own records are written.
+    """
+
+    def __init__(self, filename, base=None, page_interval=10, fsync_records=100, fsync_interval=1.0):
+        self.filename = filename
+        self.page_interval = page_interval
+        self.fsync_records = fsync_records
+        self.fsync_interval = fsync_interval
+        self.lock = threading.Lock()
+        self.state = {}
+        self.base = {}
+        self.n_unsynced = 0
+        self.label = ' [{}]:\t'.format('Journal')
+
+        if base is not None:
+            self.base = self._read(base)
+        self.state = self._read(self.filename)
+        L.log(self.label, 'Loaded {} entries from {}'.format(len(self.state), self.filename))
+        self.compact()
+        self.f = open(self.filename, 'a')
+        self._stopped = threading.Event()
+        self._syncer = threading.Thread(target=self._sync_loop, name='journal-sync', daemon=True)
+        self._syncer.start()
+
+    def _read(self, filename):
+        state = {}
+        if not os.path.exists(filename):
+            return state
+        with open(filename) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Torn write at the end of the file from a crash
+                    break
+                state[(record['source'], record['symbol'])] = record
+        return state
+
+    def compact(self):
+        tmp = '{}.tmp'.format(self.filename)
+        with open(tmp, 'w') as f:
+            for record in self.state.values():
+                f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.filename)
+
+    def _append(self, record):
+        line = json.dumps(record) + '\n'
+        with self.lock:
+            self.state[(record['source'], record['symbol'])] = record
+            self.f.write(line)
+            self.f.flush()
+            self.n_unsynced += 1
+            if self.n_unsynced >= self.fsync_records:
+                self._sync()
+
+    def _sync(self):
+        if self.n_unsynced > 0:
+            os.fsync(self.f.fileno())
+            self.n_unsynced = 0
+
+    def _sync_loop(self):
+        while not self._stopped.wait(self.fsync_interval):
+            with self.lock:
+                self._sync()
+
+    def merge(self, filename):
+        """Take over the records of a child process journal and remove it.
+        """
+        records = self._read(filename)
+        for record in records.values():
+            self._append(record)
+        with self.lock:
+            self._sync()
+        if os.path.exists(filename):
+            os.remove(filename)
+        return len(records)
+
+    def window_done(self, source, symbol, since, until):
+        """Record that every row from `since` to `until` is stored.
+        """
+        self._append({
+            'type': 'window',
+            'source': source,
+            'symbol': symbol,
+            'since': since.strftime(DATE_FORMAT),
+            'until': until.strftime(DATE_FORMAT),
+        })
+
+    def page_done(self, source, symbol, since, until, cursor):
+        """Record that the pages of the window `since` to `until` before
+        `cursor` are stored.
+        """
+        if isinstance(cursor, datetime.datetime):
+            cursor = cursor.strftime(DATE_FORMAT)
+        self._append({
+            'type': 'page',
+            'source': source,
+            'symbol': symbol,
+            'since': since.strftime(DATE_FORMAT),
+            'until': until.strftime(DATE_FORMAT),
+            'cursor': cursor,
+        })
+
+    def resume(self, source, symbol, newest=None):
+        """Where to continue a symbol: a dict with the datetime `since` the
+        next window starts from and, if a window was interrupted, its `page`
+        progress. None if the symbol is not in the journal, or if rows past
+        the journaled position are already stored, `newest` being the
+        datetime of the newest one.
+        """
+        with self.lock:
+            record = self.state.get((source, symbol)) or self.base.get((source, symbol))
+        if record is None:
+            return None
+        until = datetime.datetime.strptime(record['until'], DATE_FORMAT)
+        if newest is not None and newest > until:
+            # Stored by another run since, so the journal is behind
+            return None
+        if record['type'] == 'window':
+            return {'since': until, 'page': None}
+        return {
+            'since': datetime.datetime.strptime(record['since'], DATE_FORMAT),
+            'page': {
+                'until': until,
+                'cursor': record['cursor'],
+            },
+        }
+
+    def close(self):
+        self._stopped.set()
+        self._syncer.join()
+        with self.lock:
+            self._sync()
+            self.f.close()
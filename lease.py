@@ -0,0 +1,235 @@
+# Copyright 2021 Jaewan Yun <jaeyun@ucdavis.edu>
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import datetime
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from queue import Empty
+
+from logger import Logger
+
+
+L = Logger()
+L.set_log_type('OKGREEN')
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class LeaseQueue:
+    """Job queue shared by several nodes through a lease table.
+
+    Work units are `(source, symbol, since, until)` rows. A node claims a unit
+    by taking a lease that its heartbeat keeps extending. Units whose lease
+    expires, because the node holding them died, are handed to the next node
+    that asks for work. Units that fail are released for any node to retry,
+    until they have failed `max_attempts` times.
+    """
+
+    def __init__(self, conn, source, dialect='mysql', node=None, lease_time=600, heartbeat=60, poll_interval=5, max_attempts=5, max_tries=10):
+        self.conn = conn
+        self.source = source
+        self.dialect = dialect
+        self.node = node or '{}:{}'.format(socket.gethostname(), os.getpid())
+        self.lease_time = lease_time
+        self.heartbeat = heartbeat
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.max_tries = max_tries
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.label = ' [{}]:\t'.format('Lease')
+        if self.dialect == 'sqlite':
+            self.param = '?'
+            self.insert_ignore = 'INSERT OR IGNORE'
+        else:
+            self.param = '%s'
+            self.insert_ignore = 'INSERT IGNORE'
+
+        self.create_table()
+        self._stopped = threading.Event()
+        self._heartbeat = threading.Thread(target=self._beat, name='lease-heartbeat', daemon=True)
+        self._heartbeat.start()
+
+    @staticmethod
+    def open(spec, source, config_file='config.json', **kwargs):
+        """Open a lease queue on the MySQL database of the configuration file
+        if `spec` is True, or on a SQLite file if `spec` is a path.
+        """
+        if spec is True:
+            import mysql.connector
+            with open(config_file) as f:
+                config = json.load(f)
+            conn = mysql.connector.connect(
+                host=config['host'],
+                port=config['port'],
+                user=config['user'],
+                password=config['password'],
+                database=config['database'],
+                autocommit=True,
+            )
+            return LeaseQueue(conn, source, dialect='mysql', **kwargs)
+        conn = sqlite3.connect(spec, isolation_level=None, check_same_thread=False, timeout=30)
+        return LeaseQueue(conn, source, dialect='sqlite', **kwargs)
+
+    def _exec(self, cmd, params=()):
+        cmd = cmd.replace('?', self.param)
+        n_tries = 0
+        while True:
+            try:
+                with self.lock:
+                    cur = self.conn.cursor()
+                    cur.execute(cmd, params)
+                    if cur.description is not None:
+                        res = cur.fetchall()
+                    else:
+                        res = cur.rowcount
+                    cur.close()
+                    return res
+            except Exception as e:
+                n_tries += 1
+                if not self._retryable(e) or n_tries >= self.max_tries:
+                    raise
+                L.log(self.label, 'Lease table unavailable, retrying', e)
+                time.sleep(self.poll_interval)
+                self._reconnect()
+
+    def _retryable(self, e):
+        if self.dialect == 'sqlite':
+            return isinstance(e, sqlite3.OperationalError) and 'locked' in str(e)
+        from database import CONNECTION_ERRORS
+        return getattr(e, 'errno', None) in CONNECTION_ERRORS
+
+    def _reconnect(self):
+        if self.dialect == 'sqlite':
+            return
+        try:
+            with self.lock:
+                self.conn.reconnect()
+        except Exception as e:
+            L.log(self.label, 'Reconnect failed', e)
+
+    def create_table(self):
+        cmd = 'CREATE TABLE IF NOT EXISTS\nLeases(\n'
+        cmd += '\tsource VARCHAR(16) NOT NULL,\n'
+        cmd += '\tsymbol VARCHAR(32) NOT NULL,\n'
+        cmd += '\tsince_datetime VARCHAR(19) NOT NULL,\n'
+        cmd += '\tuntil_datetime VARCHAR(19) NOT NULL,\n'
+        cmd += '\tpriority INT NOT NULL DEFAULT 0,\n'
+        cmd += "\tstatus VARCHAR(8) NOT NULL DEFAULT 'pending',\n"
+        cmd += '\towner VARCHAR(128) DEFAULT NULL,\n'
+        cmd += '\texpiry DOUBLE NOT NULL DEFAULT 0,\n'
+        cmd += '\tupdated DOUBLE NOT NULL DEFAULT 0,\n'
+        cmd += '\tattempts INT NOT NULL DEFAULT 0,\n'
+        cmd += '\tPRIMARY KEY (source, symbol, since_datetime)\n);'
+        self._exec(cmd)
+
+    def seed(self, units):
+        """Add `(symbol, since, until)` units in priority order. `since` may be
+        None to let the worker resume from the newest stored row. Symbols with a
+        unit still queued or leased by any node are skipped, and units finished
+        before this node started are queued again.
+        """
+        now = time.time()
+        res = self._exec("SELECT DISTINCT symbol FROM Leases WHERE source = ? AND status IN ('pending', 'leased');", (self.source, ))
+        outstanding = set([r[0] for r in res])
+        n_added = 0
+        for priority, (symbol, since, until) in enumerate(units):
+            if symbol in outstanding:
+                continue
+            since = '' if since is None else since.strftime(DATE_FORMAT)
+            until = until.strftime(DATE_FORMAT)
+            key = (self.source, symbol, since)
+            n = self._exec('{} INTO Leases (source, symbol, since_datetime, until_datetime, priority, updated) VALUES (?, ?, ?, ?, ?, ?);'.format(self.insert_ignore), (*key, until, priority, now))
+            if n == 0:
+                n = self._exec("UPDATE Leases SET status = 'pending', until_datetime = ?, priority = ?, owner = NULL, updated = ? WHERE source = ? AND symbol = ? AND since_datetime = ? AND status IN ('done', 'failed') AND updated < ?;", (until, priority, now, *key, self.started))
+            n_added += max(n, 0)
+        L.log(self.label, '{} {} units queued by {}'.format(n_added, self.source, self.node))
+        return n_added
+
+    def _claim(self):
+        now = time.time()
+        candidates = self._exec("SELECT symbol, since_datetime, until_datetime FROM Leases WHERE source = ? AND (status = 'pending' OR (status = 'leased' AND expiry < ?)) ORDER BY priority LIMIT 10;", (self.source, now))
+        for symbol, since, until in candidates:
+            n = self._exec("UPDATE Leases SET status = 'leased', owner = ?, expiry = ?, updated = ?, attempts = attempts + 1 WHERE source = ? AND symbol = ? AND since_datetime = ? AND (status = 'pending' OR (status = 'leased' AND expiry < ?));", (self.node, now + self.lease_time, now, self.source, symbol, since, now))
+            if n == 1:
+                return symbol, since, until
+        return None
+
+    def _outstanding(self):
+        res = self._exec("SELECT COUNT(*) FROM Leases WHERE source = ? AND status IN ('pending', 'leased');", (self.source, ))
+        return res[0][0]
+
+    def get(self, timeout=None):
+        """Claim the next unit as a job for `download_query`. While units are
+        still leased by other nodes this waits in case their leases expire, up
+        to `timeout` seconds, and raises `Empty` once every unit is done or the
+        timeout has passed. Check `empty()` to tell the two apart.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            unit = self._claim()
+            if unit is not None:
+                break
+            if self._outstanding() == 0:
+                raise Empty
+            if deadline is not None and time.time() >= deadline:
+                raise Empty
+            wait = self.poll_interval if deadline is None else min(self.poll_interval, max(deadline - time.time(), 0))
+            time.sleep(wait)
+
+        symbol, since, until = unit
+        self.local.unit = unit
+        job = {
+            'symbol': symbol,
+            'recency': None,
+            'until': datetime.datetime.strptime(until, DATE_FORMAT),
+        }
+        if since != '':
+            job['newest_datetime'] = datetime.datetime.strptime(since, DATE_FORMAT)
+            job['prechecked'] = True
+        return job
+
+    def task_done(self):
+        """Mark the unit claimed by the calling thread as done, unless the lease
+        was lost to another node in the meantime.
+        """
+        symbol, since, _ = self.local.unit
+        self._exec("UPDATE Leases SET status = 'done', updated = ? WHERE source = ? AND symbol = ? AND since_datetime = ? AND owner = ?;", (time.time(), self.source, symbol, since, self.node))
+        self.local.unit = None
+
+    def release(self, count=True):
+        """Hand the unit claimed by the calling thread back to the queue for
+        any node to retry. With `count`, the attempt counts towards
+        `max_attempts`, after which the unit is marked failed instead.
+        """
+        symbol, since, _ = self.local.unit
+        attempts = 'attempts' if count else 'attempts - 1'
+        self._exec("UPDATE Leases SET status = CASE WHEN {0} >= ? THEN 'failed' ELSE 'pending' END, owner = NULL, expiry = 0, attempts = {0}, updated = ? WHERE source = ? AND symbol = ? AND since_datetime = ? AND owner = ?;".format(attempts), (self.max_attempts, time.time(), self.source, symbol, since, self.node))
+        self.local.unit = None
+
+    def empty(self):
+        return self._outstanding() == 0
+
+    def join(self):
+        while not self.empty():
+            time.sleep(self.poll_interval)
+
+    def _beat(self):
+        while not self._stopped.wait(self.heartbeat):
+            try:
+                self._exec("UPDATE Leases SET expiry = ? WHERE owner = ? AND status = 'leased';", (time.time() + self.lease_time, self.node))
+            except Exception as e:
+                L.log(self.label, 'Heartbeat failed', e)
+
+    def close(self):
+        self._stopped.set()
+        self._heartbeat.join()
+        self.conn.close()
@@ -1,3 +1,12 @@
+import atexit
+import datetime
+import json
+import sys
+import threading
+import time
+from queue import Queue, Full, Empty
+
+
 TYPES = {
     'HEADER': '\033[95m',
     'OKBLUE': '\033[94m',
@@ -10,10 +19,163 @@ TYPES = {
 }
 TYPE_END = '\033[0m'
 
+LEVELS = {
+    'DEBUG': 10,
+    'INFO': 20,
+    'WARNING': 30,
+    'ERROR': 40,
+}
+LEVEL_NAMES = {v: k for k, v in LEVELS.items()}
+
+# Process-wide output settings shared by every Logger
+settings = {
+    'level': LEVELS['INFO'],
+    'json': False,
+    'stream': None,
+    'queue_size': 100000,
+}
+
+
+def _level(level):
+    if isinstance(level, int):
+        return level
+    if level in LEVELS:
+        return LEVELS[level]
+    raise Exception('Unknown logging level {}'.format(level))
+
+
+def configure(level=None, json_output=None, stream=None, config_file=None):
+    """Set the process-wide threshold and output format, optionally from the
+    `log_level` and `log_json` keys of a configuration file.
+    """
+    if config_file is not None:
+        try:
+            with open(config_file) as f:
+                config = json.load(f)
+        except Exception:
+            config = {}
+        if level is None:
+            level = config.get('log_level')
+        if json_output is None:
+            json_output = config.get('log_json')
+    if level is not None:
+        settings['level'] = _level(level)
+    if json_output is not None:
+        settings['json'] = bool(json_output)
+    if stream is not None:
+        settings['stream'] = stream
+
+
+class _Writer(threading.Thread):
+    """Background thread that owns stdout so workers never block on it.
+    """
 
-class Logger:
     def __init__(self):
+        super().__init__(name='log-writer', daemon=True)
+        self.records = Queue(maxsize=settings['queue_size'])
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def put(self, record):
+        try:
+            self.records.put_nowait(record)
+        except Full:
+            with self.lock:
+                self.dropped += 1
+
+    def run(self):
+        while True:
+            n = 0
+            try:
+                batch = [self.records.get()]
+                n = 1
+                while len(batch) < 1000:
+                    try:
+                        batch.append(self.records.get_nowait())
+                        n += 1
+                    except Empty:
+                        break
+                self.write(batch)
+            except Exception:
+                pass
+            # Only records taken off the queue are marked done
+            for _ in range(n):
+                self.records.task_done()
+
+    def write(self, batch):
+        with self.lock:
+            dropped = self.dropped
+            self.dropped = 0
+        if dropped > 0:
+            batch = batch + [_record(LEVELS['WARNING'], 'WARNING', 'Dropped {} log records'.format(dropped), 0)]
+
+        if settings['json']:
+            lines = [json.dumps(r, default=str) for r in batch]
+        else:
+            lines = [_format_text(r) for r in batch]
+        stream = settings['stream'] or sys.stdout
+        stream.write('\n'.join(lines) + '\n')
+        stream.flush()
+
+
+def _record(level, type, msg, suppressed):
+    record = {
+        'time': datetime.datetime.now().isoformat(timespec='milliseconds'),
+        'level': LEVEL_NAMES.get(level, level),
+        'thread': threading.current_thread().name,
+        'type': type,
+        'msg': msg,
+    }
+    if suppressed > 0:
+        record['suppressed'] = suppressed
+    return record
+
+
+def _format_text(record):
+    msg = record['msg']
+    if 'suppressed' in record:
+        msg = '{} (+{} suppressed)'.format(msg, record['suppressed'])
+    if record['type'] is None or record['type'] not in TYPES:
+        return msg
+    return '{}{}{}'.format(TYPES[record['type']], msg, TYPE_END)
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def _get_writer():
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                writer = _Writer()
+                writer.start()
+                _writer = writer
+    return _writer
+
+
+def flush():
+    """Block until every queued record has been written.
+    """
+    if _writer is not None:
+        _writer.records.join()
+
+
+atexit.register(flush)
+
+
+class Logger:
+    def __init__(self, level='INFO', rate_limit=None):
         self.type = None
+        self.level = _level(level)
+
+        # Token bucket allowing `rate_limit` messages per second
+        self.rate_limit = rate_limit
+        self._tokens = rate_limit
+        self._last = time.monotonic()
+        self._suppressed = 0
+        self._lock = threading.Lock()
 
     def set_log_type(self, type):
         if type in TYPES:
@@ -21,10 +183,44 @@ class Logger:
         else:
             raise Exception('Unknown logging type {}'.format(type))
 
+    def set_level(self, level):
+        self.level = _level(level)
+
+    def _allow(self):
+        if self.rate_limit is None:
+            return True, 0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(max(self.rate_limit, 1), self._tokens + (now - self._last) * self.rate_limit)
+            self._last = now
+            if self._tokens < 1:
+                self._suppressed += 1
+                return False, 0
+            self._tokens -= 1
+            suppressed = self._suppressed
+            self._suppressed = 0
+            return True, suppressed
+
+    def _emit(self, level, args):
+        if level < settings['level']:
+            return
+        allow, suppressed = self._allow()
+        if not allow:
+            return
+        msg = ' '.join([str(o) for o in args])
+        _get_writer().put(_record(level, self.type, msg, suppressed))
+
     def log(self, *args):
-        if self.type is None or self.type not in TYPES:
-            print(*args)
-        else:
-            strs = [str(o) for o in args]
-            msg = ' '.join(strs)
-            print('{}{}{}'.format(TYPES[self.type], msg, TYPE_END))
+        self._emit(self.level, args)
+
+    def debug(self, *args):
+        self._emit(LEVELS['DEBUG'], args)
+
+    def info(self, *args):
+        self._emit(LEVELS['INFO'], args)
+
+    def warning(self, *args):
+        self._emit(LEVELS['WARNING'], args)
+
+    def error(self, *args):
+        self._emit(LEVELS['ERROR'], args)
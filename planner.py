@@ -0,0 +1,219 @@
+# Copyright 2021 Jaewan Yun <jaeyun@ucdavis.edu>
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import datetime
+import json
+import os
+import statistics
+import threading
+import time
+from queue import Queue, Empty
+
+from logger import Logger
+
+
+L = Logger()
+L.set_log_type('OKGREEN')
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+DAY_FORMAT = '%Y-%m-%d'
+# Window length when nothing is known about a symbol's volume
+DEFAULT_LEAP = datetime.timedelta(days=3)
+MIN_LEAP = datetime.timedelta(hours=1)
+MAX_LEAP = datetime.timedelta(days=30)
+
+
+def _day_start(dt):
+    return dt.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def expected_rows(volume, since, until):
+    """Posts expected from `since` to `until` given `volume`, a dict of
+    posts per day keyed by date, prorating partial days.
+    """
+    total = 0.0
+    t = since
+    while t < until:
+        end = min(_day_start(t) + datetime.timedelta(days=1), until)
+        total += volume.get(t.strftime(DAY_FORMAT), 0) * (end - t).total_seconds() / 86400
+        t = end
+    return total
+
+
+def window_end(volume, start, target_rows=2000):
+    """End of a window from `start` expected to hold about `target_rows`
+    posts, so quiet symbols are swept in a few long windows and busy periods
+    in short ones.
+    """
+    if volume is None:
+        return start + DEFAULT_LEAP
+    expected = 0.0
+    t = start
+    while t - start < MAX_LEAP:
+        day_end = _day_start(t) + datetime.timedelta(days=1)
+        per_second = volume.get(t.strftime(DAY_FORMAT), 0) / 86400
+        span = (day_end - t).total_seconds()
+        if per_second > 0 and expected + per_second * span >= target_rows:
+            t += datetime.timedelta(seconds=(target_rows - expected) / per_second)
+            break
+        expected += per_second * span
+        t = day_end
+    return start + min(max(t - start, MIN_LEAP), MAX_LEAP)
+
+
+class VolumeCache:
+    """Posts per day of each symbol, kept in a local JSON file.
+
+    An entry records the days it covers up to `through`, so refreshing it
+    only queries the days after. The last day is queried again since it was
+    incomplete when fetched.
+    """
+
+    def __init__(self, filename='volume_cache.json'):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.entries = self._load()
+        self.changed = set()
+
+    def _load(self):
+        if not os.path.exists(self.filename):
+            return {}
+        with open(self.filename) as f:
+            return json.load(f)
+
+    def get(self, source, symbol):
+        with self.lock:
+            return self.entries.get(source, {}).get(symbol)
+
+    def volume(self, source, symbol):
+        entry = self.get(source, symbol)
+        return None if entry is None else entry['days']
+
+    def put(self, source, symbol, days, through):
+        with self.lock:
+            self.changed.add(source)
+            entry = self.entries.setdefault(source, {}).setdefault(symbol, {'days': {}})
+            entry['days'].update(days)
+            entry['through'] = through.strftime(DATE_FORMAT)
+            entry['fetched'] = (datetime.datetime.now() + datetime.timedelta(hours=8)).strftime(DATE_FORMAT)
+
+    def save(self):
+        """Write the sources changed here, keeping those another process
+        saved in the meantime.
+        """
+        with self.lock:
+            entries = self._load()
+            entries.update({source: self.entries[source] for source in self.changed})
+            tmp = '{}.{}.tmp'.format(self.filename, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(entries, f)
+            os.replace(tmp, self.filename)
+
+
+class Planner:
+    """Volume estimates for the symbols of one source, used to order jobs,
+    size windows and estimate when a run will finish.
+
+    `histogram(symbol, since, until)` returns posts per day keyed by date
+    for a symbol, or None if they could not be counted.
+    """
+
+    def __init__(self, source, cache, histogram, start_date, max_age=datetime.timedelta(days=1)):
+        self.source = source
+        self.cache = cache
+        self.histogram = histogram
+        self.start_date = start_date
+        self.max_age = max_age
+        self.label = ' [{}]:\t'.format('Planner')
+        self.expected = {}
+        self.total = 0.0
+        self._stopped = threading.Event()
+
+    def _stale(self, entry, now):
+        if entry is None:
+            return True
+        return datetime.datetime.strptime(entry['fetched'], DATE_FORMAT) < now - self.max_age
+
+    def refresh(self, symbols, n_threads=1):
+        """Count the posts of every symbol whose cache entry is missing or
+        older than `max_age`, from where the entry ends, with `n_threads`
+        concurrent histogram queries.
+        """
+        now = datetime.datetime.now() + datetime.timedelta(hours=8)
+        jobs = Queue()
+        for symbol in symbols:
+            entry = self.cache.get(self.source, symbol)
+            if self._stale(entry, now):
+                since = self.start_date if entry is None else _day_start(datetime.datetime.strptime(entry['through'], DATE_FORMAT))
+                jobs.put((symbol, since))
+        n_jobs = jobs.qsize()
+        if n_jobs == 0:
+            return
+        L.log(self.label, 'Counting {} posts of {} symbols'.format(self.source, n_jobs))
+
+        def work():
+            while True:
+                try:
+                    symbol, since = jobs.get_nowait()
+                except Empty:
+                    return
+                days = self.histogram(symbol, since, now)
+                if days is not None:
+                    self.cache.put(self.source, symbol, days, now)
+
+        workers = [threading.Thread(target=work, daemon=True) for _ in range(max(1, n_threads))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.cache.save()
+
+    def volume(self, symbol):
+        return self.cache.volume(self.source, symbol)
+
+    def order(self, plan):
+        """Sort `(symbol, newest)` jobs by the posts each is expected to
+        fetch, largest first so the longest jobs do not start last. Symbols
+        without an estimate are assumed to be as busy as the median one.
+        """
+        now = datetime.datetime.now() + datetime.timedelta(hours=8)
+        estimates = {}
+        for symbol, newest in plan:
+            volume = self.volume(symbol)
+            if volume is not None:
+                estimates[symbol] = expected_rows(volume, newest or self.start_date, now)
+        default = statistics.median(estimates.values()) if len(estimates) > 0 else 0.0
+        self.expected = {symbol: estimates.get(symbol, default) for symbol, _ in plan}
+        self.total = sum(self.expected.values())
+        L.log(self.label, '{} {} symbols expected to fetch {:.0f} posts, {} without an estimate'.format(
+            len(plan), self.source, self.total, len(plan) - len(estimates)))
+        return sorted(plan, key=lambda p: -self.expected[p[0]])
+
+    def eta(self, rows, elapsed):
+        """Seconds left at the rate of `rows` fetched in `elapsed` seconds.
+        """
+        if rows <= 0 or elapsed <= 0:
+            return None
+        return max(self.total - rows, 0) / (rows / elapsed)
+
+    def _report(self, throughput, interval):
+        started = time.time()
+        while not self._stopped.wait(interval):
+            rows = throughput.snapshot()['rows']
+            eta = self.eta(rows, time.time() - started)
+            if eta is None:
+                continue
+            L.log(self.label, '{} {:.0f} of ~{:.0f} posts, {:.1f}% done, ETA {}'.format(
+                self.source, rows, self.total, 100 * min(rows / max(self.total, 1), 1),
+                datetime.timedelta(seconds=int(eta))))
+
+    def start(self, throughput, interval=300):
+        """Log progress against the expected total every `interval` seconds.
+        """
+        threading.Thread(target=self._report, args=[throughput, interval], name='planner-eta', daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
@@ -0,0 +1,118 @@
+# Copyright 2021 Jaewan Yun <jaeyun@ucdavis.edu>
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import multiprocessing
+import os
+import threading
+import time
+from queue import Empty
+
+
+# Child processes are spawned rather than forked so they do not inherit the
+# parent's logging thread and locks in an unknown state
+context = multiprocessing.get_context('spawn')
+
+
+class Throughput:
+    """Rows and windows written by the workers of one process, with the
+    responses and write times they saw.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rows = 0
+        self.windows = 0
+        self.responses = 0
+        self.throttled = 0
+        self.errors = 0
+        self.writes = 0
+        self.write_time = 0.0
+        self.start_time = time.time()
+        self.start_cpu = time.process_time()
+
+    def add(self, rows, windows=1, write_time=0.0):
+        with self.lock:
+            self.rows += rows
+            self.windows += windows
+            self.writes += 1
+            self.write_time += write_time
+
+    def response(self, status_code):
+        with self.lock:
+            self.responses += 1
+            if status_code == 429:
+                self.throttled += 1
+            elif status_code != 200:
+                self.errors += 1
+
+    def snapshot(self, process_id=0):
+        with self.lock:
+            return {
+                'process': process_id,
+                'pid': os.getpid(),
+                'rows': self.rows,
+                'windows': self.windows,
+                'responses': self.responses,
+                'throttled': self.throttled,
+                'errors': self.errors,
+                'writes': self.writes,
+                'write_time': self.write_time,
+                'wall': time.time() - self.start_time,
+                'cpu': time.process_time() - self.start_cpu,
+            }
+
+
+def split(total, n_processes):
+    """Share of `total` threads for each of `n_processes`, the remainder
+    going to the first processes.
+    """
+    share, remainder = divmod(total, n_processes)
+    return [share + (1 if i < remainder else 0) for i in range(n_processes)]
+
+
+def start(target, n_processes, args):
+    """Start `n_processes` processes calling `target(process_id, *args)`.
+    """
+    processes = []
+    for process_id in range(n_processes):
+        p = context.Process(target=target, args=[process_id, *args])
+        p.start()
+        processes.append(p)
+    return processes
+
+
+def collect(processes, results):
+    """Wait for every process and gather the snapshot each one reports.
+    """
+    stats = []
+    while len(stats) < len(processes):
+        try:
+            stats.append(results.get(timeout=1))
+        except Empty:
+            if all(not p.is_alive() for p in processes) and results.empty():
+                break
+    for p in processes:
+        p.join()
+    return stats
+
+
+def report(stats, wall):
+    """Summarize throughput per process and in total, with CPU utilization so
+    it is visible whether processes are still bound by one core each.
+    """
+    lines = ['Throughput: {} processes over {:.1f}s'.format(len(stats), wall)]
+    total_rows = 0
+    total_cpu = 0.0
+    for s in sorted(stats, key=lambda s: s['process']):
+        total_rows += s['rows']
+        total_cpu += s['cpu']
+        lines.append('  P{:<3} pid {:<7} {:>10} rows {:>7} windows {:>9.1f} rows/s {:>6.1f}% cpu'.format(
+            s['process'], s['pid'], s['rows'], s['windows'],
+            s['rows'] / max(s['wall'], 1e-9), 100 * s['cpu'] / max(s['wall'], 1e-9)))
+    n = max(len(stats), 1)
+    lines.append('  Total {:>10} rows {:>9.1f} rows/s {:>9.1f} rows/s per process {:>6.2f} cores busy'.format(
+        total_rows, total_rows / max(wall, 1e-9), total_rows / max(wall, 1e-9) / n, total_cpu / max(wall, 1e-9)))
+    return '\n'.join(lines)
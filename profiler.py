@@ -0,0 +1,203 @@
+# Copyright 2021 Jaewan Yun <jaeyun@ucdavis.edu>
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+
+
+# Category each pipeline stage is reported under
+STAGES = {
+    'request': 'network',
+    'token_refresh': 'network',
+    'renew_connection': 'tor',
+    'parse_response': 'parse',
+    'add_data': 'database',
+}
+CATEGORIES = ['network', 'tor', 'parse', 'database']
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+class NullProfiler:
+    """Stand-in used when profiling is off so spans cost one method call.
+    """
+    enabled = False
+
+    def span(self, stage):
+        return NULL_SPAN
+
+    def set_context(self, worker=None, symbol=None):
+        pass
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def report(self):
+        return ''
+
+
+NULL = NullProfiler()
+
+
+class _Span:
+    __slots__ = ('profiler', 'stage', 'start', 'child')
+
+    def __init__(self, profiler, stage):
+        self.profiler = profiler
+        self.stage = stage
+        self.child = 0.0
+
+    def __enter__(self):
+        self.profiler._stack().append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        stack = self.profiler._stack()
+        stack.pop()
+        if len(stack) > 0:
+            stack[-1].child += elapsed
+        # Nested spans are charged to the innermost stage only
+        self.profiler.add(self.stage, elapsed - self.child)
+        return False
+
+
+class Profiler:
+    enabled = True
+
+    def __init__(self, sample_interval=None):
+        self.sample_interval = sample_interval
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.stages = defaultdict(lambda: [0.0, 0])
+        self.symbols = defaultdict(lambda: defaultdict(float))
+        self.workers = defaultdict(lambda: defaultdict(float))
+        self.threads = {}
+        self.samples = Counter()
+        self.n_samples = 0
+        self.start_time = None
+        self.stop_time = None
+        self._sampler = None
+        self._stopped = threading.Event()
+
+    def _stack(self):
+        try:
+            return self.local.stack
+        except AttributeError:
+            self.local.stack = []
+            return self.local.stack
+
+    def set_context(self, worker=None, symbol=None):
+        """Attribute the spans of the calling thread to a worker and symbol.
+        """
+        if worker is not None:
+            self.local.worker = worker
+            with self.lock:
+                self.threads[threading.get_ident()] = worker
+        self.local.symbol = symbol
+
+    def span(self, stage):
+        return _Span(self, stage)
+
+    def add(self, stage, elapsed):
+        category = STAGES.get(stage, 'other')
+        worker = getattr(self.local, 'worker', None)
+        symbol = getattr(self.local, 'symbol', None)
+        with self.lock:
+            total = self.stages[stage]
+            total[0] += elapsed
+            total[1] += 1
+            if symbol is not None:
+                self.symbols[symbol][category] += elapsed
+            if worker is not None:
+                self.workers[worker][category] += elapsed
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        if self.sample_interval:
+            self._sampler = threading.Thread(target=self._sample, name='profiler-sampler', daemon=True)
+            self._sampler.start()
+
+    def stop(self):
+        self.stop_time = time.perf_counter()
+        self._stopped.set()
+        if self._sampler is not None:
+            self._sampler.join()
+
+    def _sample(self):
+        """Record the innermost frame of every worker thread at a fixed rate.
+        """
+        while not self._stopped.wait(self.sample_interval):
+            with self.lock:
+                idents = dict(self.threads)
+            frames = sys._current_frames()
+            with self.lock:
+                for ident in idents:
+                    frame = frames.get(ident)
+                    if frame is None:
+                        continue
+                    code = frame.f_code
+                    where = '{}:{} ({})'.format(os.path.basename(code.co_filename), frame.f_lineno, code.co_name)
+                    self.samples[where] += 1
+                    self.n_samples += 1
+
+    def report(self, top=10):
+        end = self.stop_time or time.perf_counter()
+        wall = end - (self.start_time or end)
+        with self.lock:
+            stages = {k: list(v) for k, v in self.stages.items()}
+            symbols = {k: dict(v) for k, v in self.symbols.items()}
+            workers = {k: dict(v) for k, v in self.workers.items()}
+            samples = self.samples.most_common(top)
+            n_samples = self.n_samples
+
+        worker_time = wall * max(len(workers), 1)
+        by_category = defaultdict(float)
+        for k, (elapsed, _) in stages.items():
+            by_category[STAGES.get(k, 'other')] += elapsed
+        accounted = sum(by_category.values())
+
+        lines = ['Profile: {:.1f}s wall, {} workers, {:.1f} worker-seconds'.format(wall, len(workers), worker_time)]
+        for c in CATEGORIES:
+            lines.append('  {:<10} {:>10.1f}s {:>6.1f}%'.format(c, by_category[c], 100 * by_category[c] / max(worker_time, 1e-9)))
+        idle = max(worker_time - accounted, 0)
+        lines.append('  {:<10} {:>10.1f}s {:>6.1f}%'.format('other', idle, 100 * idle / max(worker_time, 1e-9)))
+
+        lines.append('Stages:')
+        for k, (elapsed, count) in sorted(stages.items(), key=lambda kv: -kv[1][0]):
+            lines.append('  {:<18} {:>10.1f}s {:>8} calls {:>9.1f}ms avg'.format(k, elapsed, count, 1000 * elapsed / max(count, 1)))
+
+        lines.append('Workers:')
+        for w in sorted(workers, key=str):
+            parts = ' '.join(['{}={:.1f}s'.format(c, workers[w].get(c, 0)) for c in CATEGORIES])
+            lines.append('  {:<6} {}'.format(w, parts))
+
+        lines.append('Top {} symbols:'.format(top))
+        for s in sorted(symbols, key=lambda s: -sum(symbols[s].values()))[:top]:
+            parts = ' '.join(['{}={:.1f}s'.format(c, symbols[s].get(c, 0)) for c in CATEGORIES])
+            lines.append('  {:<8} {:>8.1f}s {}'.format(s, sum(symbols[s].values()), parts))
+
+        if n_samples > 0:
+            lines.append('Top {} sampled frames ({} samples):'.format(top, n_samples))
+            for where, count in samples:
+                lines.append('  {:>6.1f}% {}'.format(100 * count / n_samples, where))
+        return '\n'.join(lines)
@@ -0,0 +1,231 @@
+# Copyright 2021 Jaewan Yun <jaeyun@ucdavis.edu>
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import collections
+import heapq
+import json
+import os
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from database import add_listener, remove_listener
+from logger import Logger
+
+
+L = Logger()
+L.set_log_type('OKBLUE')
+
+# Columns kept per post, so the buffers stay small
+COLUMNS = {
+    'reddit': ['id', 'datetime', 'author', 'subreddit', 'score', 'body'],
+    'twitter': ['id', 'datetime', 'user_id', 'user_screen_name', 'favorite_count', 'retweet_count', 'full_text'],
+}
+# Minutes of arrival counts kept per symbol
+WINDOW_MINUTES = 60
+
+
+class _Symbol:
+    def __init__(self, size):
+        self.posts = collections.deque(maxlen=size)
+        self.total = 0
+        self.minutes = collections.deque()
+        # Sequence number of the last post pushed out of the buffer
+        self.evicted = 0
+
+    def append(self, seq, post):
+        if len(self.posts) == self.posts.maxlen:
+            self.evicted = self.posts[0][0]
+        self.posts.append((seq, post))
+
+    def count(self, minute, n):
+        if len(self.minutes) > 0 and self.minutes[-1][0] == minute:
+            self.minutes[-1][1] += n
+        else:
+            self.minutes.append([minute, n])
+        while self.minutes[0][0] <= minute - WINDOW_MINUTES:
+            self.minutes.popleft()
+        self.total += n
+
+
+class RecentPosts:
+    """The last `size` posts stored for each symbol by this process, with
+    counts of how many arrived, kept in memory for consumers that only need
+    the latest mentions.
+
+    Every post gets a sequence number in the order it was stored. A consumer
+    passes the last number it saw as `since` to get only newer posts, and
+    is told when posts it never read have already been evicted.
+    """
+
+    def __init__(self, size=100):
+        self.size = size
+        self.lock = threading.Lock()
+        self.symbols = {}
+        self.sequence = 0
+
+    def add(self, symbol, type, rows):
+        """Buffer stored rows. Signature of a `Database` listener.
+        """
+        columns = COLUMNS.get(type)
+        if columns is None:
+            return
+        minute = int(time.time() // 60)
+        with self.lock:
+            state = self.symbols.get((type, symbol))
+            if state is None:
+                state = self.symbols[(type, symbol)] = _Symbol(self.size)
+            for row in rows:
+                self.sequence += 1
+                state.append(self.sequence, {c: row.get(c) for c in columns})
+            state.count(minute, len(rows))
+
+    def posts(self, type=None, symbol=None, since=0, limit=100):
+        """Posts after sequence number `since`, oldest first, of one symbol or
+        of every symbol of `type`. Returns the posts, the cursor to pass
+        next and whether posts after `since` were evicted unread.
+        """
+        with self.lock:
+            states = [(key, state) for key, state in self.symbols.items()
+                      if (type is None or key[0] == type) and (symbol is None or key[1] == symbol)]
+            selected = []
+            gap = False
+            for (source, name), state in states:
+                if state.evicted > since:
+                    gap = True
+                for seq, post in reversed(state.posts):
+                    if seq <= since:
+                        break
+                    selected.append((seq, source, name, post))
+            cursor = self.sequence
+        selected = heapq.nsmallest(limit + 1, selected, key=lambda p: p[0])
+        if len(selected) > limit:
+            selected = selected[:limit]
+            cursor = selected[-1][0]
+        posts = [{'seq': seq, 'source': source, 'symbol': name, **post} for seq, source, name, post in selected]
+        return posts, cursor, gap
+
+    def counts(self, type=None, symbol=None):
+        """Posts stored per symbol since the process started and over the
+        last hour.
+        """
+        minute = int(time.time() // 60)
+        with self.lock:
+            return [{
+                'source': source,
+                'symbol': name,
+                'total': state.total,
+                'last_hour': sum([n for m, n in state.minutes if m > minute - WINDOW_MINUTES]),
+                'newest': state.posts[-1][0] if len(state.posts) > 0 else None,
+            } for (source, name), state in self.symbols.items()
+                if (type is None or source == type) and (symbol is None or name == symbol)]
+
+
+def _handler(recent):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _send(self, status, body):
+            data = json.dumps(body, default=str).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            try:
+                since = int(query.get('since', 0))
+                limit = int(query.get('limit', 100))
+            except ValueError:
+                return self._send(400, {'error': 'since and limit must be integers'})
+            if url.path == '/posts':
+                posts, cursor, gap = recent.posts(query.get('source'), query.get('symbol'), since=since, limit=limit)
+                return self._send(200, {'cursor': cursor, 'gap': gap, 'posts': posts})
+            if url.path == '/counts':
+                return self._send(200, {'counts': recent.counts(query.get('source'), query.get('symbol'))})
+            return self._send(404, {'error': 'Unknown path {}'.format(url.path)})
+    return Handler
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        request, _ = super().get_request()
+        return request, ('local', 0)
+
+
+class Server:
+    """Serves a `RecentPosts` over HTTP on a local address, either
+    `host:port` or `unix:/path/to/socket`.
+
+    `GET /posts?source=&symbol=&since=&limit=` returns `{cursor, gap, posts}`
+    and `GET /counts?source=&symbol=` returns `{counts}`. Both filters are
+    optional.
+    """
+
+    def __init__(self, recent, address):
+        self.recent = recent
+        self.address = address
+        self.label = ' [{}]:\t'.format('Recent')
+        handler = _handler(recent)
+        if address.startswith('unix:'):
+            self.path = address[len('unix:'):]
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self.server = _UnixHTTPServer(self.path, handler)
+        else:
+            self.path = None
+            host, port = address.rsplit(':', 1)
+            self.server = ThreadingHTTPServer((host, int(port)), handler)
+            self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name='recent-api', daemon=True)
+        self.thread.start()
+        add_listener(recent.add)
+        L.log(self.label, 'Serving recent posts on {}'.format(address))
+
+    def close(self):
+        remove_listener(self.recent.add)
+        self.server.shutdown()
+        self.server.server_close()
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _part_address(address, part):
+    """Address of process `part`, a later port or a suffixed socket path.
+    """
+    if part is None:
+        return address
+    if address.startswith('unix:'):
+        return '{}.{}'.format(address, part)
+    host, port = address.rsplit(':', 1)
+    return '{}:{}'.format(host, int(port) + part)
+
+
+def attach(config_file='config.json', part=None):
+    """Buffer every row written by this process and serve it on
+    `recent_api` if configured. Process `part` of a multi-process run
+    serves on the configured port plus `part`, or on the socket path
+    suffixed with it. Returns the server to close when done, or None.
+    """
+    with open(config_file) as f:
+        config = json.load(f)
+    address = config.get('recent_api')
+    if address is None:
+        return None
+    try:
+        return Server(RecentPosts(size=config.get('recent_size', 100)), _part_address(address, part))
+    except OSError as e:
+        L.log(' [Recent]:\t', 'Could not serve recent posts on {}'.format(address), e)
+        return None
@@ -4,28 +4,43 @@
 # THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 
+import argparse
 import datetime
+import glob
 import json
 import time
 import threading
-from queue import Queue
+from queue import Queue, Empty
 
-from database import Database
+from autoscale import Autoscaler
+from database import Database, DatabaseUnavailable
+from journal import Journal
+from lease import LeaseQueue
+from scheduler import Scheduler
 from symbols import Symbols
+from tail import Tail
 from tor import Tor
+import dedup
+import index
+import logger
+import planner
+import processes
+import profiler
+import recent
 from logger import Logger
 
 
 L = Logger()
 L.set_log_type('OKCYAN')
-error_log = Logger()
+error_log = Logger(level='WARNING')
 error_log.set_log_type('HEADER')
-bold_log = Logger()
+bold_log = Logger(level='DEBUG', rate_limit=1)
 bold_log.set_log_type('BOLD')
 
 
 class Reddit:
     def __init__(self, tor=None, config_file='config.json'):
+        self.type = 'reddit'
         self.tor = tor
         if self.tor is None:
             self.tor = Tor()
@@ -37,13 +52,53 @@ class Reddit:
                 config = json.load(f)
             self.start_date = config['reddit_start_date']
             self.n_threads = config['reddit_n_threads']
+            self.max_buffered_rows = config.get('max_buffered_rows', 5000)
+            self.min_threads = config.get('min_threads', 1)
+            self.max_threads = config.get('reddit_max_threads', 2 * self.n_threads)
+            # Seconds to back off after a failed request, and between pages
+            self.retry_delay = config.get('retry_delay', 10)
+            self.page_delay = config.get('page_delay', 0.2)
+            # Posts a window is sized to hold when its volume is estimated
+            self.window_rows = config.get('window_rows', 2000)
+            self.volume_cache = config.get('volume_cache', 'volume_cache.json')
         except Exception as e:
             raise Exception('Failed to read {}'.format(self.config_file))
+        self.dedup = dedup.from_config(config)
 
         self.base_url = 'https://api.pushshift.io/reddit/search/comment'
         self.tz_offset = datetime.timedelta(hours=8)
+        self.profiler = profiler.NULL
+        self.journal = None
+        self.volumes = None
+        self.throughput = processes.Throughput()
         self.max_body_len= 2000
 
+    def query(self, symbols, symbol):
+        """Build the search query and false positive filter for a symbol.
+        """
+        name = symbols.company_name(symbol)
+        info = symbols.get_info(symbol)
+        names = [
+            info['shortName'],
+            info['longName'],
+        ]
+        query_list = [*names]
+        if name.lower() != symbol.lower():
+            q = name
+            if symbols.in_dictionary(name):
+                q = '({}+(stocks|shares))'.format(q)
+            query_list.append(q)
+        if len(symbol) >= 3:
+            # q = symbol
+            # if symbols.in_dictionary(symbol):
+            #     q = '({}+(stocks|shares))'.format(symbol)
+            # query_list.append(q)
+            query_list.append('({}+(stocks|shares))'.format(symbol))
+        return {
+            'search': '|'.join(query_list),
+            'matches': [*names, name, 'stocks', 'shares'],
+        }
+
     def _request(self, config):
         since = config['since'] + self.tz_offset
         until = config['until'] + self.tz_offset
@@ -58,15 +113,66 @@ class Reddit:
         }
         while True:
             try:
-                res = config['session'].get(self.base_url, params=params)
+                with self.profiler.span('request'):
+                    res = config['session'].get(self.base_url, params=params)
                 break
             except Exception as e:
                 error_log.log(config['worker_label'], 'Connection error', e)
                 self.tor.renew_connection()
                 config['session'] = self.tor.get_session()
-                time.sleep(10)
+                time.sleep(self.retry_delay)
         return res
 
+    def histogram(self, search, since, until, max_tries=3):
+        """Comments per day matching `search` from `since` to `until`, keyed
+        by date, counted by Pushshift without returning any comments. Returns
+        None if they could not be counted.
+        """
+        params = {
+            'score': '>0',
+            'size': 0,
+            'aggs': 'created_utc',
+            'frequency': 'day',
+            'after': (since + self.tz_offset).strftime('%Y-%m-%d %H:%M:%S'),
+            'before': (until + self.tz_offset).strftime('%Y-%m-%d %H:%M:%S'),
+            'q': search,
+        }
+        for _ in range(max_tries):
+            try:
+                res = self.tor.get_session().get(self.base_url, params=params)
+                if res.status_code == 200:
+                    buckets = res.json()['aggs']['created_utc']
+                    return {
+                        datetime.datetime.fromtimestamp(b['key'], datetime.timezone.utc).strftime('%Y-%m-%d'): b['doc_count']
+                        for b in buckets
+                    }
+            except Exception as e:
+                error_log.log(' [Reddit]:\t', 'Histogram request failed', e)
+            self.tor.renew_connection()
+            time.sleep(self.retry_delay)
+        return None
+
+    def lookup(self, ids, max_tries=3):
+        """Current score of the comments with `ids`, fetched in one request
+        and keyed by id. Comments Pushshift no longer has are left out.
+        Returns None if the request failed.
+        """
+        params = {
+            'ids': ','.join(ids),
+            'size': len(ids),
+            'fields': 'id,score',
+        }
+        for _ in range(max_tries):
+            try:
+                res = self.tor.get_session().get(self.base_url, params=params)
+                if res.status_code == 200:
+                    return {t['id']: {'score': t['score']} for t in res.json()['data']}
+            except Exception as e:
+                error_log.log(' [Reddit]:\t', 'Lookup request failed', e)
+            self.tor.renew_connection()
+            time.sleep(self.retry_delay)
+        return None
+
     def parse_response(self, response, config):
         data = response.json()['data']
         if len(data) == 0:
@@ -116,103 +222,187 @@ class Reddit:
         config['since'] = datetime.datetime.fromtimestamp(int(data[-1]['created_utc']))
         return parsed
 
+    def _store(self, config, chunk, windows=1, max_tries=3):
+        """Write rows of the current window, retrying failed inserts. Raises
+        if they could not be stored, so the window is never journaled.
+        """
+        for _ in range(max_tries):
+            started = time.time()
+            with self.profiler.span('add_data'):
+                stored = config['database'].add_data(config['symbol'], chunk, type='reddit')
+            if stored:
+                self.throughput.add(len(chunk), windows=windows, write_time=time.time() - started)
+                return
+            error_log.log(config['worker_label'], '{} failed to store {} rows'.format(config['symbol'], len(chunk)))
+            time.sleep(self.retry_delay)
+        raise Exception('Failed to store {} rows of {}'.format(len(chunk), config['symbol']))
+
+    def _flush_pages(self, config, chunk):
+        """Store the pages buffered so far in a window and journal the
+        cursor they end at.
+        """
+        self._store(config, chunk, windows=0)
+        config['n_flushed'] += len(chunk)
+        _extend_range(config, chunk)
+        if config.get('journal') is not None:
+            window_since, window_until = config['window']
+            config['journal'].page_done('reddit', config['symbol'], window_since, window_until, config['since'])
+
     def get_data_chunk(self, config):
         chunk = []
+        n_pages = 0
+        journal = config.get('journal')
         while True:
-            time.sleep(0.2)
+            time.sleep(self.page_delay)
             response = self._request(config)
+            self.throughput.response(response.status_code)
 
             if response.status_code != self.tor.ok:
                 error_log.log(config['worker_label'], '{} Response not OK {}'.format(config['symbol'], response))
                 self.tor.renew_connection()
                 config['session'] = self.tor.get_session()
-                time.sleep(10)
+                time.sleep(self.retry_delay)
                 continue
 
-            data = self.parse_response(response, config)
+            with self.profiler.span('parse_response'):
+                data = self.parse_response(response, config)
+                data = config['database'].compact(data, type='reddit')
             if len(data) == 0:
                 break
+            if self.dedup is not None:
+                data = self.dedup.filter(config['symbol'], 'reddit', data, config['database'])
             chunk.extend(data)
 
-        chunk = sorted(chunk, key=lambda t: t['created_utc'], reverse=False)
+            # Rows are written as pages arrive, in the order the API returns
+            # them, so at most `max_buffered_rows` are held per worker
+            n_pages += 1
+            if len(chunk) >= self.max_buffered_rows or (journal is not None and n_pages % journal.page_interval == 0):
+                self._flush_pages(config, chunk)
+                chunk = []
         return chunk
 
     def get_data(self, config):
+        """Download and store `config['since']` to `config['until']` in
+        windows. Returns the number of rows and the datetime of the last one.
+        """
         start = config['since']
         end = config['until']
         current_date = start
 
-        leap = datetime.timedelta(days=3)
+        # Windows are sized to the expected volume when it is known
+        volume = config.get('volume')
         config['since'] = current_date
-        config['until'] = current_date + leap
+        config['until'] = planner.window_end(volume, current_date, self.window_rows)
 
         # Create table if it does not exist
         config['database'].create_table(config['symbol'], type='reddit')
+        n_rows = 0
+        last = None
+        journal = config.get('journal')
+        page = config.pop('resume_page', None)
 
         while True:
-            time.sleep(0.2)
+            time.sleep(self.page_delay)
             if config['until'] > end:
                 config['until'] = end
 
+            if page is not None:
+                # Continue an interrupted window after its last stored page
+                config['until'] = page['until']
+                config['since'] = datetime.datetime.strptime(page['cursor'], '%Y-%m-%d %H:%M:%S')
+                page = None
+            config['window'] = (current_date, config['until'])
+            config['n_flushed'] = 0
+            config['range'] = None
+
             chunk = self.get_data_chunk(config)
-            if len(chunk) == 0:
+            _extend_range(config, chunk)
+            if config['range'] is None:
                 date1 = config['since'].strftime('%Y-%m-%d %H:%M:%S')
                 date2 = config['until'].strftime('%Y-%m-%d %H:%M:%S')
             else:
-                date1 = chunk[0]['datetime'].strftime('%Y-%m-%d %H:%M:%S')
-                date2 = chunk[-1]['datetime'].strftime('%Y-%m-%d %H:%M:%S')
-            L.log(config['worker_label'], '{:<8} {} - {} \t ({})'.format(config['symbol'], date1, date2, len(chunk)))
+                date1 = config['range'][0].strftime('%Y-%m-%d %H:%M:%S')
+                date2 = config['range'][1].strftime('%Y-%m-%d %H:%M:%S')
+            n_chunk = len(chunk) + config['n_flushed']
+            L.log(config['worker_label'], '{:<8} {} - {} \t ({})'.format(config['symbol'], date1, date2, n_chunk))
             # L.log(json.dumps(chunk, indent=4, sort_keys=True))
             # return
 
             # Add to database
-            config['database'].add_data(config['symbol'], chunk, type='reddit')
+            self._store(config, chunk)
+            n_rows += n_chunk
+            if journal is not None:
+                journal.window_done('reddit', config['symbol'], *config['window'])
+            if config['range'] is not None:
+                last = config['range'][1]
 
             # Increment time
-            current_date += leap
+            current_date = config['window'][1]
             config['since'] = current_date
-            config['until'] = current_date + leap
+            config['until'] = planner.window_end(volume, current_date, self.window_rows)
             if config['since'] >= end:
                 break
+        return n_rows, last
 
 
-def _download_query(reddit, symbols, symbol, recency, session, worker_id):
+def _extend_range(config, chunk):
+    """Widen the datetime range of the rows stored in the current window.
+    """
+    if len(chunk) == 0:
+        return
+    first = min(t['datetime'] for t in chunk)
+    last = max(t['datetime'] for t in chunk)
+    if config['range'] is not None:
+        first = min(first, config['range'][0])
+        last = max(last, config['range'][1])
+    config['range'] = (first, last)
+
+
+def download_query(reddit, symbols, symbol, recency, session, worker_id, newest_datetime=None, prechecked=False, until=None, database=None):
     worker_label = ' (R{}):\t'.format(worker_id)
+    reddit.profiler.set_context(worker=worker_id, symbol=symbol)
 
     # Build query
-    name = symbols.company_name(symbol)
-    info = symbols.get_info(symbol)
-    names = [
-        info['shortName'],
-        info['longName'],
-    ]
-    query_list = [*names]
-    if name.lower() != symbol.lower():
-        q = name
-        if symbols.in_dictionary(name):
-            q = '({}+(stocks|shares))'.format(q)
-        query_list.append(q)
-    if len(symbol) >= 3:
-        # q = symbol
-        # if symbols.in_dictionary(symbol):
-        #     q = '({}+(stocks|shares))'.format(symbol)
-        # query_list.append(q)
-        query_list.append('({}+(stocks|shares))'.format(symbol))
-    query = '|'.join(query_list)
+    query = reddit.query(symbols, symbol)
     query_log = Logger()
     query_log.set_log_type('OKBLUE')
-    query_log.log(worker_label, 'Query {}'.format(query))
-    if len(query_list) == 0:
-        query_log.log(worker_label, 'Empty query {}'.format(query))
-        return
+    query_log.log(worker_label, 'Query {}'.format(query['search']))
 
     # Resume from last datetime
-    database = Database(id=worker_id)
+    own_database = database is None
+    if own_database:
+        database = Database(id=worker_id)
     since = datetime.datetime.strptime(reddit.start_date, '%Y-%m-%d %H:%M:%S')
-    newest = database.newest(symbol, type='reddit')
+    unavailable = False
+    if prechecked:
+        # Already ordered and filtered by the scheduler
+        newest = None if newest_datetime is None else {'datetime': newest_datetime}
+        recency = None
+    else:
+        try:
+            newest = database.newest(symbol, type='reddit')
+        except DatabaseUnavailable:
+            # Resume from the journal alone while the database is down
+            newest = None
+            unavailable = True
     if newest is not None:
         since = newest['datetime']
 
+    # Resume exactly where the journal says the last run stopped
+    journal = None
+    resume = None
+    if reddit.journal is not None and until is None:
+        journal = reddit.journal
+        resume = journal.resume('reddit', symbol, newest=None if newest is None else newest['datetime'])
+        if resume is not None:
+            since = resume['since']
+    if unavailable and resume is None:
+        # Unknown resume point, so retry later rather than scraping the
+        # symbol again from the start date
+        if own_database:
+            database.close()
+        raise DatabaseUnavailable('No resume point for {}'.format(symbol))
+
     # Check if it should update based on recency condition
     if recency is not None and newest is not None:
         date_last = newest['datetime']
@@ -224,6 +414,8 @@ def _download_query(reddit, symbols, symbol, recency, session, worker_id):
             skip_log = Logger()
             skip_log.set_log_type('FAIL')
             skip_log.log(worker_label, '{} skipped due to recency condition {} > {}'.format(symbol, last, check))
+            if own_database:
+                database.close()
             return
 
     config = {
@@ -231,57 +423,292 @@ def _download_query(reddit, symbols, symbol, recency, session, worker_id):
         'database': database,
         'session': session,
         'symbol': symbol,
-        'search': query,
         'since': since,
-        'until': datetime.datetime.now() + datetime.timedelta(hours=8),
-        'matches': [*names, name, 'stocks', 'shares']
+        'until': until or datetime.datetime.now() + datetime.timedelta(hours=8),
+        'journal': journal,
+        'volume': None if reddit.volumes is None else reddit.volumes.volume(symbol),
+        **query,
     }
+    if resume is not None and resume['page'] is not None:
+        config['resume_page'] = resume['page']
     L.log(worker_label, '{} resuming from {}'.format(symbol, config['since']))
+    if newest is not None or resume is not None:
+        # Rows from the resume point on may already be stored, and only the
+        # first window can overlap them
+        page = config.get('resume_page')
+        first_until = page['until'] if page is not None else planner.window_end(config['volume'], config['since'], reddit.window_rows)
+        database.warm_seen(symbol, 'reddit', config['since'], until=first_until)
     reddit.get_data(config)
-    database.close()
+    database.forget_seen(symbol, 'reddit')
+    if reddit.dedup is not None:
+        reddit.dedup.forget(symbol, 'reddit')
+    if own_database:
+        database.close()
 
 
-def _work(jobs, session, worker_id):
-    while not jobs.empty():
-        kwargs = jobs.get()
-        _download_query(**kwargs, session=session, worker_id=worker_id)
+def _work(jobs, reddit, symbols, session, worker_id, control=None):
+    while True:
+        if control is not None and control.should_stop():
+            return
+        try:
+            kwargs = jobs.get(timeout=1)
+        except Empty:
+            # A lease queue may only be waiting on units of other nodes
+            if jobs.empty():
+                break
+            continue
+        except Exception as e:
+            error_log.log(' (R{}):\t'.format(worker_id), 'Failed to get a job', e)
+            time.sleep(reddit.retry_delay)
+            continue
+        try:
+            download_query(reddit, symbols, **kwargs, session=session, worker_id=worker_id)
+        except DatabaseUnavailable as e:
+            error_log.log(' (R{}):\t'.format(worker_id), '{} deferred'.format(kwargs['symbol']), e)
+            time.sleep(reddit.retry_delay)
+            if isinstance(jobs, LeaseQueue):
+                jobs.release(count=False)
+            else:
+                # Queued again for later in this run
+                jobs.put(kwargs)
+                jobs.task_done()
+            continue
+        except Exception as e:
+            error_log.log(' (R{}):\t'.format(worker_id), '{} failed'.format(kwargs['symbol']), e)
+            if isinstance(jobs, LeaseQueue):
+                # Left for any node to retry rather than marked done
+                jobs.release()
+            else:
+                jobs.task_done()
+            continue
         jobs.task_done()
-
-
-def download(recency=None):
+    if control is not None:
+        control.stopped()
+
+
+def _start_worker(reddit, symbols, jobs, worker_id, control=None):
+    time.sleep(1)
+    reddit.tor.renew_connection()
+    time.sleep(2)
+    session = reddit.tor.get_session()
+    time.sleep(1)
+    worker = threading.Thread(target=_work, args=[jobs, reddit, symbols, session, worker_id, control])
+    worker.daemon = True
+    worker.start()
+    return worker
+
+
+def _start_workers(reddit, symbols, jobs, n_threads, first_id=0):
+    return [_start_worker(reddit, symbols, jobs, worker_id) for worker_id in range(first_id, first_id + n_threads)]
+
+
+def _process(process_id, jobs, results, lock, n_threads, profile, sample_interval, lease=None, journal=None, estimate=False):
+    """Run a group of worker threads in a child process with its own Tor
+    session, database connections and symbol table. `n_threads` lists the
+    thread count of every process.
+    """
+    logger.configure(config_file='config.json')
+    if lease is not None:
+        jobs = LeaseQueue.open(lease, 'reddit')
+    tor = Tor(lock=lock)
+    reddit = Reddit(tor)
+    if profile:
+        reddit.profiler = profiler.Profiler(sample_interval=sample_interval)
+        tor.profiler = reddit.profiler
+    if journal is not None:
+        reddit.journal = Journal(_journal_part(journal, process_id), base=journal)
+    search_index = index.attach()
+    recent_posts = recent.attach(part=process_id + 1)
+    symbols = Symbols()
+    if estimate:
+        # Estimated by the parent, so only read back to size windows
+        reddit.volumes = _volumes(reddit, symbols)
+
+    reddit.profiler.start()
+    workers = _start_workers(reddit, symbols, jobs, n_threads[process_id], first_id=sum(n_threads[:process_id]))
+    for worker in workers:
+        worker.join()
+    reddit.profiler.stop()
+    if profile:
+        L.log(reddit.profiler.report())
+    if reddit.journal is not None:
+        reddit.journal.close()
+    if search_index is not None:
+        search_index.close()
+    if recent_posts is not None:
+        recent_posts.close()
+    results.put(reddit.throughput.snapshot(process_id))
+
+
+def _journal_part(journal, process_id):
+    return '{}.{}'.format(journal, process_id)
+
+
+def _volumes(reddit, symbols):
+    """Planner counting comments per day with Pushshift histograms of the
+    query of each symbol.
+    """
+    def histogram(symbol, since, until):
+        return reddit.histogram(reddit.query(symbols, symbol)['search'], since, until)
+    start_date = datetime.datetime.strptime(reddit.start_date, '%Y-%m-%d %H:%M:%S')
+    return planner.Planner('reddit', planner.VolumeCache(reddit.volume_cache), histogram, start_date)
+
+
+def download(recency=None, profile=False, sample_interval=None, schedule=True, n_processes=1, lease=None, journal='reddit_journal.jsonl', autoscale=False, estimate=False):
+    """Download every symbol. With `profile`, time each pipeline stage and
+    log where wall time went, optionally sampling worker stacks every
+    `sample_interval` seconds. With `schedule`, the staleness of every symbol
+    is fetched in one pass so the stalest, most active symbols go first and
+    recently updated ones are never handed to a worker. With `n_processes`
+    greater than one, the configured threads are split between that many
+    processes to spread parsing over more cores. With `lease`, jobs come from
+    a lease table shared with other nodes, in the MySQL database if True or
+    in the SQLite file at the given path. Completed windows and page progress
+    are recorded in `journal` so a restart continues exactly where the last
+    run stopped. With `autoscale`, workers are added and retired at runtime
+    between `min_threads` and `reddit_max_threads` in a single process. With
+    `estimate`, the volume of every symbol is counted first and cached in
+    `volume_cache`, so windows are sized to hold about `window_rows` posts
+    and scheduled jobs run largest first with a running ETA.
+    """
+    logger.configure(config_file='config.json')
     tor = Tor()
     reddit = Reddit(tor)
+    if profile:
+        reddit.profiler = profiler.Profiler(sample_interval=sample_interval)
+        tor.profiler = reddit.profiler
+    if journal is not None:
+        reddit.journal = Journal(journal)
+        # Fold in what child processes of an earlier run recorded
+        for part in glob.glob(_journal_part(journal, '[0-9]*')):
+            reddit.journal.merge(part)
+    search_index = index.attach()
+    # Child processes serve the posts they store themselves
+    recent_posts = recent.attach() if n_processes == 1 else None
 
     # Worker queue
-    jobs = Queue()
+    if lease is not None:
+        jobs = LeaseQueue.open(lease, 'reddit')
+    elif n_processes > 1:
+        jobs = processes.context.JoinableQueue()
+    else:
+        jobs = Queue()
     symbols = Symbols()
-    for symbol_info in symbols.symbols_list:
-        symbol = symbol_info['symbol']
-        jobs.put({
-            'reddit': reddit,
-            'symbols': symbols,
-            'symbol': symbol,
-            'recency': recency,
-        })
+    plan = None
+    if schedule:
+        start_date = datetime.datetime.strptime(reddit.start_date, '%Y-%m-%d %H:%M:%S')
+        scheduler = Scheduler('reddit', start_date)
+        plan = scheduler.plan([s['symbol'] for s in symbols.symbols_list], recency=recency)
+    if estimate:
+        reddit.volumes = _volumes(reddit, symbols)
+        reddit.volumes.refresh([s['symbol'] for s in symbols.symbols_list], n_threads=reddit.n_threads)
+        if plan is not None:
+            plan = reddit.volumes.order(plan)
+    if lease is not None:
+        until = datetime.datetime.now() + datetime.timedelta(hours=8)
+        if plan is None:
+            plan = [(s['symbol'], None) for s in symbols.symbols_list]
+        jobs.seed([(symbol, newest, until) for symbol, newest in plan])
+    elif plan is not None:
+        for symbol, newest in plan:
+            jobs.put({
+                'symbol': symbol,
+                'recency': recency,
+                'newest_datetime': newest,
+                'prechecked': True,
+            })
+    else:
+        for symbol_info in symbols.symbols_list:
+            symbol = symbol_info['symbol']
+            jobs.put({
+                'symbol': symbol,
+                'recency': recency,
+            })
 
     # Download
     L.log('Reddit download begin')
-    for worker_id in range(reddit.n_threads):
-        time.sleep(1)
-        tor.renew_connection()
-        time.sleep(2)
-        session = tor.get_session()
-        time.sleep(1)
-        worker = threading.Thread(target=_work, args=[jobs, session, worker_id])
-        worker.daemon = True
-        worker.start()
-    jobs.join()
+    start_time = time.time()
+    if n_processes > 1:
+        results = processes.context.Queue()
+        lock = processes.context.Lock()
+        # Never more processes than threads, so every process gets one
+        n_processes = min(n_processes, reddit.n_threads)
+        n_threads = processes.split(reddit.n_threads, n_processes)
+        if lease is not None:
+            jobs.close()
+            jobs = None
+        children = processes.start(_process, n_processes, [jobs, results, lock, n_threads, profile, sample_interval, lease, journal, estimate])
+        stats = processes.collect(children, results)
+        if journal is not None:
+            for process_id in range(n_processes):
+                reddit.journal.merge(_journal_part(journal, process_id))
+    else:
+        reddit.profiler.start()
+        control = None
+        if autoscale:
+            control = Autoscaler(lambda worker_id: _start_worker(reddit, symbols, jobs, worker_id, control), [reddit.throughput],
+                                 depth=getattr(jobs, 'qsize', None), n_min=reddit.min_threads, n_max=reddit.max_threads)
+            control.start(reddit.n_threads)
+        else:
+            _start_workers(reddit, symbols, jobs, reddit.n_threads)
+        eta = reddit.volumes is not None and plan is not None
+        if eta:
+            reddit.volumes.start(reddit.throughput)
+        try:
+            jobs.join()
+        finally:
+            if eta:
+                reddit.volumes.stop()
+            if control is not None:
+                control.stop()
+            reddit.profiler.stop()
+            if profile:
+                L.log(reddit.profiler.report())
+            if lease is not None:
+                jobs.close()
+        stats = [reddit.throughput.snapshot()]
+    if reddit.journal is not None:
+        reddit.journal.close()
+    if search_index is not None:
+        search_index.close()
+    if recent_posts is not None:
+        recent_posts.close()
+    L.log(processes.report(stats, time.time() - start_time))
     L.log('Reddit download complete')
 
 
+def tail(checkpoint_file='reddit_tail.json', **kwargs):
+    """Poll the recent window of every symbol until interrupted, keeping
+    per-symbol cursors in `checkpoint_file`. Keyword arguments are passed to
+    `Tail`.
+    """
+    logger.configure(config_file='config.json')
+    tor = Tor()
+    reddit = Reddit(tor)
+    symbols = Symbols()
+    search_index = index.attach()
+    recent_posts = recent.attach()
+    try:
+        Tail(reddit, symbols, checkpoint_file, **kwargs).run()
+    finally:
+        if search_index is not None:
+            search_index.close()
+        if recent_posts is not None:
+            recent_posts.close()
+
+
 if __name__ == '__main__':
-    # recency = datetime.timedelta(days=2)
-    download(recency=None)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tail', action='store_true', help='keep polling recent windows instead of sweeping once')
+    parser.add_argument('--autoscale', action='store_true', help='adjust the number of workers at runtime')
+    parser.add_argument('--estimate', action='store_true', help='count the volume of every symbol before downloading')
+    args = parser.parse_args()
+
+    if args.tail:
+        tail()
+    else:
+        # recency = datetime.timedelta(days=2)
+        download(recency=None, autoscale=args.autoscale, estimate=args.estimate)
 
     # config['since'] = datetime.datetime.now() + datetime.timedelta(hours=8) - datetime.timedelta(hours=10)
     # config['until'] = datetime.datetime.now() + datetime.timedelta(hours=8)
@@ -0,0 +1,108 @@
+# Copyright 2021 Jaewan Yun <jaeyun@ucdavis.edu>
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import argparse
+import datetime
+import time
+
+from database import Database, METRIC_COLUMNS
+from reddit import Reddit
+from tor import Tor
+from twitter import Twitter
+from logger import Logger
+import logger
+
+
+L = Logger()
+L.set_log_type('OKGREEN')
+
+
+class Refresher:
+    """Re-reads the engagement counts of recently stored posts, which are
+    frozen at scrape time, and stores the ones that changed.
+
+    Ids of every symbol are looked up `lookup_size` at a time with the
+    scraper's `lookup`, so a post stored for several symbols is fetched
+    once. Changes are written per symbol once `write_size` have built up.
+    """
+
+    def __init__(self, scraper, database, lookup_size=100, write_size=500):
+        self.scraper = scraper
+        self.type = scraper.type
+        self.database = database
+        self.lookup_size = lookup_size
+        self.write_size = write_size
+        self.label = ' [{}]:\t'.format('Refresh')
+        self.pending = []
+        self.changes = {}
+        self.stats = {'checked': 0, 'changed': 0, 'missing': 0, 'failed': 0}
+
+    def _lookup(self):
+        ids = sorted({id for _, id, _, _ in self.pending})
+        current = self.scraper.lookup(ids)
+        if current is None:
+            self.stats['failed'] += len(self.pending)
+            self.pending = []
+            return
+        for symbol, id, dt, old in self.pending:
+            new = current.get(id)
+            if new is None:
+                self.stats['missing'] += 1
+                continue
+            self.stats['checked'] += 1
+            metrics = {c: (old[c], new[c]) for c in new if new[c] != old[c]}
+            if len(metrics) > 0:
+                self.changes.setdefault(symbol, []).append((id, dt, metrics))
+        self.pending = []
+        for symbol in [s for s, changes in self.changes.items() if len(changes) >= self.write_size]:
+            self._write(symbol)
+
+    def _write(self, symbol):
+        changes = self.changes.pop(symbol)
+        if self.database.update_metrics(symbol, self.type, changes, batch_size=self.write_size):
+            self.stats['changed'] += len(changes)
+        else:
+            L.log(self.label, 'Failed to update {} {} rows'.format(len(changes), symbol))
+
+    def run(self, hours):
+        """Refresh the posts of every symbol from the last `hours`.
+        """
+        started = time.time()
+        since = datetime.datetime.now() + datetime.timedelta(hours=8) - datetime.timedelta(hours=hours)
+        columns = METRIC_COLUMNS[self.type]
+        for symbol in self.database.tables(self.type) or []:
+            for id, dt, *values in self.database.recent_metrics(symbol, self.type, since) or []:
+                self.pending.append((symbol, id, dt, dict(zip(columns, values))))
+                if len(self.pending) >= self.lookup_size:
+                    self._lookup()
+        if len(self.pending) > 0:
+            self._lookup()
+        for symbol in list(self.changes):
+            self._write(symbol)
+        L.log(self.label, '{} refreshed in {:.1f}s: {} checked, {} changed, {} no longer available, {} failed'.format(
+            self.type, time.time() - started, self.stats['checked'], self.stats['changed'], self.stats['missing'], self.stats['failed']))
+        return self.stats
+
+
+def refresh(sources, hours=48, lookup_size=100, write_size=500):
+    logger.configure(config_file='config.json')
+    tor = Tor()
+    database = Database(id='F')
+    for source in sources:
+        scraper = Reddit(tor) if source == 'reddit' else Twitter(tor)
+        Refresher(scraper, database, lookup_size=lookup_size, write_size=write_size).run(hours)
+    database.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sources', nargs='+', default=['reddit', 'twitter'], help='sources to refresh')
+    parser.add_argument('--hours', type=float, default=48, help='refresh posts from the last hours')
+    parser.add_argument('--lookup-size', type=int, default=100, help='ids per lookup request')
+    parser.add_argument('--write-size', type=int, default=500, help='changed rows per UPDATE')
+    args = parser.parse_args()
+
+    refresh(args.sources, hours=args.hours, lookup_size=args.lookup_size, write_size=args.write_size)
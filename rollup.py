@@ -0,0 +1,48 @@
+# Copyright 2021 Jaewan Yun <jaeyun@ucdavis.edu>
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import argparse
+import time
+
+from database import Database
+from logger import Logger
+
+
+L = Logger()
+L.set_log_type('OKGREEN')
+
+
+def rebuild(sources, symbols=None):
+    """Recompute the hourly and daily rollups of every stored symbol from the
+    raw tables. Run once after enabling rollups on an existing database, or
+    to repair them.
+    """
+    database = Database(id='U')
+    n_done = 0
+    n_failed = 0
+    for source in sources:
+        stored = database.tables(source) or []
+        if symbols is not None:
+            stored = [s for s in stored if s in symbols]
+        for symbol in sorted(stored):
+            start_time = time.time()
+            if database.rebuild_rollups(symbol, source):
+                n_done += 1
+                L.log(' [Rollup]:\t', '{} {} rebuilt in {:.1f}s'.format(source, symbol, time.time() - start_time))
+            else:
+                n_failed += 1
+    database.close()
+    L.log(' [Rollup]:\t', '{} symbols rebuilt, {} failed'.format(n_done, n_failed))
+    return n_failed == 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sources', nargs='+', default=['reddit', 'twitter'], help='sources to rebuild')
+    parser.add_argument('--symbols', nargs='+', help='symbols to rebuild, all stored symbols by default')
+    args = parser.parse_args()
+
+    rebuild(args.sources, symbols=args.symbols)
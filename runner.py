@@ -0,0 +1,205 @@
+# Copyright 2021 Jaewan Yun <jaeyun@ucdavis.edu>
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import argparse
+import datetime
+import json
+import threading
+import time
+from queue import Queue, Empty
+
+import index
+import logger
+import profiler
+import recent
+import reddit
+import twitter
+from audit import read_jobs
+from autoscale import Autoscaler
+from database import DatabasePool, DatabaseUnavailable
+from journal import Journal
+from logger import Logger
+from scheduler import Scheduler
+from symbols import Symbols
+from tor import Tor
+
+
+L = Logger()
+L.set_log_type('OKCYAN')
+
+# Registered sources, each a scraper class taking a Tor object and a function
+# that downloads one symbol
+SOURCES = {}
+
+
+def register(type, scraper_class, download_query):
+    SOURCES[type] = {
+        'class': scraper_class,
+        'download_query': download_query,
+    }
+
+
+register('reddit', reddit.Reddit, reddit.download_query)
+register('twitter', twitter.Twitter, twitter.download_query)
+
+
+class Runner:
+    """Run several sources over one Tor controller, one symbol table and one
+    database connection pool, with a global limit on concurrent workers.
+    """
+
+    def __init__(self, sources=None, config_file='config.json', n_threads=None, journal='runner_journal.jsonl'):
+        logger.configure(config_file=config_file)
+        self.sources = sources or list(SOURCES.keys())
+        self.tor = Tor(config_file=config_file)
+        self.symbols = Symbols()
+        self.scrapers = {s: SOURCES[s]['class'](self.tor, config_file=config_file) for s in self.sources}
+
+        # Global budget defaults to the sum of the per-source thread counts
+        with open(config_file) as f:
+            config = json.load(f)
+        self.n_threads = n_threads or config.get('n_threads') or sum([s.n_threads for s in self.scrapers.values()])
+        self.min_threads = config.get('min_threads', 1)
+        self.max_threads = config.get('max_threads', 2 * self.n_threads)
+        self.databases = DatabasePool(self.max_threads, config_file=config_file)
+        self.jobs = {s: Queue() for s in self.sources}
+
+        # Sources share one journal, keyed by source and symbol
+        self.journal = Journal(journal) if journal is not None else None
+        self.index = index.attach(config_file)
+        self.recent = recent.attach(config_file)
+        for scraper in self.scrapers.values():
+            scraper.journal = self.journal
+        self.label = ' [{}]:\t'.format('Runner')
+
+    def _plan(self, type, recency, schedule, jobs_file=None):
+        if jobs_file is not None:
+            # Targeted refetch of the ranges found by the auditor
+            for job in read_jobs(jobs_file, type):
+                self.jobs[type].put(job)
+            return
+
+        plan = None
+        if schedule:
+            start_date = datetime.datetime.strptime(self.scrapers[type].start_date, '%Y-%m-%d %H:%M:%S')
+            plan = Scheduler(type, start_date).plan([s['symbol'] for s in self.symbols.symbols_list], recency=recency)
+        if plan is not None:
+            for symbol, newest in plan:
+                self.jobs[type].put({
+                    'symbol': symbol,
+                    'recency': recency,
+                    'newest_datetime': newest,
+                    'prechecked': True,
+                })
+        else:
+            for symbol_info in self.symbols.symbols_list:
+                self.jobs[type].put({
+                    'symbol': symbol_info['symbol'],
+                    'recency': recency,
+                })
+
+    def _next(self, worker_id):
+        """Take the next job, rotating between sources so they share workers.
+        """
+        for i in range(len(self.sources)):
+            type = self.sources[(worker_id + i) % len(self.sources)]
+            try:
+                return type, self.jobs[type].get_nowait()
+            except Empty:
+                continue
+        return None, None
+
+    def _work(self, session, worker_id, control=None):
+        while True:
+            if control is not None and control.should_stop():
+                return
+            type, kwargs = self._next(worker_id)
+            if type is None:
+                break
+            database = self.databases.get()
+            try:
+                SOURCES[type]['download_query'](self.scrapers[type], self.symbols, **kwargs, session=session, worker_id=worker_id, database=database)
+            except DatabaseUnavailable as e:
+                L.log(self.label, '{} {} deferred'.format(type, kwargs['symbol']), e)
+                time.sleep(self.scrapers[type].retry_delay)
+                # Queued again for later in this run
+                self.jobs[type].put(kwargs)
+            except Exception as e:
+                L.log(self.label, '{} {} failed'.format(type, kwargs['symbol']), e)
+            finally:
+                self.databases.put(database)
+                self.jobs[type].task_done()
+        if control is not None:
+            control.stopped()
+
+    def _start_worker(self, worker_id, control=None):
+        time.sleep(1)
+        self.tor.renew_connection()
+        time.sleep(2)
+        session = self.tor.get_session()
+        time.sleep(1)
+        worker = threading.Thread(target=self._work, args=[session, worker_id, control])
+        worker.daemon = True
+        worker.start()
+
+    def run(self, recency=None, profile=False, sample_interval=None, schedule=True, jobs_file=None, autoscale=False):
+        if profile:
+            shared = profiler.Profiler(sample_interval=sample_interval)
+            self.tor.profiler = shared
+            for scraper in self.scrapers.values():
+                scraper.profiler = shared
+        for type in self.sources:
+            self._plan(type, recency, schedule, jobs_file=jobs_file)
+
+        L.log(self.label, 'Download begin for {} with {} workers'.format(', '.join(self.sources), self.n_threads))
+        start_time = time.time()
+        self.tor.profiler.start()
+        control = None
+        if autoscale:
+            # Starts at the configured budget and moves within the bounds
+            control = Autoscaler(lambda worker_id: self._start_worker(worker_id, control),
+                                 [scraper.throughput for scraper in self.scrapers.values()],
+                                 depth=lambda: sum([q.qsize() for q in self.jobs.values()]),
+                                 n_min=self.min_threads, n_max=self.max_threads)
+            control.start(self.n_threads)
+        else:
+            for worker_id in range(self.n_threads):
+                self._start_worker(worker_id)
+        try:
+            for type in self.sources:
+                self.jobs[type].join()
+        finally:
+            if control is not None:
+                control.stop()
+            self.tor.profiler.stop()
+            if profile:
+                L.log(self.tor.profiler.report())
+            self.databases.close()
+            if self.journal is not None:
+                self.journal.close()
+            if self.index is not None:
+                self.index.close()
+            if self.recent is not None:
+                self.recent.close()
+
+        wall = time.time() - start_time
+        for type, scraper in self.scrapers.items():
+            s = scraper.throughput.snapshot()
+            L.log(self.label, '{:<8} {:>10} rows {:>7} windows {:>9.1f} rows/s'.format(type, s['rows'], s['windows'], s['rows'] / max(wall, 1e-9)))
+        L.log(self.label, 'Download complete')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sources', nargs='+', choices=list(SOURCES.keys()), help='sources to run, all by default')
+    parser.add_argument('--threads', type=int, help='global number of workers')
+    parser.add_argument('--profile', action='store_true', help='report where wall time went')
+    parser.add_argument('--jobs', help='refetch only the ranges in a file written by audit.py')
+    parser.add_argument('--autoscale', action='store_true', help='adjust the number of workers at runtime')
+    args = parser.parse_args()
+
+    runner = Runner(sources=args.sources, n_threads=args.threads)
+    runner.run(profile=args.profile, jobs_file=args.jobs, autoscale=args.autoscale)
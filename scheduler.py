@@ -0,0 +1,68 @@
+# Copyright 2021 Jaewan Yun <jaeyun@ucdavis.edu>
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import datetime
+
+from database import Database, DatabaseUnavailable
+from logger import Logger
+
+
+L = Logger()
+L.set_log_type('OKGREEN')
+
+
+class Scheduler:
+    def __init__(self, type, start_date, activity_window=datetime.timedelta(days=7), min_rate=0.01):
+        self.type = type
+        self.start_date = start_date
+        self.activity_window = activity_window
+        self.min_rate = min_rate
+        self.label = ' [{}]:\t'.format('Scheduler')
+
+    def priority(self, stats, now):
+        """Expected number of posts missed since the last update, estimated
+        from the mention rate over the activity window.
+        """
+        if stats is None or stats['newest'] is None:
+            # Never scraped, so everything since the start date is missing
+            return float('inf'), (now - self.start_date).total_seconds()
+        hours = self.activity_window.total_seconds() / 3600
+        rate = max(stats['recent'] / hours, self.min_rate)
+        staleness = max((now - stats['newest']).total_seconds() / 3600, 0)
+        return rate * staleness, staleness
+
+    def plan(self, symbols, recency=None):
+        """Order symbols by priority and drop those updated within `recency`.
+
+        Returns a list of `(symbol, newest)` tuples, or None if the bulk
+        staleness query failed and every symbol should be checked by its worker.
+        """
+        now = datetime.datetime.now() + datetime.timedelta(hours=8)
+        database = Database(id='S')
+        try:
+            stats = database.bulk_newest(symbols, self.type, now - self.activity_window)
+        except DatabaseUnavailable:
+            # Workers defer symbols they cannot look up until it is back
+            L.log(self.label, 'Database unavailable, leaving staleness checks to workers')
+            stats = None
+        database.close()
+        if stats is None:
+            L.log(self.label, 'Bulk staleness query failed, falling back to alphabetical order')
+            return None
+
+        planned = []
+        n_fresh = 0
+        for symbol in symbols:
+            s = stats.get(symbol)
+            newest = None if s is None else s['newest']
+            if recency is not None and newest is not None and newest > now - recency:
+                n_fresh += 1
+                continue
+            planned.append((self.priority(s, now), symbol, newest))
+        planned = sorted(planned, key=lambda p: p[0], reverse=True)
+
+        L.log(self.label, '{} {} symbols scheduled, {} skipped due to recency condition'.format(len(planned), self.type, n_fresh))
+        return [(symbol, newest) for _, symbol, newest in planned]
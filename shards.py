@@ -0,0 +1,156 @@
+# Copyright 2021 Jaewan Yun <jaeyun@ucdavis.edu>
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import argparse
+import bisect
+import hashlib
+import time
+
+from logger import Logger
+
+
+L = Logger()
+L.set_log_type('OKGREEN')
+
+SOURCES = ['reddit', 'twitter']
+CONNECTION_KEYS = ['host', 'port', 'user', 'password', 'database']
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+
+def shard_name(shard):
+    """Name of a shard entry of the `shards` config key, which defaults to
+    its address so reordering the list moves nothing.
+    """
+    return shard.get('name') or '{}:{}/{}'.format(shard.get('host'), shard.get('port'), shard.get('database'))
+
+
+class ShardMap:
+    """Consistent hash ring placing each `(source, symbol)` on one of the
+    named shards. Every shard owns `replicas` points on the ring, so adding
+    a shard moves only about 1/N of the symbols, all of them to the new one.
+    """
+
+    def __init__(self, names, replicas=128):
+        if len(names) == 0:
+            raise Exception('No shards configured')
+        if len(set(names)) != len(names):
+            raise Exception('Shard names are not unique: {}'.format(names))
+        self.names = list(names)
+        ring = sorted((_hash('{}#{}'.format(name, i)), name) for name in self.names for i in range(replicas))
+        self.points = [point for point, _ in ring]
+        self.owners = [name for _, name in ring]
+        self.cache = {}
+
+    def locate(self, symbol, type):
+        key = (type, symbol)
+        if key not in self.cache:
+            i = bisect.bisect(self.points, _hash('{}/{}'.format(type, symbol))) % len(self.points)
+            self.cache[key] = self.owners[i]
+        return self.cache[key]
+
+    def group(self, symbols, type):
+        """Symbols by the shard that holds them.
+        """
+        groups = {}
+        for symbol in symbols:
+            groups.setdefault(self.locate(symbol, type), []).append(symbol)
+        return groups
+
+
+def move(source, target, symbol, type, chunk_size=5000):
+    """Copy the table of a symbol from the `source` shard to the `target`
+    shard with its duplicate references and, for tables with
+    `normalize_users`, the profiles its tweets refer to. The rollups are
+    rebuilt on the target, then everything of the symbol is dropped from
+    the source. Rows already on the target are skipped, so an interrupted
+    move can be repeated.
+    """
+    definition = source.table_definition(symbol, type)
+    if definition is None or not target.create_table(symbol, type, definition=definition):
+        return False
+    columns = source.table_columns(symbol, type)
+    n_rows = 0
+    for rows in source.scan_chunks(symbol, type, columns=columns, chunk_size=chunk_size, typed=False):
+        if not target.insert_rows(symbol, type, columns, rows):
+            return False
+        if 'user_snapshot' in columns:
+            i = columns.index('user_id')
+            j = columns.index('user_snapshot')
+            snapshots, users = source.export_users({(row[i], row[j]) for row in rows if row[j] is not None})
+            if snapshots is None or not target.import_users(snapshots, users):
+                return False
+        n_rows += len(rows)
+
+    duplicates = source.duplicates(symbol, type)
+    if duplicates is None or (len(duplicates) > 0 and not target.add_duplicates(symbol, type, duplicates)):
+        return False
+    if target.rollups and not target.rebuild_rollups(symbol, type):
+        return False
+
+    stored = target.size(symbol, type)
+    if stored is None or stored[0][0] < n_rows:
+        L.log(' [Shards]:\t', '{} {} has {} of {} rows on the target, keeping the source'.format(type, symbol, None if stored is None else stored[0][0], n_rows))
+        return False
+    return source.drop_symbol(symbol, type)
+
+
+def plan(database):
+    """`(symbol, type, source, target)` for every per-symbol post table
+    stored on a shard other than the one the shard map places it on. Shared
+    tables such as the user profiles stay on every shard.
+    """
+    from database import USER_TABLES
+    moves = []
+    for name in database.shard_map.names:
+        shard = database.shard_database(name)
+        for type in SOURCES:
+            for symbol in shard.tables(type) or []:
+                if shard.table_name(symbol, type) in USER_TABLES:
+                    continue
+                owner = database.shard_map.locate(symbol, type)
+                if owner != name:
+                    moves.append((symbol, type, name, owner))
+    return moves
+
+
+def rebalance(config_file='config.json', dry_run=False):
+    """Move every table to the shard the current `shards` list places it
+    on. Run it with the scrapers stopped after adding a shard.
+    """
+    from database import Database
+    database = Database(id='B', config_file=config_file, spool=False)
+    if database.shard_map is None:
+        raise Exception('No shards in {}'.format(config_file))
+    moves = plan(database)
+    L.log(' [Shards]:\t', '{} tables to move'.format(len(moves)))
+    started = time.time()
+    n_failed = 0
+    for i, (symbol, type, source, target) in enumerate(moves):
+        L.log(' [Shards]:\t', '({}/{}) {} {}: {} -> {}'.format(i + 1, len(moves), type, symbol, source, target))
+        if dry_run:
+            continue
+        try:
+            moved = move(database.shard_database(source), database.shard_database(target), symbol, type)
+        except Exception as e:
+            L.log(' [Shards]:\t', 'Failed to move {} {}'.format(type, symbol), e)
+            moved = False
+        if not moved:
+            n_failed += 1
+    if not dry_run:
+        L.log(' [Shards]:\t', 'Moved {} tables in {:.1f}s, {} failed'.format(len(moves) - n_failed, time.time() - started, n_failed))
+    database.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default='config.json', help='config file with the shards key')
+    parser.add_argument('--dry-run', action='store_true', help='only list the tables that would move')
+    args = parser.parse_args()
+
+    rebalance(args.config, dry_run=args.dry_run)
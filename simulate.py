@@ -0,0 +1,476 @@
+# Copyright 2021 Jaewan Yun <jaeyun@ucdavis.edu>
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import argparse
+import collections
+import datetime
+import json
+import os
+import random
+import select
+import socket
+import socketserver
+import struct
+import tempfile
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Queue, Empty
+
+import profiler
+from logger import Logger
+
+
+L = Logger()
+L.set_log_type('OKBLUE')
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Fault settings of each failure mode, layered over the fault-free baseline
+MODES = {
+    'baseline': {},
+    'reset': {'reset_rate': 0.02},
+    'slow': {'slow_rate': 0.05, 'slow_delay': 2.0},
+    'throttle': {'throttle_rate': 0.02},
+    'controller': {'throttle_rate': 0.02, 'controller_delay': 2.0},
+}
+FAULTS = ['reset_rate', 'slow_rate', 'slow_delay', 'throttle_rate', 'controller_delay']
+
+
+class Faults:
+    """What the simulated network does wrong.
+
+    Per request, `reset_rate` is the chance the connection is reset,
+    `slow_rate` the chance the response takes `slow_delay` seconds longer and
+    `throttle_rate` the chance the API starts answering 429 to everything sent
+    over the current circuit until the next NEWNYM. The control port waits
+    `controller_delay` seconds before answering NEWNYM, and like Tor ignores
+    a NEWNYM sent within `newnym_interval` seconds of the last one.
+    """
+
+    def __init__(self, reset_rate=0.0, slow_rate=0.0, slow_delay=0.0, throttle_rate=0.0, controller_delay=0.0, newnym_interval=0.0):
+        self.reset_rate = reset_rate
+        self.slow_rate = slow_rate
+        self.slow_delay = slow_delay
+        self.throttle_rate = throttle_rate
+        self.controller_delay = controller_delay
+        self.newnym_interval = newnym_interval
+
+
+class Network:
+    """Stand-in for Tor and the API behind it: a SOCKS5 proxy, a control port
+    and a Pushshift-like comment search, all on 127.0.0.1.
+
+    Every proxied connection goes to the fake API whatever its destination,
+    and is tagged with the circuit that was current when it was opened so
+    the API can throttle by circuit.
+    """
+
+    def __init__(self, faults, symbols, start, days, posts_per_day, seed=0):
+        self.faults = faults
+        self.symbols = symbols
+        self.start = start
+        self.days = days
+        self.step = 86400 // posts_per_day
+        self.n_posts = days * posts_per_day
+        self.tz_offset = datetime.timedelta(hours=8)
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.events = collections.Counter()
+        self.circuit = 0
+        self.throttled = set()
+        self.ports = {}
+        self.last_newnym = 0
+        self._servers = []
+
+    def count(self, event, n=1):
+        with self.lock:
+            self.events[event] += n
+
+    def fault(self, name):
+        """Draw whether fault `name` happens now, counting it if it does.
+        """
+        with self.lock:
+            happens = self.random.random() < getattr(self.faults, '{}_rate'.format(name))
+            if happens:
+                self.events[name] += 1
+            return happens
+
+    def newnym(self):
+        with self.lock:
+            now = time.time()
+            if now - self.last_newnym < self.faults.newnym_interval:
+                self.events['newnym_ignored'] += 1
+                return
+            self.last_newnym = now
+            self.events['newnym'] += 1
+            self.circuit += 1
+
+    def is_throttled(self, port):
+        """Whether the circuit of the proxied connection from `port` is
+        throttled, possibly starting now.
+        """
+        with self.lock:
+            circuit = self.ports.get(port, self.circuit)
+            if circuit in self.throttled:
+                return True
+        if self.fault('throttle'):
+            with self.lock:
+                self.throttled.add(circuit)
+            return True
+        return False
+
+    def posts(self, symbol, after, before, size):
+        """Posts of `symbol` created strictly between two epoch times, oldest
+        first.
+        """
+        t0 = int(self.start.timestamp())
+        first = max(0, (after - t0) // self.step + 1)
+        posts = []
+        for k in range(first, self.n_posts):
+            created = t0 + k * self.step
+            if created >= before or len(posts) >= size:
+                break
+            posts.append({
+                'id': '{}{}'.format(symbol.lower(), k),
+                'created_utc': created,
+                'author': 'user{}'.format(k % 97),
+                'author_created_utc': t0 - 86400,
+                'score': 1 + k % 5,
+                'body': 'Thoughts on {} stocks today, post number {} of the simulation'.format(symbol, k),
+                'subreddit': 'stocks',
+            })
+        return posts
+
+    def start_servers(self):
+        api = ThreadingHTTPServer(('127.0.0.1', 0), _api_handler(self))
+        proxy = _ThreadingTCPServer(('127.0.0.1', 0), _proxy_handler(self, api.server_address))
+        control = _ThreadingTCPServer(('127.0.0.1', 0), _control_handler(self))
+        self._servers = [api, proxy, control]
+        for server in self._servers:
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.api_port = api.server_address[1]
+        self.proxy_port = proxy.server_address[1]
+        self.control_port = control.server_address[1]
+
+    def stop_servers(self):
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+
+
+class _ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def _api_handler(network):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def _send(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if network.is_throttled(self.client_address[1]):
+                network.count('throttled')
+                self._send(429, {'error': 'Too Many Requests'})
+                return
+            url = urllib.parse.urlparse(self.path)
+            params = dict(urllib.parse.parse_qsl(url.query))
+            after = datetime.datetime.strptime(params['after'], DATE_FORMAT) - network.tz_offset
+            before = datetime.datetime.strptime(params['before'], DATE_FORMAT) - network.tz_offset
+            data = network.posts(params['q'], int(after.timestamp()), int(before.timestamp()), int(params.get('size', 100)))
+            network.count('requests')
+            self._send(200, {'data': data})
+    return Handler
+
+
+def _proxy_handler(network, upstream_address):
+    class Handler(socketserver.BaseRequestHandler):
+        def _recv(self, n):
+            data = b''
+            while len(data) < n:
+                part = self.request.recv(n - len(data))
+                if not part:
+                    raise ConnectionError('Client closed during handshake')
+                data += part
+            return data
+
+        def _handshake(self):
+            # No-authentication CONNECT only, which is all requests needs
+            _, n_methods = self._recv(2)
+            self._recv(n_methods)
+            self.request.sendall(b'\x05\x00')
+            _, command, _, address_type = self._recv(4)
+            if address_type == 1:
+                self._recv(4)
+            elif address_type == 3:
+                self._recv(self._recv(1)[0])
+            elif address_type == 4:
+                self._recv(16)
+            self._recv(2)
+            return command
+
+        def _reset(self):
+            # Close with a RST rather than a FIN
+            self.request.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+            self.request.close()
+
+        def handle(self):
+            try:
+                command = self._handshake()
+            except ConnectionError:
+                return
+            if command != 1:
+                self.request.sendall(b'\x05\x07\x00\x01' + bytes(6))
+                return
+            upstream = socket.create_connection(upstream_address)
+            port = upstream.getsockname()[1]
+            with network.lock:
+                network.ports[port] = network.circuit
+            self.request.sendall(b'\x05\x00\x00\x01' + bytes(6))
+            try:
+                self._relay(upstream)
+            finally:
+                upstream.close()
+                with network.lock:
+                    network.ports.pop(port, None)
+
+        def _relay(self, upstream):
+            client = self.request
+            slow = False
+            while True:
+                readable, _, _ = select.select([client, upstream], [], [])
+                for sock in readable:
+                    try:
+                        data = sock.recv(65536)
+                    except OSError:
+                        return
+                    if not data:
+                        return
+                    if sock is client:
+                        if network.fault('reset'):
+                            self._reset()
+                            return
+                        slow = network.fault('slow')
+                        upstream.sendall(data)
+                        continue
+                    if slow:
+                        time.sleep(network.faults.slow_delay)
+                        slow = False
+                    client.sendall(data)
+    return Handler
+
+
+def _control_handler(network):
+    class Handler(socketserver.StreamRequestHandler):
+        """Enough of the Tor control protocol for stem to authenticate and
+        send NEWNYM.
+        """
+
+        def _reply(self, *lines):
+            out = ''.join(['250-{}\r\n'.format(line) for line in lines]) + '250 OK\r\n'
+            self.wfile.write(out.encode())
+
+        def handle(self):
+            for line in self.rfile:
+                words = line.decode().strip().split(' ')
+                command = words[0].upper()
+                if command == 'PROTOCOLINFO':
+                    self._reply('PROTOCOLINFO 1', 'AUTH METHODS=HASHEDPASSWORD', 'VERSION Tor="0.4.5.0"')
+                elif command == 'GETINFO':
+                    self._reply(*['{}=0.4.5.0'.format(key) if key == 'version' else '{}='.format(key) for key in words[1:]])
+                elif command == 'GETCONF':
+                    keys = words[1:]
+                    out = ['250-{}\r\n'.format(key) for key in keys[:-1]] + ['250 {}\r\n'.format(keys[-1])]
+                    self.wfile.write(''.join(out).encode())
+                elif command == 'SIGNAL' and words[1:] == ['NEWNYM']:
+                    if network.faults.controller_delay > 0:
+                        network.count('controller_delay')
+                        time.sleep(network.faults.controller_delay)
+                    network.newnym()
+                    self.wfile.write(b'250 OK\r\n')
+                elif command == 'QUIT':
+                    self.wfile.write(b'250 closing connection\r\n')
+                    return
+                else:
+                    self.wfile.write(b'250 OK\r\n')
+    return Handler
+
+
+class Sink:
+    """Database stand-in that discards writes, so a simulation measures the
+    network paths alone.
+    """
+
+    def create_table(self, symbol, type):
+        pass
+
+    def compact(self, data, type):
+        return data
+
+    def add_data(self, symbol, data, type):
+        return True
+
+    def warm_seen(self, symbol, type, since, until=None):
+        pass
+
+    def forget_seen(self, symbol, type):
+        pass
+
+    def close(self):
+        pass
+
+
+def run(mode, faults, n_workers, n_symbols=16, days=6, posts_per_day=400, retry_delay=1.0, page_delay=0.05, seed=0):
+    """Download `n_symbols` simulated symbols with `n_workers` threads
+    through a simulated network with `faults`. Returns the measurements of
+    the run.
+    """
+    from reddit import Reddit
+    from tor import Tor
+
+    start = datetime.datetime(2021, 1, 1)
+    symbols = ['SIM{}'.format(i) for i in range(n_symbols)]
+    network = Network(faults, symbols, start, days, posts_per_day, seed=seed)
+    network.start_servers()
+
+    fd, config_file = tempfile.mkstemp(suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump({
+            'tor_password': 'simulate',
+            'tor_port': network.proxy_port,
+            'tor_controller_port': network.control_port,
+            'reddit_start_date': start.strftime(DATE_FORMAT),
+            'reddit_n_threads': n_workers,
+            'retry_delay': retry_delay,
+            'page_delay': page_delay,
+        }, f)
+    try:
+        tor = Tor(config_file=config_file, verbose=False)
+        reddit = Reddit(tor, config_file=config_file)
+        reddit.base_url = 'http://127.0.0.1:{}/reddit/search/comment'.format(network.api_port)
+        reddit.profiler = profiler.Profiler()
+        tor.profiler = reddit.profiler
+
+        jobs = Queue()
+        for symbol in symbols:
+            jobs.put(symbol)
+
+        def work(worker_id):
+            reddit.profiler.set_context(worker=worker_id)
+            session = tor.get_session()
+            while True:
+                try:
+                    symbol = jobs.get_nowait()
+                except Empty:
+                    return
+                reddit.profiler.set_context(symbol=symbol)
+                config = {
+                    'worker_label': ' (S{}):\t'.format(worker_id),
+                    'database': Sink(),
+                    'session': session,
+                    'symbol': symbol,
+                    'since': start,
+                    'until': start + datetime.timedelta(days=days),
+                    'search': symbol,
+                    'matches': [symbol, 'stocks'],
+                }
+                reddit.get_data(config)
+                session = config['session']
+
+        reddit.profiler.start()
+        started = time.time()
+        workers = [threading.Thread(target=work, args=[i], daemon=True) for i in range(n_workers)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        wall = time.time() - started
+        reddit.profiler.stop()
+    finally:
+        network.stop_servers()
+        os.remove(config_file)
+
+    stages = reddit.profiler.stages
+    return {
+        'mode': mode,
+        'workers': n_workers,
+        'wall': wall,
+        'rows': reddit.throughput.snapshot()['rows'],
+        'events': dict(network.events),
+        'renew_time': stages['renew_connection'][0],
+        'renews': stages['renew_connection'][1],
+    }
+
+
+def _n_faults(result):
+    events = result['events']
+    return events.get('reset', 0) + events.get('slow', 0) + events.get('throttle', 0)
+
+
+def report(results):
+    """Time lost to each failure mode against the baseline with the same
+    number of workers. Lost worker-seconds are the extra wall time of the run
+    times its workers.
+    """
+    baselines = {r['workers']: r for r in results if r['mode'] == 'baseline'}
+    lines = ['Simulation: {} runs'.format(len(results))]
+    lines.append('  {:<10} {:>7} {:>8} {:>10} {:>7} {:>7} {:>12} {:>10} {:>9}'.format(
+        'mode', 'workers', 'wall', 'rows/s', 'faults', 'newnym', 'lost', 'per fault', 'renewing'))
+    for r in sorted(results, key=lambda r: (list(MODES).index(r['mode']) if r['mode'] in MODES else len(MODES), r['workers'])):
+        baseline = baselines.get(r['workers'])
+        lost = 0.0 if baseline is None else max(r['wall'] - baseline['wall'], 0) * r['workers']
+        n_faults = _n_faults(r)
+        lines.append('  {:<10} {:>7} {:>7.1f}s {:>10.1f} {:>7} {:>7} {:>11.1f}s {:>9.2f}s {:>8.1f}s'.format(
+            r['mode'], r['workers'], r['wall'], r['rows'] / max(r['wall'], 1e-9), n_faults,
+            '{}/{}'.format(r['events'].get('newnym', 0), r['renews']),
+            lost, lost / n_faults if n_faults > 0 else 0.0, r['renew_time']))
+    lines.append('  newnym is circuits changed / renewals requested; renewals coalesced across workers are not sent')
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--modes', nargs='+', default=list(MODES), choices=list(MODES), help='failure modes to simulate')
+    parser.add_argument('--workers', nargs='+', type=int, default=[1, 2, 4, 8], help='worker counts to simulate')
+    parser.add_argument('--symbols', type=int, default=16, help='number of simulated symbols')
+    parser.add_argument('--days', type=int, default=6, help='days of posts per symbol')
+    parser.add_argument('--posts', type=int, default=400, help='posts per symbol per day')
+    parser.add_argument('--retry-delay', type=float, default=1.0, help='seconds the scraper backs off after a failure')
+    parser.add_argument('--page-delay', type=float, default=0.05, help='seconds the scraper waits between pages')
+    parser.add_argument('--reset-rate', type=float, help='chance a request has its connection reset')
+    parser.add_argument('--slow-rate', type=float, help='chance a response is slow')
+    parser.add_argument('--slow-delay', type=float, help='seconds a slow response takes longer')
+    parser.add_argument('--throttle-rate', type=float, help='chance a request gets its circuit throttled until the next NEWNYM')
+    parser.add_argument('--controller-delay', type=float, help='seconds the control port takes to answer NEWNYM')
+    parser.add_argument('--newnym-interval', type=float, default=0.0, help='seconds within which a repeated NEWNYM is ignored')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    overrides = {k: getattr(args, k) for k in FAULTS if getattr(args, k) is not None}
+    results = []
+    modes = ['baseline'] + [m for m in args.modes if m != 'baseline']
+    for n_workers in args.workers:
+        for mode in modes:
+            # Overrides tune the faults a mode injects but add no new ones
+            settings = {k: overrides.get(k, v) for k, v in MODES[mode].items()}
+            settings['newnym_interval'] = args.newnym_interval
+            result = run(mode, Faults(**settings), n_workers, n_symbols=args.symbols, days=args.days, posts_per_day=args.posts,
+                         retry_delay=args.retry_delay, page_delay=args.page_delay, seed=args.seed)
+            L.log(' [Simulate]:\t', '{} with {} workers: {:.1f}s, {}'.format(mode, n_workers, result['wall'], result['events']))
+            results.append(result)
+    L.log(report(results))
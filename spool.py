@@ -0,0 +1,276 @@
+# Copyright 2021 Jaewan Yun <jaeyun@ucdavis.edu>
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import argparse
+import datetime
+import fcntl
+import glob
+import itertools
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+
+from logger import Logger
+
+
+L = Logger()
+L.set_log_type('WARNING')
+
+# Length and CRC32 of the payload that follows
+RECORD = struct.Struct('<II')
+
+
+def _default(value):
+    if isinstance(value, datetime.datetime):
+        return {'$datetime': value.isoformat()}
+    if isinstance(value, datetime.date):
+        return {'$date': value.isoformat()}
+    if isinstance(value, bytes):
+        return {'$bytes': value.hex()}
+    raise TypeError('Cannot spool {}'.format(type(value)))
+
+
+def _object_hook(d):
+    if len(d) == 1:
+        if '$datetime' in d:
+            return datetime.datetime.fromisoformat(d['$datetime'])
+        if '$date' in d:
+            return datetime.date.fromisoformat(d['$date'])
+        if '$bytes' in d:
+            return bytes.fromhex(d['$bytes'])
+    return d
+
+
+class Spool:
+    """Append-only spool of rows that could not be written to the database,
+    replayed in order by a background drainer once it is reachable again.
+
+    Records are framed with their length and CRC32 in numbered segment
+    files of about `segment_bytes`, and fsynced before `append` returns. A
+    process claims a subdirectory of `directory` with a file lock, so
+    processes never share segments and a new process drains what a crashed
+    one left behind. The drainer's position is kept in a cursor file, and
+    a segment is deleted once drained.
+
+    `replay(symbol, type, names, values)` stores a record and returns True,
+    False if it should be retried later, or None if the record can never be
+    stored. Such records are moved to `rejected.jsonl`. Replay must be
+    idempotent, since a record may be replayed again after a crash.
+    """
+
+    def __init__(self, directory, replay, segment_bytes=64 * 2 ** 20, retry_interval=10, max_replay_rows=5000):
+        self.replay = replay
+        self.segment_bytes = segment_bytes
+        self.retry_interval = retry_interval
+        self.max_replay_rows = max_replay_rows
+        self.lock = threading.Lock()
+        self.label = ' [{}]:\t'.format('Spool')
+        self.n_spooled = 0
+        self.n_replayed = 0
+
+        for i in itertools.count():
+            self.directory = os.path.join(directory, str(i))
+            os.makedirs(self.directory, exist_ok=True)
+            self.lock_file = open(os.path.join(self.directory, 'lock'), 'a')
+            try:
+                fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                self.lock_file.close()
+
+        self.cursor_file = os.path.join(self.directory, 'cursor.json')
+        self.position = self._read_cursor()
+        segments = self._segments()
+        # Writes always start a new segment, so a torn tail left by a crash
+        # is never appended to
+        self.f = None
+        self.segment = (segments[-1] if len(segments) > 0 else self.position[0]) + 1
+        self.active = len(segments) > 0
+        if self.active:
+            L.log(self.label, 'Found {} segments to replay in {}'.format(len(segments), self.directory))
+
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._drainer = threading.Thread(target=self._drain, name='spool-drainer', daemon=True)
+        self._drainer.start()
+
+    def _segment_file(self, segment):
+        return os.path.join(self.directory, '{:012d}.seg'.format(segment))
+
+    def _segments(self):
+        return sorted([int(os.path.basename(f)[:-4]) for f in glob.glob(os.path.join(self.directory, '*.seg'))])
+
+    def _read_cursor(self):
+        try:
+            with open(self.cursor_file) as f:
+                cursor = json.load(f)
+            return cursor['segment'], cursor['offset']
+        except (OSError, ValueError, KeyError):
+            segments = self._segments()
+            return (segments[0] if len(segments) > 0 else 0), 0
+
+    def _write_cursor(self):
+        tmp = '{}.tmp'.format(self.cursor_file)
+        with open(tmp, 'w') as f:
+            json.dump({'segment': self.position[0], 'offset': self.position[1]}, f)
+        os.replace(tmp, self.cursor_file)
+
+    def trip(self):
+        """Send every write to the spool until the drainer has caught up.
+        """
+        with self.lock:
+            if not self.active:
+                L.log(self.label, 'Database unavailable or slow, spooling writes to {}'.format(self.directory))
+            self.active = True
+        self._wake.set()
+
+    def append(self, symbol, type, names, values):
+        payload = json.dumps({'symbol': symbol, 'type': type, 'names': names, 'values': values}, default=_default).encode()
+        with self.lock:
+            if self.f is None or self.f.tell() >= self.segment_bytes:
+                if self.f is not None:
+                    self.f.close()
+                    self.segment += 1
+                self.f = open(self._segment_file(self.segment), 'ab')
+            self.f.write(RECORD.pack(len(payload), zlib.crc32(payload)) + payload)
+            self.f.flush()
+            os.fsync(self.f.fileno())
+            self.active = True
+            self.n_spooled += len(values)
+        self._wake.set()
+        return True
+
+    def _read(self, position):
+        """The record at `position` and the position after it, or None if
+        there is no complete record there.
+        """
+        segment, offset = position
+        try:
+            with open(self._segment_file(segment), 'rb') as f:
+                f.seek(offset)
+                header = f.read(RECORD.size)
+                if len(header) < RECORD.size:
+                    return None
+                length, crc = RECORD.unpack(header)
+                payload = f.read(length)
+        except FileNotFoundError:
+            return None
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            return None
+        return json.loads(payload, object_hook=_object_hook), (segment, offset + RECORD.size + length)
+
+    def _next(self):
+        """Next complete record, moving past segments that are finished.
+        """
+        while True:
+            read = self._read(self.position)
+            if read is not None:
+                return read
+            later = [s for s in self._segments() if s > self.position[0]]
+            if len(later) == 0:
+                return None
+            # The writer has moved on, so anything left here is a torn tail
+            finished = self._segment_file(self.position[0])
+            if os.path.exists(finished):
+                os.remove(finished)
+            self.position = (later[0], 0)
+            self._write_cursor()
+
+    def _batch(self):
+        """Consecutive records of one table, merged up to `max_replay_rows`.
+        """
+        read = self._next()
+        if read is None:
+            return None
+        record, end = read
+        while len(record['values']) < self.max_replay_rows:
+            following = self._read(end)
+            if following is None:
+                break
+            other, other_end = following
+            if (other['symbol'], other['type'], other['names']) != (record['symbol'], record['type'], record['names']):
+                break
+            record['values'].extend(other['values'])
+            end = other_end
+        return record, end
+
+    def _drain(self):
+        while not self._stopped.is_set():
+            batch = self._batch()
+            if batch is None:
+                with self.lock:
+                    # Checked again under the lock so no append is missed
+                    batch = self._batch()
+                    if batch is None:
+                        if self.active:
+                            L.log(self.label, 'Spool drained, {} rows replayed'.format(self.n_replayed))
+                        self.active = False
+                if batch is None:
+                    self._wake.wait(self.retry_interval)
+                    self._wake.clear()
+                    continue
+
+            record, end = batch
+            try:
+                stored = self.replay(record['symbol'], record['type'], record['names'], record['values'])
+            except Exception as e:
+                L.log(self.label, 'Replay failed', e)
+                stored = False
+            if stored is False:
+                self._stopped.wait(self.retry_interval)
+                continue
+            if stored is None:
+                L.log(self.label, 'Rejected {} rows of {} {}'.format(len(record['values']), record['type'], record['symbol']))
+                with open(os.path.join(self.directory, 'rejected.jsonl'), 'a') as f:
+                    f.write(json.dumps(record, default=_default) + '\n')
+            else:
+                self.n_replayed += len(record['values'])
+            self.position = end
+            self._write_cursor()
+
+    def wait(self, timeout=None):
+        """Wait until every spooled row is replayed. Returns False on timeout.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while self.active:
+            if deadline is not None and time.time() >= deadline:
+                return False
+            time.sleep(0.5)
+        return True
+
+    def close(self):
+        self._stopped.set()
+        self._wake.set()
+        self._drainer.join()
+        with self.lock:
+            if self.f is not None:
+                self.f.close()
+                self.f = None
+        fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+        self.lock_file.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default='config.json', help='config file with the spool_dir key')
+    args = parser.parse_args()
+
+    # Replay what earlier runs left behind. Each spool claims the next
+    # subdirectory not locked by a running process
+    import database
+    with open(args.config) as f:
+        directory = json.load(f).get('spool_dir')
+    if directory is None:
+        raise Exception('No spool_dir in {}'.format(args.config))
+    n = len(glob.glob(os.path.join(directory, '[0-9]*')))
+    spools = [database.open_spool(args.config, shared=False) for _ in range(n)]
+    for spool in spools:
+        spool.wait()
+    for spool in spools:
+        spool.close()
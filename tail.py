@@ -0,0 +1,205 @@
+# Copyright 2021 Jaewan Yun <jaeyun@ucdavis.edu>
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import datetime
+import heapq
+import json
+import os
+import threading
+import time
+
+from database import Database, DatabaseUnavailable
+from logger import Logger
+
+
+L = Logger()
+L.set_log_type('OKGREEN')
+error_log = Logger(level='WARNING')
+error_log.set_log_type('HEADER')
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class Tail:
+    """Keep every symbol current by polling its recent window on a cadence
+    that follows the symbol's activity.
+
+    Each symbol has an in-memory high-water mark that is checkpointed to a
+    file, so restarts pick up where the last poll stopped without querying
+    the newest row of every table again.
+    """
+
+    def __init__(self, scraper, symbols, checkpoint_file, n_threads=None, min_interval=60, max_interval=3600,
+                 target_rows=50, lookback=datetime.timedelta(days=1), lag=datetime.timedelta(minutes=10), checkpoint_interval=60):
+        self.scraper = scraper
+        self.type = scraper.type
+        self.symbols = symbols
+        self.checkpoint_file = checkpoint_file
+        self.n_threads = n_threads or scraper.n_threads
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target_rows = target_rows
+        self.lookback = lookback
+        self.lag = lag
+        self.checkpoint_interval = checkpoint_interval
+        self.label = ' [{}]:\t'.format('Tail')
+
+        self.cursors = {}
+        self.queries = {}
+        self.heap = []
+        self.cond = threading.Condition()
+        self.stopped = threading.Event()
+
+    def _now(self):
+        return datetime.datetime.now() + datetime.timedelta(hours=8)
+
+    def _interval(self, rate):
+        """Seconds until the symbol is expected to have `target_rows` new rows.
+        """
+        if rate <= 0:
+            return self.max_interval
+        return min(max(self.target_rows / rate, self.min_interval), self.max_interval)
+
+    def load(self):
+        """Restore cursors from the checkpoint, falling back to one bulk query
+        for symbols that are not in it.
+        """
+        if os.path.exists(self.checkpoint_file):
+            with open(self.checkpoint_file) as f:
+                saved = json.load(f)
+            for symbol, c in saved.items():
+                self.cursors[symbol] = {
+                    'since': datetime.datetime.strptime(c['since'], DATE_FORMAT),
+                    'rate': c['rate'],
+                }
+
+        now = self._now()
+        symbols = [s['symbol'] for s in self.symbols.symbols_list]
+        missing = [s for s in symbols if s not in self.cursors]
+        if len(missing) > 0:
+            window = datetime.timedelta(days=7)
+            database = Database(id='T')
+            try:
+                stats = database.bulk_newest(missing, self.type, now - window) or {}
+            except DatabaseUnavailable:
+                # Bounded by `lookback`, never the full history
+                L.log(self.label, 'Database unavailable, starting {} symbols at the lookback'.format(len(missing)))
+                stats = {}
+            database.close()
+            for symbol in missing:
+                s = stats.get(symbol)
+                if s is None or s['newest'] is None:
+                    since = now - self.lookback
+                    rate = 0.0
+                else:
+                    since = max(s['newest'], now - self.lookback)
+                    rate = s['recent'] / window.total_seconds()
+                self.cursors[symbol] = {'since': since, 'rate': rate}
+
+        # Most active symbols are polled first
+        for i, symbol in enumerate(sorted(symbols, key=lambda s: -self.cursors[s]['rate'])):
+            heapq.heappush(self.heap, (time.time() + i * 0.01, symbol))
+        L.log(self.label, 'Tailing {} {} symbols'.format(len(symbols), self.type))
+
+    def save(self):
+        with self.cond:
+            saved = {k: {'since': v['since'].strftime(DATE_FORMAT), 'rate': v['rate']} for k, v in self.cursors.items()}
+        tmp = '{}.tmp'.format(self.checkpoint_file)
+        with open(tmp, 'w') as f:
+            json.dump(saved, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.checkpoint_file)
+
+    def _next(self):
+        with self.cond:
+            while not self.stopped.is_set():
+                if len(self.heap) > 0:
+                    due, symbol = self.heap[0]
+                    wait = due - time.time()
+                    if wait <= 0:
+                        heapq.heappop(self.heap)
+                        return symbol
+                else:
+                    wait = None
+                self.cond.wait(timeout=wait if wait is None else min(wait, 1))
+        return None
+
+    def _poll(self, symbol, config):
+        with self.cond:
+            cursor = self.cursors[symbol]
+            since = cursor['since']
+        self.scraper.profiler.set_context(symbol=symbol)
+        if symbol not in self.queries:
+            self.queries[symbol] = self.scraper.query(self.symbols, symbol)
+
+        now = self._now()
+        started = time.time()
+        config.update(self.queries[symbol])
+        config['symbol'] = symbol
+        config['since'] = since
+        config['until'] = now
+        # Polls overlap by `lag`, so keep the IDs stored since the cursor
+        # for this poll only, rather than a set per symbol for the whole run
+        config['database'].create_table(symbol, self.type)
+        config['database'].warm_seen(symbol, self.type, since, until=now)
+        try:
+            n_rows, last = self.scraper.get_data(config)
+        finally:
+            config['database'].forget_seen(symbol, self.type)
+
+        # Rows may be indexed late, so the next poll re-reads the last `lag`
+        # before the newest row, or before now if nothing new was stored
+        since = max((last or now) - self.lag, since)
+        elapsed = max((now - cursor['since']).total_seconds(), 1)
+        rate = 0.5 * cursor['rate'] + 0.5 * n_rows / elapsed
+        with self.cond:
+            self.cursors[symbol] = {'since': since, 'rate': rate}
+            heapq.heappush(self.heap, (started + self._interval(rate), symbol))
+            self.cond.notify()
+
+    def _work(self, session, worker_id):
+        worker_label = ' ({}{}):\t'.format(self.type[0].upper(), worker_id)
+        self.scraper.profiler.set_context(worker=worker_id)
+        database = Database(id=worker_id)
+        config = {
+            'worker_label': worker_label,
+            'database': database,
+            'session': session,
+        }
+        while not self.stopped.is_set():
+            symbol = self._next()
+            if symbol is None:
+                break
+            try:
+                self._poll(symbol, config)
+            except Exception as e:
+                error_log.log(worker_label, '{} poll failed'.format(symbol), e)
+                with self.cond:
+                    heapq.heappush(self.heap, (time.time() + self.min_interval, symbol))
+        database.close()
+
+    def run(self):
+        self.load()
+        tor = self.scraper.tor
+        for worker_id in range(self.n_threads):
+            tor.renew_connection()
+            session = tor.get_session()
+            worker = threading.Thread(target=self._work, args=[session, worker_id])
+            worker.daemon = True
+            worker.start()
+
+        try:
+            while not self.stopped.wait(self.checkpoint_interval):
+                self.save()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stopped.set()
+            with self.cond:
+                self.cond.notify_all()
+            self.save()
+            L.log(self.label, 'Checkpoint saved to {}'.format(self.checkpoint_file))
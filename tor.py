@@ -7,9 +7,11 @@
 import json
 import requests
 import time
+import threading
 from stem import Signal
 from stem.control import Controller
 
+import profiler
 from logger import Logger
 
 
@@ -18,12 +20,20 @@ L.set_log_type('HEADER')
 
 
 class Tor:
-    def __init__(self, config_file='config.json', verbose=True):
+    def __init__(self, config_file='config.json', verbose=True, lock=None):
         self.config_file = config_file
         self.verbose = verbose
         self.is_tor_renewing = False
+        self.last_renewed = 0
+        # Incremented on every NEWNYM so state tied to a circuit can expire
+        self.circuit = 0
+        # Serializes NEWNYM signals, across processes if given a process lock
+        self.lock = lock
+        if self.lock is None:
+            self.lock = threading.Lock()
         self.tor_label = ' [{}]:\t'.format('Tor')
         self.ok = requests.codes.ok
+        self.profiler = profiler.NULL
 
         # Read configuration from file
         try:
@@ -59,16 +69,26 @@ class Tor:
     def renew_connection(self):
         """Establish a clean pathway through the tor network.
         """
+        requested = time.time()
         while self.is_tor_renewing:
             time.sleep(0.1)
 
-        if self.verbose:
-            L.log(self.tor_label, 'Renewing connection')
+        with self.profiler.span('renew_connection'), self.lock:
+            # Requests made while another thread was renewing share its circuit
+            if self.last_renewed > requested:
+                return
 
-        self.is_tor_renewing = True
-        with Controller.from_port(port=self.tor_controller_port) as c:
-            c.authenticate(password=self.password)
-            time.sleep(c.get_newnym_wait())
-            c.signal(Signal.NEWNYM)
-            # time.sleep(c.get_newnym_wait())
-        self.is_tor_renewing = False
+            if self.verbose:
+                L.log(self.tor_label, 'Renewing connection')
+
+            self.is_tor_renewing = True
+            try:
+                with Controller.from_port(port=self.tor_controller_port) as c:
+                    c.authenticate(password=self.password)
+                    time.sleep(c.get_newnym_wait())
+                    c.signal(Signal.NEWNYM)
+                    # time.sleep(c.get_newnym_wait())
+                self.last_renewed = time.time()
+                self.circuit += 1
+            finally:
+                self.is_tor_renewing = False
@@ -4,22 +4,36 @@
 # THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 
+import argparse
 import datetime
+import glob
 import json
 import re
 import time
 import threading
-from queue import Queue
+from queue import Queue, Empty
 
-from database import Database
+from autoscale import Autoscaler
+from database import Database, DatabaseUnavailable, METRIC_COLUMNS
+from journal import Journal
+from lease import LeaseQueue
+from scheduler import Scheduler
 from symbols import Symbols
+from tail import Tail
 from tor import Tor
+import dedup
+import index
+import logger
+import planner
+import processes
+import profiler
+import recent
 from logger import Logger
 
 
 L = Logger()
 L.set_log_type('OKCYAN')
-error_log = Logger()
+error_log = Logger(level='WARNING')
 error_log.set_log_type('HEADER')
 
 
@@ -28,11 +42,12 @@ USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:78.0) Gecko/20100101
 
 
 class Token:
-    def __init__(self, config, tor):
+    def __init__(self, config, tor, retry_delay=10):
         config['bearer_token'] = BEARER_TOKEN
         config['guest_token'] = None
         self.config = config
         self.tor = tor
+        self.retry_delay = retry_delay
         self.url = 'https://twitter.com'
         self._retries = 100
         self._timeout = 100
@@ -42,7 +57,7 @@ class Token:
         self.tor.renew_connection()
         self.config['session'] = self.tor.get_session()
         self.config['session'].headers.update({'User-Agent': USER_AGENT})
-        time.sleep(10)
+        time.sleep(self.retry_delay)
 
     def _request(self):
         for attempt in range(self._retries + 1):
@@ -68,8 +83,117 @@ class Token:
         self.config['guest_token'] = str(match.group(1))
 
 
+class TokenPool:
+    """Guest tokens shared by every worker of the process.
+
+    A token is kept per Tor circuit and reused until it is older than `ttl`
+    seconds, has been used `max_uses` times or is invalidated by a failed
+    request. A background thread replaces the token of the current circuit
+    before it runs out so workers rarely wait for twitter.com.
+    """
+
+    def __init__(self, tor, ttl=3 * 3600, max_uses=150, refresh_ahead=0.8, check_interval=10, retry_delay=10):
+        self.tor = tor
+        self.retry_delay = retry_delay
+        self.ttl = ttl
+        self.max_uses = max_uses
+        self.refresh_ahead = refresh_ahead
+        self.check_interval = check_interval
+        self.tokens = {}
+        self.lock = threading.Lock()
+        # Fetch in progress per circuit, for other workers to wait on
+        self.pending = {}
+        self.label = ' [{}]:\t'.format('Token')
+        self._refresher = None
+
+    def _expired(self, token, margin=1.0):
+        age = time.time() - token['fetched']
+        return age > self.ttl * margin or token['uses'] >= self.max_uses * margin
+
+    def _fetch(self, session=None):
+        """Download a new guest token, one fetch at a time per circuit. The
+        first worker to ask fetches without holding any lock, and the others
+        wait for its result.
+        """
+        circuit = self.tor.circuit
+        with self.lock:
+            token = self.tokens.get(circuit)
+            if token is not None and not self._expired(token, self.refresh_ahead):
+                return token
+            fetch = self.pending.get(circuit)
+            leader = fetch is None
+            if leader:
+                fetch = self.pending[circuit] = {'done': threading.Event(), 'token': None, 'error': None}
+        if not leader:
+            fetch['done'].wait()
+            if fetch['error'] is not None:
+                raise Exception('Guest token fetch failed: {}'.format(fetch['error']))
+            return fetch['token']
+
+        try:
+            config = {
+                'session': session or self.tor.get_session(),
+                'worker_label': self.label,
+            }
+            with self.tor.profiler.span('token_refresh'):
+                Token(config, self.tor, self.retry_delay).refresh(config)
+            token = {
+                'guest_token': config['guest_token'],
+                'fetched': time.time(),
+                'uses': 0,
+            }
+            with self.lock:
+                # Renewals inside refresh() may have moved to a new circuit
+                self.tokens = {self.tor.circuit: token}
+            fetch['token'] = token
+            return token
+        except Exception as e:
+            fetch['error'] = e
+            raise
+        finally:
+            with self.lock:
+                self.pending.pop(circuit, None)
+            fetch['done'].set()
+
+    def get(self, config):
+        """Guest token for the current circuit, counting one use.
+        """
+        if self._refresher is None:
+            with self.lock:
+                if self._refresher is None:
+                    self._refresher = threading.Thread(target=self._refresh, name='token-refresher', daemon=True)
+                    self._refresher.start()
+
+        with self.lock:
+            token = self.tokens.get(self.tor.circuit)
+            if token is None or self._expired(token):
+                token = None
+        if token is None:
+            token = self._fetch(config['session'])
+        with self.lock:
+            token['uses'] += 1
+        return token['guest_token']
+
+    def invalidate(self, guest_token):
+        with self.lock:
+            self.tokens = {k: v for k, v in self.tokens.items() if v['guest_token'] != guest_token}
+
+    def _refresh(self):
+        while True:
+            time.sleep(self.check_interval)
+            with self.lock:
+                token = self.tokens.get(self.tor.circuit)
+            if token is not None and not self._expired(token, self.refresh_ahead):
+                continue
+            try:
+                self._fetch()
+            except Exception as e:
+                error_log.log(self.label, 'Background refresh failed', e)
+
+
 class Twitter:
     def __init__(self, tor=None, config_file='config.json'):
+        self.type = 'twitter'
         self.tor = tor
         if self.tor is None:
             self.tor = Tor()
@@ -81,11 +205,101 @@ class Twitter:
                 config = json.load(f)
             self.start_date = config['twitter_start_date']
             self.n_threads = config['twitter_n_threads']
+            self.max_buffered_rows = config.get('max_buffered_rows', 5000)
+            self.min_threads = config.get('min_threads', 1)
+            self.max_threads = config.get('twitter_max_threads', 2 * self.n_threads)
+            # Seconds to back off after a failed request, and between pages
+            self.retry_delay = config.get('retry_delay', 10)
+            self.page_delay = config.get('page_delay', 0.2)
+            # Posts a window is sized to hold when its volume is estimated
+            self.window_rows = config.get('window_rows', 2000)
+            self.volume_cache = config.get('volume_cache', 'volume_cache.json')
         except Exception as e:
             raise Exception('Failed to read {}'.format(self.config_file))
+        self.dedup = dedup.from_config(config)
 
         self.base_url = 'https://api.twitter.com/2/search/adaptive.json'
+        self.lookup_url = 'https://api.twitter.com/1.1/statuses/lookup.json'
         self.tz_offset = datetime.timedelta(hours=8)
+        self.profiler = profiler.NULL
+        self.journal = None
+        self.volumes = None
+        self.tokens = TokenPool(self.tor, retry_delay=self.retry_delay)
+        self.throughput = processes.Throughput()
+
+    def query(self, symbols, symbol):
+        """Build the search query for a symbol.
+        """
+        name = symbols.company_name(symbol)
+        query_list = []
+        if name.lower() != symbol.lower():
+            query_list.append(name)
+        query_list.append('${}'.format(symbol))
+        # query = '({}) lang:en'.format(' OR '.join(query_list))
+        return {
+            'cursor': -1,
+            'search': ' OR '.join(query_list),
+            'exclude_retweets': True,
+            # 'min_retweets': 1,
+        }
+
+    def histogram(self, database, symbol, since, until, n_recent=30):
+        """Tweets per day of a symbol from `since` to `until`, keyed by date.
+        The search API has no count endpoint, so stored days are read from
+        the daily rollups and the days not yet stored are assumed to be as
+        busy as the last `n_recent` stored ones. Returns None if nothing is
+        stored.
+        """
+        rows = database.rollups(symbol, 'twitter', period='day', since=since, until=until)
+        if not rows:
+            return None
+        days = {bucket.strftime('%Y-%m-%d'): mentions for bucket, mentions, *_ in rows}
+        recent = [mentions for _, mentions, *_ in rows[-n_recent:]]
+        rate = sum(recent) / len(recent)
+        day = rows[-1][0] + datetime.timedelta(days=1)
+        while day < until:
+            days[day.strftime('%Y-%m-%d')] = rate
+            day += datetime.timedelta(days=1)
+        return days
+
+    def lookup(self, ids, max_tries=3):
+        """Current engagement counts of the tweets with `ids`, at most 100,
+        fetched in one request and keyed by id. Deleted tweets are left out,
+        and counts the response lacks are not returned. Returns None if the
+        request failed.
+        """
+        params = {
+            'id': ','.join(ids),
+            'include_entities': 'false',
+            'include_quote_count': 'true',
+            'include_reply_count': 'true',
+            'trim_user': 'true',
+        }
+        config = {
+            'session': self.tor.get_session(),
+            'worker_label': ' [Twitter]:\t',
+        }
+        for _ in range(max_tries):
+            config['guest_token'] = self.tokens.get(config)
+            headers = {
+                'authorization': BEARER_TOKEN,
+                'x-guest-token': config['guest_token'],
+            }
+            config['session'].headers.update({'User-Agent': USER_AGENT})
+            try:
+                res = config['session'].get(self.lookup_url, params=params, headers=headers)
+                if res.status_code == 200:
+                    return {
+                        t['id_str']: {c: t[c] for c in METRIC_COLUMNS['twitter'] if c in t}
+                        for t in res.json()
+                    }
+                self.tokens.invalidate(config['guest_token'])
+            except Exception as e:
+                error_log.log(config['worker_label'], 'Lookup request failed', e)
+            self.tor.renew_connection()
+            config['session'] = self.tor.get_session()
+            time.sleep(self.retry_delay)
+        return None
 
     def _request(self, config):
         params = {
@@ -163,19 +377,22 @@ class Twitter:
             q += f" exclude:nativeretweets exclude:retweets"
         params['q'] = q.strip()
 
-        headers = {
-            'authorization': config['bearer_token'],
-            'x-guest-token': config['guest_token'],
-        }
         while True:
+            config['guest_token'] = self.tokens.get(config)
+            headers = {
+                'authorization': BEARER_TOKEN,
+                'x-guest-token': config['guest_token'],
+            }
+            config['session'].headers.update({'User-Agent': USER_AGENT})
             try:
-                res = config['session'].get(self.base_url, params=params, headers=headers)
+                with self.profiler.span('request'):
+                    res = config['session'].get(self.base_url, params=params, headers=headers)
                 break
             except Exception as e:
                 error_log.log(config['worker_label'], 'Connection error', e)
                 self.tor.renew_connection()
                 config['session'] = self.tor.get_session()
-                time.sleep(10)
+                time.sleep(self.retry_delay)
         return res
 
     def parse_response(self, response, config):
@@ -255,92 +472,188 @@ class Twitter:
             config['cursor'] = data['timeline']['instructions'][-1]['replaceEntry']['entry']['content']['operation']['cursor']['value']
         return parsed
 
+    def _store(self, config, chunk, windows=1, max_tries=3):
+        """Write rows of the current window, retrying failed inserts. Raises
+        if they could not be stored, so the window is never journaled.
+        """
+        for _ in range(max_tries):
+            started = time.time()
+            with self.profiler.span('add_data'):
+                stored = config['database'].add_data(config['symbol'], chunk, type='twitter')
+            if stored:
+                self.throughput.add(len(chunk), windows=windows, write_time=time.time() - started)
+                return
+            error_log.log(config['worker_label'], '{} failed to store {} rows'.format(config['symbol'], len(chunk)))
+            time.sleep(self.retry_delay)
+        raise Exception('Failed to store {} rows of {}'.format(len(chunk), config['symbol']))
+
+    def _flush_pages(self, config, chunk):
+        """Store the pages buffered so far in a window and journal the
+        cursor they end at.
+        """
+        self._store(config, chunk, windows=0)
+        config['n_flushed'] += len(chunk)
+        _extend_range(config, chunk)
+        if config.get('journal') is not None:
+            window_since, window_until = config['window']
+            config['journal'].page_done('twitter', config['symbol'], window_since, window_until, config['cursor'])
+
     def get_data_chunk(self, config):
         chunk = []
+        n_pages = 0
+        journal = config.get('journal')
         while True:
-            time.sleep(0.2)
+            time.sleep(self.page_delay)
             response = self._request(config)
+            self.throughput.response(response.status_code)
 
             if response.status_code != self.tor.ok:
                 error_log.log(config['worker_label'], '{} Response not OK {}'.format(config['symbol'], response))
+                self.tokens.invalidate(config['guest_token'])
                 self.tor.renew_connection()
                 config['session'] = self.tor.get_session()
-                config['token'].refresh(config)
-                time.sleep(10)
+                time.sleep(self.retry_delay)
                 continue
 
-            data = self.parse_response(response, config)
+            with self.profiler.span('parse_response'):
+                data = self.parse_response(response, config)
+                data = config['database'].compact(data, type='twitter')
             if len(data) == 0:
                 break
+            if self.dedup is not None:
+                data = self.dedup.filter(config['symbol'], 'twitter', data, config['database'])
             chunk.extend(data)
 
-        chunk = sorted(chunk, key=lambda t: t['id'], reverse=False)
+            # Rows are written as pages arrive, in the order the API returns
+            # them, so at most `max_buffered_rows` are held per worker
+            n_pages += 1
+            if len(chunk) >= self.max_buffered_rows or (journal is not None and n_pages % journal.page_interval == 0):
+                self._flush_pages(config, chunk)
+                chunk = []
         return chunk
 
     def get_data(self, config):
-        config['token'] = Token(config, self.tor)
-        config['token'].refresh(config)
-
+        """Download and store `config['since']` to `config['until']` in
+        windows. Returns the number of rows and the datetime of the last one.
+        """
         start = config['since']
         end = config['until']
         current_date = start
 
-        leap = datetime.timedelta(days=3)
+        # Windows are sized to the expected volume when it is known
+        volume = config.get('volume')
         config['since'] = current_date
-        config['until'] = current_date + leap
+        config['until'] = planner.window_end(volume, current_date, self.window_rows)
 
         # Create table if it does not exist
         config['database'].create_table(config['symbol'], type='twitter')
+        n_rows = 0
+        last = None
+        journal = config.get('journal')
+        page = config.pop('resume_page', None)
 
         while True:
-            time.sleep(0.2)
+            time.sleep(self.page_delay)
             if config['until'] > end:
                 config['until'] = end
 
+            if page is not None:
+                # Continue an interrupted window after its last stored page
+                config['until'] = page['until']
+                config['cursor'] = page['cursor']
+                page = None
+            config['window'] = (current_date, config['until'])
+            config['n_flushed'] = 0
+            config['range'] = None
+
             chunk = self.get_data_chunk(config)
-            if len(chunk) == 0:
+            _extend_range(config, chunk)
+            if config['range'] is None:
                 date1 = config['since'].strftime('%Y-%m-%d %H:%M:%S')
                 date2 = config['until'].strftime('%Y-%m-%d %H:%M:%S')
             else:
-                date1 = chunk[0]['datetime'].strftime('%Y-%m-%d %H:%M:%S')
-                date2 = chunk[-1]['datetime'].strftime('%Y-%m-%d %H:%M:%S')
-            L.log(config['worker_label'], '{:<8} {} - {} ({})'.format(config['symbol'], date1, date2, len(chunk)))
+                date1 = config['range'][0].strftime('%Y-%m-%d %H:%M:%S')
+                date2 = config['range'][1].strftime('%Y-%m-%d %H:%M:%S')
+            n_chunk = len(chunk) + config['n_flushed']
+            L.log(config['worker_label'], '{:<8} {} - {} ({})'.format(config['symbol'], date1, date2, n_chunk))
             # L.log(json.dumps(chunk, indent=4, sort_keys=True))
             # return
 
             # Add to database
-            config['database'].add_data(config['symbol'], chunk, type='twitter')
+            self._store(config, chunk)
+            n_rows += n_chunk
+            if journal is not None:
+                journal.window_done('twitter', config['symbol'], *config['window'])
+            if config['range'] is not None:
+                last = config['range'][1].replace(tzinfo=None)
 
             # Increment time
-            current_date += leap
+            current_date = config['window'][1]
             config['since'] = current_date
-            config['until'] = current_date + leap
+            config['until'] = planner.window_end(volume, current_date, self.window_rows)
             if config['since'] >= end:
                 break
+        return n_rows, last
+
 
+def _extend_range(config, chunk):
+    """Widen the datetime range of the rows stored in the current window.
+    """
+    if len(chunk) == 0:
+        return
+    first = min(t['datetime'] for t in chunk)
+    last = max(t['datetime'] for t in chunk)
+    if config['range'] is not None:
+        first = min(first, config['range'][0])
+        last = max(last, config['range'][1])
+    config['range'] = (first, last)
 
-def _download_query(twitter, symbols, symbol, recency, session, worker_id):
+
+def download_query(twitter, symbols, symbol, recency, session, worker_id, newest_datetime=None, prechecked=False, until=None, database=None):
     worker_label = ' (T{}):\t'.format(worker_id)
+    twitter.profiler.set_context(worker=worker_id, symbol=symbol)
 
     # Build query
-    name = symbols.company_name(symbol)
-    query_list = []
-    if name.lower() != symbol.lower():
-        query_list.append(name)
-    query_list.append('${}'.format(symbol))
-    query = ' OR '.join(query_list)
-    # query = '({}) lang:en'.format(' OR '.join(query_list))
+    query = twitter.query(symbols, symbol)
     query_log = Logger()
     query_log.set_log_type('OKBLUE')
-    query_log.log(worker_label, 'Query [{}]'.format(query))
+    query_log.log(worker_label, 'Query [{}]'.format(query['search']))
 
     # Resume from last datetime
-    database = Database(id=worker_id)
+    own_database = database is None
+    if own_database:
+        database = Database(id=worker_id)
     since = datetime.datetime.strptime(twitter.start_date, '%Y-%m-%d %H:%M:%S')
-    newest = database.newest(symbol, type='twitter')
+    unavailable = False
+    if prechecked:
+        # Already ordered and filtered by the scheduler
+        newest = None if newest_datetime is None else {'datetime': newest_datetime}
+        recency = None
+    else:
+        try:
+            newest = database.newest(symbol, type='twitter')
+        except DatabaseUnavailable:
+            # Resume from the journal alone while the database is down
+            newest = None
+            unavailable = True
     if newest is not None:
         since = newest['datetime']
 
+    # Resume exactly where the journal says the last run stopped
+    journal = None
+    resume = None
+    if twitter.journal is not None and until is None:
+        journal = twitter.journal
+        resume = journal.resume('twitter', symbol, newest=None if newest is None else newest['datetime'])
+        if resume is not None:
+            since = resume['since']
+    if unavailable and resume is None:
+        # Unknown resume point, so retry later rather than scraping the
+        # symbol again from the start date
+        if own_database:
+            database.close()
+        raise DatabaseUnavailable('No resume point for {}'.format(symbol))
+
     # Check if it should update based on recency condition
     if recency is not None and newest is not None:
         date_last = newest['datetime']
@@ -352,6 +665,8 @@ def _download_query(twitter, symbols, symbol, recency, session, worker_id):
             skip_log = Logger()
             skip_log.set_log_type('FAIL')
             skip_log.log(worker_label, '{} skipped due to recency condition {} > {}'.format(symbol, last, check))
+            if own_database:
+                database.close()
             return
 
     config = {
@@ -359,59 +674,294 @@ def _download_query(twitter, symbols, symbol, recency, session, worker_id):
         'database': database,
         'session': session,
         'symbol': symbol,
-        'cursor': -1,
-        'search': query,
         'since': since,
-        'until': datetime.datetime.now() + datetime.timedelta(hours=8),
-        'exclude_retweets': True,
-        # 'min_retweets': 1,
+        'until': until or datetime.datetime.now() + datetime.timedelta(hours=8),
+        'journal': journal,
+        'volume': None if twitter.volumes is None else twitter.volumes.volume(symbol),
+        **query,
     }
+    if resume is not None and resume['page'] is not None:
+        config['resume_page'] = resume['page']
     L.log(worker_label, '{} resuming from {}'.format(symbol, config['since']))
+    if newest is not None or resume is not None:
+        # Rows from the resume point on may already be stored, and only the
+        # first window can overlap them
+        page = config.get('resume_page')
+        first_until = page['until'] if page is not None else planner.window_end(config['volume'], config['since'], twitter.window_rows)
+        database.warm_seen(symbol, 'twitter', config['since'], until=first_until)
     twitter.get_data(config)
-    database.close()
+    database.forget_seen(symbol, 'twitter')
+    if twitter.dedup is not None:
+        twitter.dedup.forget(symbol, 'twitter')
+    if own_database:
+        database.close()
 
 
-def _work(jobs, session, worker_id):
-    while not jobs.empty():
-        kwargs = jobs.get()
-        _download_query(**kwargs, session=session, worker_id=worker_id)
+def _work(jobs, twitter, symbols, session, worker_id, control=None):
+    while True:
+        if control is not None and control.should_stop():
+            return
+        try:
+            kwargs = jobs.get(timeout=1)
+        except Empty:
+            # A lease queue may only be waiting on units of other nodes
+            if jobs.empty():
+                break
+            continue
+        except Exception as e:
+            error_log.log(' (T{}):\t'.format(worker_id), 'Failed to get a job', e)
+            time.sleep(twitter.retry_delay)
+            continue
+        try:
+            download_query(twitter, symbols, **kwargs, session=session, worker_id=worker_id)
+        except DatabaseUnavailable as e:
+            error_log.log(' (T{}):\t'.format(worker_id), '{} deferred'.format(kwargs['symbol']), e)
+            time.sleep(twitter.retry_delay)
+            if isinstance(jobs, LeaseQueue):
+                jobs.release(count=False)
+            else:
+                # Queued again for later in this run
+                jobs.put(kwargs)
+                jobs.task_done()
+            continue
+        except Exception as e:
+            error_log.log(' (T{}):\t'.format(worker_id), '{} failed'.format(kwargs['symbol']), e)
+            if isinstance(jobs, LeaseQueue):
+                # Left for any node to retry rather than marked done
+                jobs.release()
+            else:
+                jobs.task_done()
+            continue
         jobs.task_done()
-
-
-def download(recency=None):
+    if control is not None:
+        control.stopped()
+
+
+def _start_worker(twitter, symbols, jobs, worker_id, control=None):
+    time.sleep(1)
+    twitter.tor.renew_connection()
+    time.sleep(2)
+    session = twitter.tor.get_session()
+    time.sleep(1)
+    worker = threading.Thread(target=_work, args=[jobs, twitter, symbols, session, worker_id, control])
+    worker.daemon = True
+    worker.start()
+    return worker
+
+
+def _start_workers(twitter, symbols, jobs, n_threads, first_id=0):
+    return [_start_worker(twitter, symbols, jobs, worker_id) for worker_id in range(first_id, first_id + n_threads)]
+
+
+def _process(process_id, jobs, results, lock, n_threads, profile, sample_interval, lease=None, journal=None, estimate=False):
+    """Run a group of worker threads in a child process with its own Tor
+    session, database connections and symbol table. `n_threads` lists the
+    thread count of every process.
+    """
+    logger.configure(config_file='config.json')
+    if lease is not None:
+        jobs = LeaseQueue.open(lease, 'twitter')
+    tor = Tor(lock=lock)
+    twitter = Twitter(tor)
+    if profile:
+        twitter.profiler = profiler.Profiler(sample_interval=sample_interval)
+        tor.profiler = twitter.profiler
+    if journal is not None:
+        twitter.journal = Journal(_journal_part(journal, process_id), base=journal)
+    search_index = index.attach()
+    recent_posts = recent.attach(part=process_id + 1)
+    symbols = Symbols()
+    if estimate:
+        # Estimated by the parent, so only read back to size windows
+        twitter.volumes = _volumes(twitter)
+
+    twitter.profiler.start()
+    workers = _start_workers(twitter, symbols, jobs, n_threads[process_id], first_id=sum(n_threads[:process_id]))
+    for worker in workers:
+        worker.join()
+    twitter.profiler.stop()
+    if profile:
+        L.log(twitter.profiler.report())
+    if twitter.journal is not None:
+        twitter.journal.close()
+    if search_index is not None:
+        search_index.close()
+    if recent_posts is not None:
+        recent_posts.close()
+    results.put(twitter.throughput.snapshot(process_id))
+
+
+def _journal_part(journal, process_id):
+    return '{}.{}'.format(journal, process_id)
+
+
+def _volumes(twitter, database=None):
+    """Planner estimating tweets per day from the daily rollups in
+    `database`.
+    """
+    def histogram(symbol, since, until):
+        return twitter.histogram(database, symbol, since, until)
+    start_date = datetime.datetime.strptime(twitter.start_date, '%Y-%m-%d %H:%M:%S')
+    return planner.Planner('twitter', planner.VolumeCache(twitter.volume_cache), histogram, start_date)
+
+
+def download(recency=None, profile=False, sample_interval=None, schedule=True, n_processes=1, lease=None, journal='twitter_journal.jsonl', autoscale=False, estimate=False):
+    """Download every symbol. With `profile`, time each pipeline stage and
+    log where wall time went, optionally sampling worker stacks every
+    `sample_interval` seconds. With `schedule`, the staleness of every symbol
+    is fetched in one pass so the stalest, most active symbols go first and
+    recently updated ones are never handed to a worker. With `n_processes`
+    greater than one, the configured threads are split between that many
+    processes to spread parsing over more cores. With `lease`, jobs come from
+    a lease table shared with other nodes, in the MySQL database if True or
+    in the SQLite file at the given path. Completed windows and page progress
+    are recorded in `journal` so a restart continues exactly where the last
+    run stopped. With `autoscale`, workers are added and retired at runtime
+    between `min_threads` and `twitter_max_threads` in a single process. With
+    `estimate`, the volume of every symbol is counted first and cached in
+    `volume_cache`, so windows are sized to hold about `window_rows` posts
+    and scheduled jobs run largest first with a running ETA.
+    """
+    logger.configure(config_file='config.json')
     tor = Tor()
     twitter = Twitter(tor)
+    if profile:
+        twitter.profiler = profiler.Profiler(sample_interval=sample_interval)
+        tor.profiler = twitter.profiler
+    if journal is not None:
+        twitter.journal = Journal(journal)
+        # Fold in what child processes of an earlier run recorded
+        for part in glob.glob(_journal_part(journal, '[0-9]*')):
+            twitter.journal.merge(part)
+    search_index = index.attach()
+    # Child processes serve the posts they store themselves
+    recent_posts = recent.attach() if n_processes == 1 else None
 
     # Worker queue
-    jobs = Queue()
+    if lease is not None:
+        jobs = LeaseQueue.open(lease, 'twitter')
+    elif n_processes > 1:
+        jobs = processes.context.JoinableQueue()
+    else:
+        jobs = Queue()
     symbols = Symbols()
-    for symbol_info in symbols.symbols_list:
-        symbol = symbol_info['symbol']
-        jobs.put({
-            'twitter': twitter,
-            'symbols': symbols,
-            'symbol': symbol,
-            'recency': recency,
-        })
+    plan = None
+    if schedule:
+        start_date = datetime.datetime.strptime(twitter.start_date, '%Y-%m-%d %H:%M:%S')
+        scheduler = Scheduler('twitter', start_date)
+        plan = scheduler.plan([s['symbol'] for s in symbols.symbols_list], recency=recency)
+    if estimate:
+        database = Database(id='P')
+        twitter.volumes = _volumes(twitter, database)
+        twitter.volumes.refresh([s['symbol'] for s in symbols.symbols_list])
+        database.close()
+        if plan is not None:
+            plan = twitter.volumes.order(plan)
+    if lease is not None:
+        until = datetime.datetime.now() + datetime.timedelta(hours=8)
+        if plan is None:
+            plan = [(s['symbol'], None) for s in symbols.symbols_list]
+        jobs.seed([(symbol, newest, until) for symbol, newest in plan])
+    elif plan is not None:
+        for symbol, newest in plan:
+            jobs.put({
+                'symbol': symbol,
+                'recency': recency,
+                'newest_datetime': newest,
+                'prechecked': True,
+            })
+    else:
+        for symbol_info in symbols.symbols_list:
+            symbol = symbol_info['symbol']
+            jobs.put({
+                'symbol': symbol,
+                'recency': recency,
+            })
 
     # Download
     L.log('Twitter download begin')
-    for worker_id in range(twitter.n_threads):
-        time.sleep(1)
-        tor.renew_connection()
-        time.sleep(2)
-        session = tor.get_session()
-        time.sleep(1)
-        worker = threading.Thread(target=_work, args=[jobs, session, worker_id])
-        worker.daemon = True
-        worker.start()
-    jobs.join()
+    start_time = time.time()
+    if n_processes > 1:
+        results = processes.context.Queue()
+        lock = processes.context.Lock()
+        # Never more processes than threads, so every process gets one
+        n_processes = min(n_processes, twitter.n_threads)
+        n_threads = processes.split(twitter.n_threads, n_processes)
+        if lease is not None:
+            jobs.close()
+            jobs = None
+        children = processes.start(_process, n_processes, [jobs, results, lock, n_threads, profile, sample_interval, lease, journal, estimate])
+        stats = processes.collect(children, results)
+        if journal is not None:
+            for process_id in range(n_processes):
+                twitter.journal.merge(_journal_part(journal, process_id))
+    else:
+        twitter.profiler.start()
+        control = None
+        if autoscale:
+            control = Autoscaler(lambda worker_id: _start_worker(twitter, symbols, jobs, worker_id, control), [twitter.throughput],
+                                 depth=getattr(jobs, 'qsize', None), n_min=twitter.min_threads, n_max=twitter.max_threads)
+            control.start(twitter.n_threads)
+        else:
+            _start_workers(twitter, symbols, jobs, twitter.n_threads)
+        eta = twitter.volumes is not None and plan is not None
+        if eta:
+            twitter.volumes.start(twitter.throughput)
+        try:
+            jobs.join()
+        finally:
+            if eta:
+                twitter.volumes.stop()
+            if control is not None:
+                control.stop()
+            twitter.profiler.stop()
+            if profile:
+                L.log(twitter.profiler.report())
+            if lease is not None:
+                jobs.close()
+        stats = [twitter.throughput.snapshot()]
+    if twitter.journal is not None:
+        twitter.journal.close()
+    if search_index is not None:
+        search_index.close()
+    if recent_posts is not None:
+        recent_posts.close()
+    L.log(processes.report(stats, time.time() - start_time))
     L.log('Twitter download complete')
 
 
+def tail(checkpoint_file='twitter_tail.json', **kwargs):
+    """Poll the recent window of every symbol until interrupted, keeping
+    per-symbol cursors in `checkpoint_file`. Keyword arguments are passed to
+    `Tail`.
+    """
+    logger.configure(config_file='config.json')
+    tor = Tor()
+    twitter = Twitter(tor)
+    symbols = Symbols()
+    search_index = index.attach()
+    recent_posts = recent.attach()
+    try:
+        Tail(twitter, symbols, checkpoint_file, **kwargs).run()
+    finally:
+        if search_index is not None:
+            search_index.close()
+        if recent_posts is not None:
+            recent_posts.close()
+
+
 if __name__ == '__main__':
-    # recency = datetime.timedelta(days=2)
-    download(recency=None)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tail', action='store_true', help='keep polling recent windows instead of sweeping once')
+    parser.add_argument('--autoscale', action='store_true', help='adjust the number of workers at runtime')
+    parser.add_argument('--estimate', action='store_true', help='count the volume of every symbol before downloading')
+    args = parser.parse_args()
+
+    if args.tail:
+        tail()
+    else:
+        # recency = datetime.timedelta(days=2)
+        download(recency=None, autoscale=args.autoscale, estimate=args.estimate)
 
     # config['since'] = datetime.datetime.now() + datetime.timedelta(hours=8) - datetime.timedelta(hours=10)
     # config['until'] = datetime.datetime.now() + datetime.timedelta(hours=8)